@@ -0,0 +1,266 @@
+'''
+    asyncio transport and programmer API. The serial port's file descriptor is put in non-blocking mode and read
+    from the event loop (add_reader), so one process can drive many targets without a thread each:
+
+        async def program(f_p, image):
+            a_p = async_programmer(f_p)
+            async with a_p.comm:
+                await a_p.reset()
+                await a_p.flash(0, image)
+
+        asyncio.run(asyncio.gather(*[program(f_p, image) for f_p in programmers]))
+
+    The protocol is the blocking programmer's: its *_steps generators yield I/O requests (see flashcomm.run_steps)
+    that are executed here with awaits. RenesasFlashComm still does the GPIOs and the frame building.
+    UART2 and the single wire UART1 are supported, SPI transfers can't be made non-blocking.
+'''
+import asyncio
+import logging
+import os
+
+from defs import *
+from flashcomm import FrameParser, as_buffer
+from checksum import frame_checksum
+
+
+class AsyncFlashComm():
+    ''' Async send / receive and framing on the serial port of a RenesasFlashComm '''
+
+    def __init__(self, flashcomm):
+        if flashcomm.serial_port is None:
+            raise ValueError("Only the UART modes can be driven asynchronously")
+        if flashcomm.reader is not None:
+            raise ValueError("The port is already read by a reader thread")
+        self.flashcomm = flashcomm
+        self.fd = flashcomm.serial_port.fileno()
+        # Single wire UART: everything sent is received back
+        self.echo = flashcomm.comm_mode != Comm_Mode.UART2
+        self.parser = FrameParser(flashcomm.FRAME_STX, flashcomm.n_len_bytes, frame_checksum, (flashcomm.FRAME_ETB, flashcomm.FRAME_ETX))
+        self.rx = bytearray()
+        self._rx_event = None
+        self._loop = None
+
+    async def __aenter__(self):
+        self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def open(self):
+        ''' Starts receiving on the running event loop '''
+        self._loop = asyncio.get_running_loop()
+        self._rx_event = asyncio.Event()
+        os.set_blocking(self.fd, False)
+        self._loop.add_reader(self.fd, self._on_readable)
+
+    def close(self):
+        if self._loop is not None:
+            self._loop.remove_reader(self.fd)
+            self._loop = None
+        os.set_blocking(self.fd, True)
+
+    def _on_readable(self):
+        try:
+            _d = os.read(self.fd, 0x10000)
+        except BlockingIOError:
+            return
+        if _d:
+            self.rx += _d
+            self._rx_event.set()
+
+    async def recv(self, n_bytes, timeout):
+        ''' Returns up to n_bytes, waits up to timeout for the first one. b'' if nothing came '''
+        if not self.rx:
+            self._rx_event.clear()
+            try:
+                await asyncio.wait_for(self._rx_event.wait(), max(timeout, 0))
+            except asyncio.TimeoutError:
+                return b''
+        _d = bytes(self.rx[:n_bytes])
+        del self.rx[:n_bytes]
+        return _d
+
+    async def recv_exact(self, n_bytes, timeout):
+        ''' Waits until n_bytes are in or timeout has passed, returns what came '''
+        deadline = self._loop.time() + timeout
+        _d = b''
+        while len(_d) < n_bytes:
+            _r = await self.recv(n_bytes - len(_d), deadline - self._loop.time())
+            if not _r:
+                break
+            _d += _r
+        return _d
+
+    async def send(self, data):
+        ''' Writes all of data, waiting for the port to become writable when its buffer is full '''
+        mv = memoryview(as_buffer(data))
+        n_sent = 0
+        while n_sent < len(mv):
+            try:
+                n_sent += os.write(self.fd, mv[n_sent:])
+            except BlockingIOError:
+                _w = self._loop.create_future()
+                self._loop.add_writer(self.fd, lambda: _w.done() or _w.set_result(None))
+                try:
+                    await _w
+                finally:
+                    self._loop.remove_writer(self.fd)
+        if self.echo:
+            # read back the bytes we sent since it's a single wire, see SingleWire
+            _e = await self.recv_exact(len(mv), 0.1 + len(mv) * 10 / self.flashcomm.baud_rate)
+            if not _e:
+                raise NoResponseError("No echo of the {} bytes sent, is the line connected?".format(len(mv)))
+            if _e != mv:
+                raise BusCollisionError("Echo differs from the {} bytes sent".format(len(mv)))
+
+    async def send_command_frame(self, cmd, data = []):
+        await self.send(self.flashcomm.make_frame(self.flashcomm.FRAME_SOH, data, prefix = bytes((cmd,))))
+
+    async def send_data_frame(self, data = [], prefix = b''):
+        await self.send(self.flashcomm.make_frame(self.flashcomm.FRAME_STX, data, prefix = prefix))
+
+    async def recv_data_frame(self, timeout = 0.1):
+        ''' Receives a data frame and returns its payload, the whole frame has to be in within timeout '''
+        p = self.parser
+        p.reset()
+        deadline = self._loop.time() + timeout
+        while p.state != p.COMPLETE:
+            _b = await self.recv(p.want(), deadline - self._loop.time())
+            if not _b:
+                if p.state != p.HUNT_STX:
+                    raise InvalidFooterError("Frame incomplete: " + p.hex())
+                if p.n_garbage:
+                    raise InvalidHeaderError("Received frame is not a data frame: " + p.hex())
+                raise NoResponseError("No frame received")
+            p.feed(_b)
+            if p.state == p.ERROR:
+                raise p.error
+            if p.state == p.HUNT_STX and p.n_skipped >= 0x100:
+                raise InvalidHeaderError("Received frame is not a data frame: " + p.hex())
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(p.hex())
+        return p.payload()
+
+    async def io(self, req):
+        ''' Executes one I/O request of the protocol steps (not FRAME, that's the programmer's) '''
+        op = req[0]
+        if op == IO_Op.SEND:
+            return await self.send(req[1])
+        if op == IO_Op.RECV:
+            return await self.recv_exact(req[1], self.flashcomm.serial_port.timeout)
+        if op == IO_Op.SLEEP:
+            return await asyncio.sleep(req[1])
+        if op == IO_Op.FLUSH:
+            self.flashcomm.serial_port.reset_input_buffer()
+            return self.rx.clear()
+        if op == IO_Op.COMMAND:
+            if len(req) > 3 and req[3] is not None:
+                raise ValueError("No command callbacks on the UART")
+            return await self.send_command_frame(*req[1:3])
+        if op == IO_Op.DATA:
+            return await self.send_data_frame(*req[1:])
+        raise ValueError("Can't execute {}".format(op))
+
+
+class AsyncFlashProgrammer():
+    '''
+        Runs the protocol steps of a RenesasFlashProgrammer (program_steps, read_stream_steps, ...) on the event loop.
+        The commands and their checks, the layout, timeouts and image handling all come from the wrapped programmer,
+        so the family specifics (the RH850 reset and two phase commands) are the same as on the blocking transport
+    '''
+
+    def __init__(self, f_p):
+        self.f_p = f_p
+        self.comm = AsyncFlashComm(f_p.flashcomm)
+
+    async def recv(self, timeout = None):
+        ''' Receives a data frame, waiting until timeout (default the programmer's). Raises InvalidFrameError if nothing came '''
+        try:
+            return await self.comm.recv_data_frame(self.f_p.timeout if timeout is None else timeout)
+        except (InvalidFrameError, NoResponseError) as e:
+            raise InvalidFrameError("Didn't receive a frame: {}".format(e))
+
+    async def io(self, req):
+        if req[0] == IO_Op.FRAME:
+            return await self.recv(req[1])
+        return await self.comm.io(req)
+
+    async def run(self, steps):
+        ''' flashcomm.run_steps with awaits '''
+        _r = _e = None
+        while True:
+            try:
+                req = steps.throw(_e) if _e is not None else steps.send(_r)
+            except StopIteration as e:
+                return e.value
+            try:
+                _r, _e = await self.io(req), None
+            except Exception as e:
+                _r, _e = None, e
+
+    async def stream(self, steps):
+        ''' flashcomm.stream_steps with awaits, an async generator of the values the steps hand out '''
+        _r = _e = None
+        while True:
+            try:
+                req = steps.throw(_e) if _e is not None else steps.send(_r)
+            except StopIteration:
+                return
+            if req[0] == IO_Op.OUT:
+                _r, _e = None, None
+                yield req[1]
+                continue
+            try:
+                _r, _e = await self.io(req), None
+            except Exception as e:
+                _r, _e = None, e
+
+    async def reset(self):
+        ''' 0 if the reset command is acknowledged, -1 if not '''
+        fc = self.f_p.flashcomm
+        if fc.type in fc.reset_funcs:
+            raise ValueError("No async reset sequence for {}".format(fc.type.value))
+        return await self.run(self.f_p.reset_steps())
+
+    async def program(self, addr_start, bin_data):
+        return await self.run(self.f_p.program_steps(addr_start, bin_data))
+
+    async def block_erase(self, addr_start, addr_end):
+        return await self.run(self.f_p.block_erase_steps(addr_start, addr_end))
+
+    async def erase(self, addr_start, addr_end):
+        ''' Erases every erase block touching addr_start - addr_end, raises NoAckError if one fails '''
+        await self.run(self.f_p.erase_blocks_steps(self.f_p.get_layout().blocks(addr_start, addr_end), chip_erase = False))
+
+    async def get_checksum(self, addr_start, addr_end):
+        return await self.run(self.f_p.get_checksum_steps(addr_start, addr_end))
+
+    async def read_checksum(self, addr_start, addr_end):
+        return await self.run(self.f_p.read_checksum_steps(addr_start, addr_end))
+
+    def read_stream(self, addr_start, n_bytes):
+        ''' Async generator of (address, data) per received frame '''
+        return self.stream(self.f_p.read_stream_steps(addr_start, n_bytes))
+
+    async def read(self, addr_start, n_bytes):
+        buf = bytearray(n_bytes)
+        n_rcvd = 0
+        async for addr, dat in self.read_stream(addr_start, n_bytes):
+            buf[addr - addr_start:addr - addr_start + len(dat)] = dat
+            n_rcvd = addr - addr_start + len(dat)
+        return bytes(buf[:n_rcvd])
+
+    async def flash(self, addr, binary):
+        ''' Erases the blocks the image touches (erase_blocks, no chip erase) and programs it, no diff here '''
+        f_p = self.f_p
+        image = f_p.load_image(binary, addr)
+        blocks = f_p.get_layout().blocks_for(image.ranges())
+        await self.run(f_p.erase_blocks_steps(blocks, chip_erase = False))
+        await self.run(f_p.program_image_steps(image, blocks))
+        return image
+
+
+def async_programmer(f_p):
+    ''' The async wrapper for a programmer '''
+    return AsyncFlashProgrammer(f_p)
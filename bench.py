@@ -0,0 +1,240 @@
+'''
+    End-to-end throughput benchmark of the programmers against the simulated bootloader (simulator.py).
+    Every MCU class in main.flash_programmers runs program / verify / checksums / read / erase, and the time is
+    split into sleep(), waiting on the serial port and Python CPU.
+
+        GPIOZERO_PIN_FACTORY=mock python bench.py --size 2000 --out bench.json
+        GPIOZERO_PIN_FACTORY=mock python bench.py --compare bench.json
+
+    The simulator runs in its own process so its CPU time doesn't count.
+'''
+import argparse
+import contextlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from defs import MCU_Type, Comm_Mode
+from flashcomm import RenesasFlashComm
+from simulator import SimulatedTarget
+import main
+
+
+''' Communication mode and start address used per MCU type '''
+BENCH_TARGETS = {
+    MCU_Type.RH850: (Comm_Mode.UART2, 0x0),
+    MCU_Type.R32C: (Comm_Mode.UART2, 0xfc0000),
+    MCU_Type.R78K0: (Comm_Mode.UART2, 0x0),
+    MCU_Type.R78K0R: (Comm_Mode.UART1, 0x0),
+    MCU_Type.V850E2: (Comm_Mode.UART1, 0x0),
+}
+
+''' Modules that do "from time import sleep" (or precise_sleep from gpio) '''
+SLEEP_MODULES = ["flashcomm", "renesas_fpi", "rh850_prog", "r32c_prog", "r78k0_prog"]
+
+
+class Probe():
+    ''' Accumulates the time spent in sleep() and on the serial port, and counts the commands '''
+
+    def __init__(self):
+        self.sleep = 0.0
+        self.io = 0.0
+        self.commands = 0
+        self._patched = []
+
+    def _timed(self, f, attr):
+        def _wrapper(*args, **kwargs):
+            _st = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                setattr(self, attr, getattr(self, attr) + time.perf_counter() - _st)
+        return _wrapper
+
+    def _patch(self, obj, name, f):
+        self._patched.append((obj, name, obj.__dict__.get(name)))
+        setattr(obj, name, f)
+
+    def install(self, flashcomm):
+        for m in SLEEP_MODULES:
+            mod = sys.modules.get(m)
+            for name in ("sleep", "precise_sleep"):
+                if mod is not None and hasattr(mod, name):
+                    self._patch(mod, name, self._timed(getattr(mod, name), "sleep"))
+        _send_cmd = flashcomm.send_command_frame
+        def _count(*args, **kwargs):
+            self.commands += 1
+            return _send_cmd(*args, **kwargs)
+        self._patch(flashcomm, "send_command_frame", _count)
+        # R32C has no command frames, every raw send is a command
+        if flashcomm.type == MCU_Type.R32C:
+            _send = flashcomm.send
+            def _count_raw(*args, **kwargs):
+                self.commands += 1
+                return _send(*args, **kwargs)
+            self._patch(flashcomm, "send", _count_raw)
+        self._patch(flashcomm.serial_port, "read", self._timed(flashcomm.serial_port.read, "io"))
+        self._patch(flashcomm.serial_port, "write", self._timed(flashcomm.serial_port.write, "io"))
+
+    def uninstall(self):
+        for obj, name, orig in reversed(self._patched):
+            if orig is None:
+                delattr(obj, name)
+            else:
+                setattr(obj, name, orig)
+        self._patched = []
+
+    def snapshot(self):
+        return (time.perf_counter(), time.process_time(), self.sleep, self.io, self.commands)
+
+
+def measure(probe, name, n_bytes, f):
+    ''' Runs f and returns the result entry '''
+    w_0, c_0, s_0, io_0, n_0 = probe.snapshot()
+    err = None
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            f()
+    except Exception as e:
+        err = "{}: {}".format(type(e).__name__, e)
+    w_1, c_1, s_1, io_1, n_1 = probe.snapshot()
+    wall = w_1 - w_0
+    return {
+        "op": name,
+        "bytes": n_bytes,
+        "wall": wall,
+        "bytes_per_s": n_bytes / wall if wall and n_bytes else 0.0,
+        "commands": n_1 - n_0,
+        "commands_per_s": (n_1 - n_0) / wall if wall else 0.0,
+        "sleep": s_1 - s_0,
+        "io": io_1 - io_0,
+        "cpu": c_1 - c_0,
+        "error": err,
+    }
+
+
+def operations(f_p, addr, size, firmware, tmp):
+    ''' The benchmarked operations available on this programmer: (name, bytes, function) '''
+    ops = []
+    if hasattr(f_p, "flash") and f_p.mcu_type != MCU_Type.R32C:
+        ops.append(("program", size, lambda: f_p.flash(addr, firmware)))
+        for _m in f_p.verify_modes():
+            ops.append(("vfy_" + _m, size, lambda _m = _m: f_p.verify_image(firmware, addr, mode = _m)))
+        ops.append(("checksums", size, lambda: f_p.get_checksums(addr, addr + size)))
+    if hasattr(f_p, "read"):
+        ops.append(("read", size, lambda: f_p.read(addr, size)))
+    else:
+        ops.append(("read", size, lambda: f_p.read_memory(addr, size, os.path.join(tmp, "read.bin"))))
+    if f_p.mcu_type == MCU_Type.R32C:
+        ops.append(("erase", 0, f_p.erase_chip))
+    else:
+        ops.append(("erase", size, lambda: [f_p.block_erase(a) for a in range(addr, addr + size, f_p.fl_block_size)]))
+    return ops
+
+
+def release_pins():
+    ''' Off the Pi the mock pin factory is used, forget the pins of the previous session '''
+    try:
+        from gpiozero import Device
+    except ImportError:
+        return
+    if Device.pin_factory is not None and hasattr(Device.pin_factory, "reset"):
+        Device.pin_factory.reset()
+
+
+def bench_mcu(mcu, size, sim_kwargs, tmp):
+    ''' Runs all operations for one MCU type against a fresh simulator, returns the result entries '''
+    mode, addr = BENCH_TARGETS[mcu]
+    results = []
+    sim = SimulatedTarget(mcu, echo = mode != Comm_Mode.UART2, **sim_kwargs)
+    port = sim.open()
+    proc = multiprocessing.Process(target = sim.serve_forever, daemon = True)
+    proc.start()
+    firmware = os.path.join(tmp, "firmware.bin")
+    with open(firmware, "wb") as f:
+        f.write(os.urandom(size))
+    try:
+        flashcomm = RenesasFlashComm(mcu, mode, port = port)
+        f_p = main.flash_programmers[mcu](flashcomm = flashcomm)
+        probe = Probe()
+        probe.install(flashcomm)
+        try:
+            _r = measure(probe, "reset", 0, f_p.reset)
+            results.append(_r)
+            if _r["error"] is None:
+                for name, n_bytes, f in operations(f_p, addr, size, firmware, tmp):
+                    results.append(measure(probe, name, n_bytes, f))
+        finally:
+            probe.uninstall()
+    except Exception as e:
+        results.append({"op": "setup", "error": "{}: {}".format(type(e).__name__, e)})
+    finally:
+        release_pins()
+        proc.terminate()
+        proc.join()
+        sim.close()
+    for r in results:
+        r["mcu"] = mcu.value
+        r["mode"] = mode.value
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd = os.path.dirname(os.path.abspath(__file__)), stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, previous = None):
+    prev = {(r["mcu"], r["op"]): r for r in previous["results"]} if previous else {}
+    print("{:<8} {:<12} {:>9} {:>11} {:>8} {:>8} {:>8} {:>8} {:>8}  {}".format(
+        "mcu", "op", "wall [s]", "bytes/s", "cmds/s", "sleep", "io", "cpu", "vs prev", "error"))
+    for r in results:
+        if "wall" not in r:
+            print("{:<8} {:<12} {}".format(r["mcu"], r["op"], r["error"]))
+            continue
+        _p = prev.get((r["mcu"], r["op"]))
+        _d = "{:+.0%}".format(r["wall"] / _p["wall"] - 1) if _p and _p.get("wall") else ""
+        print("{:<8} {:<12} {:>9.3f} {:>11.0f} {:>8.1f} {:>8.3f} {:>8.3f} {:>8.3f} {:>8}  {}".format(
+            r["mcu"], r["op"], r["wall"], r["bytes_per_s"], r["commands_per_s"], r["sleep"], r["io"], r["cpu"], _d, r["error"] or ""))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Renesas flash programming benchmark', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--mcu", help="Only benchmark these MCU types", choices = [t.value for t in BENCH_TARGETS], action = "append")
+    parser.add_argument("--size", help="Image / read size (hex)", type = lambda x: int(x, 16), default = 0x2000)
+    parser.add_argument("--baud", help="Simulated wire speed (0: no wire delay)", type = int, default = 0)
+    parser.add_argument("--erase_time", help="Simulated erase latency per block (s)", type = float, default = 0.0)
+    parser.add_argument("--program_time", help="Simulated program latency per KiB (s)", type = float, default = 0.0)
+    parser.add_argument("--out", help="Write the results as json to this file")
+    parser.add_argument("--compare", help="Results json of a previous run to compare against")
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.ERROR, format="%(filename)s:%(funcName)s: %(message)s")
+
+    mcus = [MCU_Type(m) for m in args.mcu] if args.mcu else [m for m in main.flash_programmers if m in BENCH_TARGETS]
+    sim_kwargs = {"baud_rate": args.baud, "erase_time": args.erase_time, "program_time": args.program_time}
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for mcu in mcus:
+            results += bench_mcu(mcu, args.size, sim_kwargs, tmp)
+    skipped = [m.value for m in main.flash_programmers if m not in BENCH_TARGETS]
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_results(results, previous)
+    if skipped:
+        print("Not benchmarked (no simulated transport): {}".format(", ".join(skipped)))
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"commit": git_commit(), "time": time.time(), "size": args.size, "sim": sim_kwargs, "results": results}, f, indent = 1)
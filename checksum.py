@@ -0,0 +1,117 @@
+''' Checksums used by the Renesas flash programming interface '''
+from time import perf_counter
+
+''' Imported the first time a buffer is big enough for it (_numpy), None if it isn't installed '''
+numpy = None
+_numpy_tried = False
+
+
+''' From this size on, summing through numpy is faster than sum() over the bytes '''
+NUMPY_MIN_SIZE      =   0x4000
+
+
+def _numpy():
+    global numpy, _numpy_tried
+    if not _numpy_tried:
+        _numpy_tried = True
+        try:
+            import numpy
+        except ImportError:
+            pass
+    return numpy
+
+
+def byte_sum(data):
+    ''' Sum of all bytes in data (bytes, bytearray, memoryview or list of ints) '''
+    if len(data) >= NUMPY_MIN_SIZE and not isinstance(data, list) and _numpy() is not None:
+        return int(numpy.frombuffer(data, dtype=numpy.uint8).sum(dtype=numpy.uint64))
+    return sum(data)
+
+
+def frame_checksum(data):
+    ''' Checksum of a frame: 0 minus all bytes from the length field up to the checksum, truncated to 8 bits '''
+    return -byte_sum(data) & 0xff
+
+
+def area_checksum(data, bits = 16):
+    ''' The checksum the device returns for an area (COMMAND_CHECKSUM): 0 minus all bytes, truncated to 16 bits '''
+    return -byte_sum(data) & ((1 << bits) - 1)
+
+
+def image_checksum(image, addr_start, addr_end, addr_base = 0, fill = 0xff, bits = 16):
+    '''
+        Area checksum of addr_start - addr_end (inclusive) of an image loaded at addr_base.
+        Bytes outside the image count as fill (erased flash)
+    '''
+    mv = memoryview(image)
+    s = max(addr_start - addr_base, 0)
+    e = min(addr_end + 1 - addr_base, len(mv))
+    chk = Checksum(bits)
+    if e > s:
+        chk.update(mv[s:e])
+    else:
+        e = s
+    chk.update_fill(fill, (addr_end - addr_start + 1) - (e - s))
+    return chk.value()
+
+
+class Checksum():
+    '''
+        Incremental checksum - header bytes and payload slices can be folded in one after the other without
+        concatenating them first
+    '''
+
+    def __init__(self, bits = 8, data = None):
+        self.mask = (1 << bits) - 1
+        self.total = 0
+        if data is not None:
+            self.update(data)
+
+    def update(self, data):
+        ''' Adds a single byte (int) or a bytes-like slice '''
+        if isinstance(data, int):
+            self.total += data & 0xff
+        else:
+            self.total += byte_sum(data)
+        return self
+
+    def update_fill(self, fill, n):
+        ''' Adds n bytes of the fill value '''
+        self.total += (fill & 0xff) * n
+        return self
+
+    def value(self):
+        return -self.total & self.mask
+
+
+def _checksum_loop(data):
+    ''' The original per-byte implementation, kept for the benchmark '''
+    s = 0
+    for b in data:
+        s = (s - b) & 0xff
+    return s & 0xff
+
+
+if __name__ == "__main__":
+    import os
+
+    _data = os.urandom(0x100000)
+    _frames = [memoryview(_data)[i:i + 0x400] for i in range(0, len(_data), 0x400)]
+
+    def _bench(name, f, args, rounds = 5):
+        _best = None
+        for _r in range(rounds):
+            _st = perf_counter()
+            for a in args:
+                f(a)
+            _t = perf_counter() - _st
+            _best = _t if _best is None else min(_best, _t)
+        print("{:<40} {:10.3f} ms/MiB".format(name, _best * 1000))
+
+    assert _checksum_loop(_data) == frame_checksum(_data)
+    print("numpy: {}".format("yes" if _numpy() is not None else "no"))
+    _bench("per-byte loop, 1 MiB", _checksum_loop, [_data], rounds = 2)
+    _bench("frame_checksum, 1 MiB", frame_checksum, [_data])
+    _bench("per-byte loop, 0x400 frames", _checksum_loop, _frames, rounds = 2)
+    _bench("frame_checksum, 0x400 frames", frame_checksum, _frames)
+    _bench("area_checksum, 0x100 pages", area_checksum, [memoryview(_data)[i:i + 0x100] for i in range(0, len(_data), 0x100)])
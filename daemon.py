@@ -0,0 +1,199 @@
+'''
+    Programmer daemon: owns the flashcomm device and the programmer, keeps the target in flash programming mode
+    between jobs and runs main.py subcommands it gets over a local Unix socket, one job at a time in the order
+    they come in.
+
+        python daemon.py serve rh850 uart2 --port /dev/ttyUSB0 &
+        python daemon.py sig
+        python daemon.py program 0 firmware.hex
+        python daemon.py chks 0 0xffff
+        python daemon.py stop
+
+    Before a job that needs the bootloader a probe (a command that changes nothing) checks the session is still
+    there. Only if it isn't, the reset / baud rate / signature sequence runs again.
+'''
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import stat
+import sys
+from time import time
+
+from defs import *
+import main
+
+
+''' $RFPI_SOCKET, else in the per-user runtime directory (mode 0700) where there is one '''
+DEFAULT_SOCKET  =   os.environ.get("RFPI_SOCKET") or os.path.join(os.environ.get("XDG_RUNTIME_DIR") or "/tmp", "rfpi.sock")
+
+
+def job_parser():
+    ''' Parses the subcommand of a job, same as main.py '''
+    parser = argparse.ArgumentParser(prog = "daemon.py", description = "Job for the programmer daemon")
+    main.add_actions(parser)
+    return parser
+
+
+class ProgrammerDaemon():
+    ''' The programmer and the state of its bootloader session '''
+
+    def __init__(self, f_p, max_baud):
+        self.f_p = f_p
+        self.max_baud = max_baud
+        self.in_session = False
+        self.n_resets = 0
+        self._reset_called = False
+
+    def ensure_session(self):
+        ''' The reset of main.run_action: probe, and only start a new session if the old one is gone '''
+        self._reset_called = True
+        if self.in_session:
+            if self.f_p.probe():
+                return 0
+            logging.info("Bootloader session lost, resetting")
+        self.in_session = False
+        _r = main.start_session(self.f_p, self.max_baud)
+        self.n_resets += 1
+        self.in_session = _r != -1
+        return _r
+
+    def run_job(self, argv, cwd):
+        ''' Runs one job, returns (exit status, what it printed and logged) '''
+        out = io.StringIO()
+        handler = logging.StreamHandler(out)
+        handler.setFormatter(logging.Formatter("%(filename)s:%(funcName)s: %(message)s"))
+        logging.getLogger().addHandler(handler)
+        self._reset_called = False
+        status = 0
+        try:
+            with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+                args = job_parser().parse_args(argv)
+                os.chdir(cwd)
+                main.run_action(self.f_p, args, self.ensure_session)
+        except SystemExit as e:
+            # argparse
+            status = e.code if isinstance(e.code, int) else 2
+        except Exception as e:
+            logging.error("{}: {}".format(type(e).__name__, e))
+            logging.debug("", exc_info = True)
+            # Half way through a command the bootloader is in an unknown state
+            self.in_session = False
+            status = 1
+        finally:
+            logging.getLogger().removeHandler(handler)
+        if not self._reset_called:
+            # calibrate, test, mcu_on/off: the target isn't in the session we started (anymore)
+            self.in_session = False
+        return status, out.getvalue()
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    ''' One JSON request line, one JSON response line '''
+
+    def handle(self):
+        try:
+            req = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+        if req.get("stop"):
+            self.server.stopping = True
+            resp = {"status": 0, "output": "Stopping\n"}
+        else:
+            _st = time()
+            n_resets = self.server.daemon.n_resets
+            status, output = self.server.daemon.run_job(req["argv"], req.get("cwd", "/"))
+            resp = {"status": status, "output": output, "t": time() - _st, "reset": self.server.daemon.n_resets != n_resets}
+            logging.info("{} -> {} in {:.2f}s".format(" ".join(req["argv"]), status, resp["t"]))
+        self.wfile.write(json.dumps(resp).encode() + b"\n")
+
+
+class DaemonServer(socketserver.UnixStreamServer):
+    ''' Handles one connection at a time, the others wait in the listen queue '''
+
+    request_queue_size = 64
+    # So the loop sees stopping
+    timeout = 0.5
+
+    def __init__(self, path, daemon):
+        self.daemon = daemon
+        self.stopping = False
+        if os.path.lexists(path):
+            st = os.lstat(path)
+            if st.st_uid != os.getuid() or not stat.S_ISSOCK(st.st_mode):
+                raise PermissionError("{} exists and is not a socket of this user, not replacing it".format(path))
+            os.remove(path)
+        # The socket can flash the target, so only for this user, from the moment it is bound
+        _umask = os.umask(0o177)
+        try:
+            super().__init__(path, JobHandler)
+        finally:
+            os.umask(_umask)
+
+    def run(self):
+        while not self.stopping:
+            self.handle_request()
+
+
+def serve(args):
+    logging.basicConfig(level = main.log[args.log_level], format = "%(filename)s:%(funcName)s: %(message)s")
+    f_p = main.create_programmer(MCU_Type(args.mcu), Comm_Mode(args.mode), args.port, args.baud, args.gpio_flmd, args.gpio_reset, args.gpio, args.reader)
+    server = DaemonServer(args.socket, ProgrammerDaemon(f_p, args.max_baud))
+
+    def _stop(signum, frame):
+        server.stopping = True
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    logging.info("Listening on {}".format(args.socket))
+    try:
+        server.run()
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+
+def send_job(path, req):
+    ''' Sends a request to the daemon and returns its response '''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        s.sendall(json.dumps(req).encode() + b"\n")
+        f = s.makefile("rb")
+        return json.loads(f.readline())
+
+
+if __name__ == "__main__":
+    _socket = DEFAULT_SOCKET
+    argv = sys.argv[1:]
+    if len(argv) >= 2 and argv[0] == "--socket":
+        _socket = argv[1]
+        argv = argv[2:]
+
+    if argv[:1] == ["serve"]:
+        parser = main.build_parser()
+        parser.prog = "daemon.py [--socket SOCKET] serve"
+        args = parser.parse_args(argv[1:])
+        args.socket = _socket
+        serve(args)
+        exit(0)
+
+    if argv[:1] == ["stop"]:
+        req = {"stop": True}
+    else:
+        # Checked here so usage errors show up without a round trip
+        job_parser().parse_args(argv)
+        req = {"argv": argv, "cwd": os.getcwd()}
+    try:
+        resp = send_job(_socket, req)
+    except (FileNotFoundError, ConnectionRefusedError):
+        print("No daemon listening on {} (start one with: daemon.py serve <mcu> <mode> ...)".format(_socket))
+        exit(2)
+    sys.stdout.write(resp["output"])
+    if "t" in resp:
+        print("[{:.2f}s{}]".format(resp["t"], ", new bootloader session" if resp["reset"] else ""))
+    exit(resp["status"])
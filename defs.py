@@ -21,6 +21,17 @@ class Comm_Mode(Enum):
     TOOLD   =   "toold"     # TOOLD (same as 1 wire UART but with a different entry sequence on TOOLC)
     TOOL0   =   "tool0"
 
+class IO_Op(Enum):
+    """I/O a protocol step asks for, the first item of the requests it yields (see flashcomm.run_steps)"""
+    SEND    =   "send"      # (SEND, data): raw bytes
+    RECV    =   "recv"      # (RECV, n_bytes): raw bytes, up to n_bytes within the port timeout
+    SLEEP   =   "sleep"     # (SLEEP, seconds)
+    FLUSH   =   "flush"     # (FLUSH,): drop what was received so far
+    COMMAND =   "command"   # (COMMAND, cmd, data): command frame
+    DATA    =   "data"      # (DATA, data, prefix): data frame
+    FRAME   =   "frame"     # (FRAME, timeout): payload of the next data frame (timeout None: the programmer's)
+    OUT     =   "out"       # (OUT, value): handed to the caller of a stream, e.g. read_stream
+
 
 class InvalidFrameError(ValueError):
     '''Invalid byte at the beginning of the frame'''
@@ -46,4 +57,14 @@ class NoAckError(ValueError):
     '''Message was received successfully but status was not ACK'''
     pass
 
+class InvalidImageError(ValueError):
+    '''Firmware image could not be parsed'''
+    pass
 
+class BusCollisionError(ValueError):
+    '''Single wire UART: the echo differs from what was sent'''
+    pass
+
+class VerifyError(ValueError):
+    '''The flash contents differ from the firmware image'''
+    pass
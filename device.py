@@ -0,0 +1,101 @@
+'''
+    Device profiles: what the silicon signature says about the device (see rfpi.md), kept in the store together with
+    the baud rate that worked for it, so the next session doesn't have to find out again
+'''
+import logging
+
+import store
+
+
+class DeviceProfile():
+    '''
+        Decoded signature. Multi-byte addresses are little endian:
+            device data (3) | name (10) | code flash end (3/4) | [data flash end (3/4)] | firmware version (3)
+        The data flash end is only documented for the V850E2 (rfpi.md), other families decode just the code flash end
+    '''
+
+    N_DEVICE    =   3
+    N_NAME      =   10
+    N_VERSION   =   3
+
+    def __init__(self, signature = b""):
+        self.signature = bytes(signature)
+        self.device = b""
+        self.name = ""
+        self.code_flash_end = None
+        self.data_flash_end = None
+        self.version = ""
+        # Baud rate that worked last time, 0 if not known
+        self.baud = 0
+
+    @classmethod
+    def decode(cls, signature, data_flash_end = False):
+        '''
+            Profile from the signature, data_flash_end if the family's signature has the data flash end. A signature
+            of another format is kept, but nothing is decoded from it
+        '''
+        p = cls(signature)
+        sig = p.signature
+        n_addr = len(sig) - cls.N_DEVICE - cls.N_NAME - cls.N_VERSION
+        if n_addr in (3, 4):
+            n_flash, n_b = 1, n_addr
+        elif n_addr in (6, 8) and data_flash_end:
+            n_flash, n_b = 2, n_addr // 2
+        else:
+            logging.warning("Unknown signature format ({} bytes): {}".format(len(sig), sig.hex()))
+            return p
+        p.device = sig[:cls.N_DEVICE]
+        pos = cls.N_DEVICE + cls.N_NAME
+        p.name = bytes(c & 0x7f for c in sig[cls.N_DEVICE:pos]).decode("ascii", "replace").strip()
+        p.code_flash_end = int.from_bytes(sig[pos:pos + n_b], "little")
+        pos += n_b
+        if n_flash == 2:
+            p.data_flash_end = int.from_bytes(sig[pos:pos + n_b], "little")
+            pos += n_b
+        _v = sig[pos:pos + cls.N_VERSION]
+        p.version = "{}.{}{}".format(*_v)
+        return p
+
+    def regions(self, regions):
+        '''
+            The (start, size, erase block size) regions of the MCU type cut at the flash ends of this device. Regions
+            above the code flash end are data flash, kept as they are if the signature has no data flash end. A region
+            is never made larger than in the MCU type's layout
+        '''
+        if self.code_flash_end is None:
+            return list(regions)
+        ret = []
+        for start, size, blk in sorted(regions):
+            end = self.code_flash_end if start <= self.code_flash_end else self.data_flash_end
+            if end is None:
+                ret.append((start, size, blk))
+            elif start <= end:
+                ret.append((start, min(size, end - start + 1), blk))
+        return ret
+
+    def to_dict(self):
+        return {"signature": self.signature.hex(), "baud": self.baud}
+
+    @classmethod
+    def from_dict(cls, d, data_flash_end = False):
+        p = cls.decode(bytes.fromhex(d.get("signature", "")), data_flash_end)
+        p.baud = d.get("baud", 0)
+        return p
+
+    def __str__(self):
+        if self.code_flash_end is None:
+            return "Unknown device, signature {}".format(self.signature.hex())
+        s = "{} (device {}), firmware {}, code flash end {:x}".format(self.name, self.device.hex(), self.version, self.code_flash_end)
+        if self.data_flash_end is not None:
+            s += ", data flash end {:x}".format(self.data_flash_end)
+        return s
+
+
+def load_profile(mcu_type, comm_mode, data_flash_end = False):
+    ''' The profile of the device last seen with this MCU type and comm mode, None if there is none '''
+    d = store.load(store.store_key(mcu_type, comm_mode), "profile")
+    return DeviceProfile.from_dict(d, data_flash_end) if d else None
+
+
+def save_profile(mcu_type, comm_mode, profile):
+    store.save(store.store_key(mcu_type, comm_mode), "profile", profile.to_dict())
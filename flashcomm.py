@@ -1,12 +1,303 @@
 # Renesas flash programming interface implementation
-from gpiozero import DigitalOutputDevice, SPIDevice
-from time import sleep, time
+from time import time
 import serial
 import logging
 import os.path
+import select
+import threading
 
 
 from defs import *
+from checksum import frame_checksum
+from gpio import gpio_backend, precise_sleep, pulse_train
+import store
+
+def as_buffer(data):
+    ''' data as a bytes-like object, not copied if it is one already (frames), lists of ints (sync bytes) are converted '''
+    return data if isinstance(data, (bytes, bytearray, memoryview)) else bytes(data)
+
+def run_steps(steps, io):
+    '''
+        Drives protocol steps: a generator yielding I/O requests (IO_Op, ...) and returning its result. io(request)
+        executes one and its result is sent back in, an exception raised by it is thrown in. The steps are the same
+        for the blocking and the asyncio transport, only io differs
+    '''
+    _r = _e = None
+    while True:
+        try:
+            req = steps.throw(_e) if _e is not None else steps.send(_r)
+        except StopIteration as e:
+            return e.value
+        try:
+            _r, _e = io(req), None
+        except Exception as e:
+            _r, _e = None, e
+
+def stream_steps(steps, io):
+    ''' run_steps for steps that hand out values (IO_Op.OUT): a generator of those values '''
+    _r = _e = None
+    while True:
+        try:
+            req = steps.throw(_e) if _e is not None else steps.send(_r)
+        except StopIteration:
+            return
+        if req[0] == IO_Op.OUT:
+            _r, _e = None, None
+            yield req[1]
+            continue
+        try:
+            _r, _e = io(req), None
+        except Exception as e:
+            _r, _e = None, e
+
+
+class FrameParser():
+    '''
+        Resumable state machine for received data frames:
+            hunt STX -> length -> payload -> checksum/footer
+        Bytes can be fed in any chunk size, want() tells how many bytes are needed to get to the next state
+        so the transport can do bulk reads. Frames are assembled in a preallocated buffer.
+        It only resyncs while looking for the header: once the length is read, a bad checksum or footer
+        ends the frame in ERROR, with the reason in error
+    '''
+
+    HUNT_STX    =   0
+    LENGTH      =   1
+    PAYLOAD     =   2
+    COMPLETE    =   3
+    ERROR       =   4
+
+    def __init__(self, stx, n_len_bytes, checksum_func, footers = (0x17, 0x03)):
+        self.stx = stx
+        self.n_len_bytes = n_len_bytes
+        self.checksum = checksum_func
+        self.footers = footers
+        # STX + length + largest payload + checksum + footer
+        max_len = 0xffff if n_len_bytes > 1 else 0x100
+        self.buf = bytearray(1 + n_len_bytes + max_len + 2)
+        self.reset()
+
+    def reset(self):
+        ''' Starts hunting for a new frame '''
+        self.state = self.HUNT_STX
+        self.pos = 0
+        self.total = 0
+        # Bytes skipped while hunting for STX, and how many of those weren't idle (0x00)
+        self.n_skipped = 0
+        self.n_garbage = 0
+        # Why the frame ended in ERROR
+        self.error = None
+
+    def want(self):
+        ''' Amount of bytes needed to finish the current state '''
+        if self.state == self.HUNT_STX:
+            return 1
+        if self.state == self.LENGTH:
+            return 1 + self.n_len_bytes - self.pos
+        if self.state == self.PAYLOAD:
+            return self.total - self.pos
+        return 0
+
+    def feed(self, data):
+        ''' Feeds received bytes to the parser, returns the amount of bytes consumed. Stops at the end of a frame '''
+        if not isinstance(data, (bytes, bytearray)):
+            data = bytes(data)
+        i = 0
+        n = len(data)
+        while i < n and self.state < self.COMPLETE:
+            if self.state == self.HUNT_STX:
+                j = data.find(self.stx, i)
+                end = n if j < 0 else j
+                self.n_skipped += end - i
+                self.n_garbage += (end - i) - data.count(0, i, end)
+                if j < 0:
+                    return n
+                self.buf[0] = self.stx
+                self.pos = 1
+                self.state = self.LENGTH
+                i = j + 1
+                continue
+
+            _take = min(self.want(), n - i)
+            self.buf[self.pos:self.pos + _take] = data[i:i + _take]
+            self.pos += _take
+            i += _take
+            if self.state == self.LENGTH and self.pos == 1 + self.n_len_bytes:
+                d_len = int.from_bytes(self.buf[1:self.pos], "big")
+                if self.n_len_bytes == 1 and d_len == 0:
+                    d_len = 0x100
+                if d_len == 0:
+                    # No frame is empty, so that STX was garbage: look for the next one from the byte after it
+                    self._resync()
+                    continue
+                self.total = self.pos + d_len + 2
+                self.state = self.PAYLOAD
+            elif self.state == self.PAYLOAD and self.pos == self.total:
+                self._check()
+        return i
+
+    def _resync(self):
+        ''' Drops the STX of the header read so far and hunts again on the length bytes after it '''
+        _rest = bytes(self.buf[1:self.pos])
+        self.state = self.HUNT_STX
+        self.n_skipped += 1
+        self.n_garbage += 1
+        self.pos = 0
+        # Shorter than a header, so all of it is taken and the frame can't end in here
+        self.feed(_rest)
+
+    def _check(self):
+        ''' Validates footer and checksum '''
+        if self.buf[self.pos - 1] not in self.footers:
+            self.error = InvalidFooterError("Format error in footer: " + self.hex())
+            self.state = self.ERROR
+        elif self.buf[self.pos - 2] != self.checksum(memoryview(self.buf)[1:self.pos - 2]):
+            self.error = InvalidChecksumError("Incorrect checksum: " + self.hex())
+            self.state = self.ERROR
+        else:
+            self.state = self.COMPLETE
+
+    def payload(self):
+        ''' Returns the data of the completed frame '''
+        return bytes(self.buf[1 + self.n_len_bytes:self.pos - 2])
+
+    def hex(self):
+        return " ".join('{:02x}'.format(b) for b in self.buf[:self.pos])
+
+
+class PortReader():
+    '''
+        Drains a serial port from a thread into a ring buffer, so bytes are taken off the port while the caller
+        is busy (logging, checksums, building the next frame) instead of when it gets around to reading.
+        read() has the semantics of Serial.read with a timeout, but returns what is already buffered right away.
+        clear() replaces reset_input_buffer: bytes the thread had in flight when it was called are dropped too
+    '''
+
+    RING_SIZE       =   0x20000     # Bigger than the largest frame (2 length bytes)
+
+    def __init__(self, port, size = RING_SIZE):
+        self.port = port
+        self.buf = bytearray(size)
+        # Bytes written and read in total, the ring holds head - tail of them
+        self.head = 0
+        self.tail = 0
+        self.cond = threading.Condition()
+        self.generation = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target = self._run, name = "rx " + str(self.port.port), daemon = True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        size = len(self.buf)
+        while self.running:
+            try:
+                # Wait for data without taking it off the port (the timeout lets stop() be noticed). A clear() from
+                # here on drops what is read next, and the read doesn't block, so it can only hold bytes from before
+                readable = select.select([self.port.fileno()], [], [], self.port.timeout or 0.1)[0]
+                gen = self.generation
+                data = self.port.read(min(self.port.in_waiting, size // 2)) if readable else b''
+            except (OSError, ValueError, serial.SerialException) as e:
+                logging.debug("Reader stopped: {}".format(e))
+                break
+            if not data:
+                continue
+            with self.cond:
+                while self.running and size - (self.head - self.tail) < len(data):
+                    self.cond.wait(0.1)
+                if gen != self.generation:
+                    continue
+                o = self.head % size
+                n = min(len(data), size - o)
+                self.buf[o:o + n] = data[:n]
+                self.buf[:len(data) - n] = data[n:]
+                self.head += len(data)
+                self.cond.notify_all()
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+
+    def available(self):
+        return self.head - self.tail
+
+    def read(self, n_bytes, timeout):
+        ''' Waits until n_bytes are buffered or timeout (s) has passed, returns up to n_bytes '''
+        deadline = time() + timeout
+        with self.cond:
+            while self.head - self.tail < n_bytes and self.running:
+                _t = deadline - time()
+                if _t <= 0:
+                    break
+                self.cond.wait(_t)
+            n = min(n_bytes, self.head - self.tail)
+            size = len(self.buf)
+            o = self.tail % size
+            _e = min(o + n, size)
+            data = bytes(self.buf[o:_e]) + bytes(self.buf[:n - (_e - o)])
+            self.tail += n
+            self.cond.notify_all()
+        return data
+
+    def clear(self):
+        ''' Drops everything received so far, the port's input buffer included '''
+        with self.cond:
+            self.port.reset_input_buffer()
+            self.generation += 1
+            self.tail = self.head
+            self.cond.notify_all()
+
+
+class SingleWire():
+    '''
+        Transmit side of the single wire UART modes (UART1, TOOL0, TOOLD), where RX and TX share the line and
+        every byte sent comes back. A frame is written in one go and its echo consumed with one sized read
+        (through the reader thread if there is one), then compared with what was sent: a byte that differs means
+        the target drove the line at the same time. The response is read by the caller as on UART2
+    '''
+
+    def __init__(self, flashcomm):
+        # The port is looked up on every send, the entry sequences open it after the reset
+        self.flashcomm = flashcomm
+        self.n_collisions = 0
+
+    def read(self, n_bytes, timeout):
+        ''' Up to n_bytes, waiting for them for up to timeout (s) '''
+        fc = self.flashcomm
+        if fc.reader is not None:
+            return fc.reader.read(n_bytes, timeout)
+        deadline = time() + timeout
+        data = fc.serial_port.read(n_bytes)
+        while len(data) < n_bytes and time() < deadline:
+            data += fc.serial_port.read(n_bytes - len(data))
+        return data
+
+    def send(self, data):
+        ''' Writes data and checks its echo. Raises NoResponseError if there is none, BusCollisionError if it differs '''
+        fc = self.flashcomm
+        data = as_buffer(data)
+        fc.write(data)
+        echo = self.read(len(data), fc.serial_port.timeout + len(data) * 10 / fc.baud_rate)
+        if echo == data:
+            return
+        if not echo:
+            raise NoResponseError("No echo of the {} bytes sent, is the line connected?".format(len(data)))
+        self.n_collisions += 1
+        _at = next((i for i, (a, b) in enumerate(zip(echo, data)) if a != b), len(echo))
+        raise BusCollisionError("Echo differs from the data sent at byte {} of {} (sent {}, echoed {})".format(
+            _at, len(data), bytes(data[_at:_at + 8]).hex(" "), bytes(echo[_at:_at + 8]).hex(" ")))
+
 
 class RenesasFlashComm():
     """Handles the serial communication with the Renesas Flash interface"""
@@ -21,6 +312,23 @@ class RenesasFlashComm():
     RESET_CMD_TIME              =   0.02
     POST_FLMD                   =   0.01
 
+    ''' UART1: how long the target gets to send its 0x00 after the reset '''
+    UART1_SYNC_TIME             =   0.1
+
+    ''' Width of the low and high phase of a FLMD0 pulse '''
+    FLMD_PULSE_TIME             =   0.00005
+
+    ''' SPI: gap (us) the target needs between the bytes of a data frame '''
+    SPI_BYTE_DELAY              =   20
+
+    ''' The timings above, in the order calc_timings searches them '''
+    TIMING_PARAMS = ("RESET_OFF_TIME", "RESET_TIME", "RESET_CMD_TIME", "POST_FLMD")
+
+    ''' Timings that differ from the defaults for a MCU type (RH850: wait before the sync bytes) '''
+    type_timings = {
+        MCU_Type.RH850: {"RESET_CMD_TIME": 0.2}
+        }
+
 
 
     '''Amount of pulses required on FLMD0 for the serial protocol '''
@@ -33,40 +341,54 @@ class RenesasFlashComm():
         MCU_Type.V850ES: {Comm_Mode.UART2: 0, Comm_Mode.SPI: 9},
         MCU_Type.R78K0: {Comm_Mode.UART2: 0, Comm_Mode.SPI: 8},
         MCU_Type.R78K0_Kx2: {Comm_Mode.TOOLD: 0},
-        MCU_Type.R78K0R: {Comm_Mode.UART2: 0},
+        MCU_Type.R78K0R: {Comm_Mode.UART2: 0, Comm_Mode.UART1: 0},
         MCU_Type.R32C: {Comm_Mode.UART2: 0}
         } # TODO move these to base classes
 
 
 
-    def __init__(self, mcu_type, comm_mode, port = "/dev/serial0", baud_rate = 9600, gpio_flmd = 2, gpio_reset = 3):
+    def __init__(self, mcu_type, comm_mode, port = "/dev/serial0", baud_rate = 9600, gpio_flmd = 2, gpio_reset = 3, spi_port = 0, spi_device = 0, gpio = None, reader = False):
         print("Starting the flash programming interface")
         print("----------------------------------------")
         print("FLMD0: GPIO{}\t MISO: 21\t MOSI: 19".format(gpio_flmd))
         print("RESET: GPIO{}\t CLK: 23".format(gpio_reset))
         print("----------------------------------------")
+        # GPIO backend (gpiozero, cdev, mock or a backend instance, see gpio.py)
+        self.gpio = gpio_backend(gpio)
         # FLMD0 is GPIO2, RESET is GPIO22
         if comm_mode == Comm_Mode.TOOLD:
-            self.flmd0 = DigitalOutputDevice(gpio_flmd, initial_value=0)
+            self.flmd0 = self.gpio.output(gpio_flmd, initial_value=0)
         else:
-            self.flmd0 = DigitalOutputDevice(gpio_flmd, initial_value=1)
+            self.flmd0 = self.gpio.output(gpio_flmd, initial_value=1)
 
-        self.reset = DigitalOutputDevice(gpio_reset, initial_value=0)
+        self.reset = self.gpio.output(gpio_reset, initial_value=0)
         self.comm_mode = comm_mode
         self.type = mcu_type
         self.port = port
+        self.baud_rate = baud_rate
+        # Receive through a PortReader thread (UART modes)
+        self.use_reader = reader
+        self.reader = None
+        self.serial_port = None
 
         if comm_mode == Comm_Mode.SPI:
             # SPIdev to communicate over the flash programming interface
-            self.spicomm = SPIDevice(port=0, device=0)
+            from gpiozero import SPIDevice
+            self.spicomm = SPIDevice(port=spi_port, device=spi_device)
+            # The spidev.SpiDev underneath (gpiozero 1.x: _interface, 2.x: _bus), frames go out in one ioctl through it
+            self.spi = getattr(self.spicomm._spi, "_interface", None) or self.spicomm._spi._bus
             # Configure SPI device
-            self.spicomm._spi._interface.max_speed_hz = baud_rate
+            self.spi.max_speed_hz = baud_rate
             self.spicomm._spi._set_clock_mode(3)
             self.serial_port = None
+            # Dummy bytes clocked out to read n bytes, by n
+            self.spi_dummy = {}
         elif comm_mode == Comm_Mode.UART2 or comm_mode == Comm_Mode.UART1:
-            self.serial_port = serial.Serial(port, baud_rate, serial.EIGHTBITS, serial.PARITY_NONE, serial.STOPBITS_ONE, timeout=0.1) # TODO poss change timeout depending on baud rate
+            self.open_serial(port, baud_rate)
         elif comm_mode == Comm_Mode.TOOLD:
             pass
+        # RX and TX on one line, the port is opened here (UART1) or by the entry sequence (TOOL0, TOOLD)
+        self.single_wire = SingleWire(self) if comm_mode in (Comm_Mode.UART1, Comm_Mode.TOOL0, Comm_Mode.TOOLD) else None
         """Frame bytes"""
         self.FRAME_SOH = 0x01 
         self.FRAME_ETB = 0x17 
@@ -80,13 +402,53 @@ class RenesasFlashComm():
             self.FRAME_STX = 0x81
 
 
-        ''' Reset functions for the specific mcu type. All other MCUs use the generic reset '''
-        self.reset_funcs = {MCU_Type.RH850: self.rh850_reset, MCU_Type.R78K0R: self.fp_uart1, MCU_Type.R78K0_Kx2: self.toold_entry, MCU_Type.RL78: self.tool0_entry}
+        ''' Reset functions for the specific mcu type, they only run blocking. All other MCUs use reset_steps '''
+        self.reset_funcs = {MCU_Type.R78K0R: self.fp_uart1, MCU_Type.R78K0_Kx2: self.toold_entry, MCU_Type.RL78: self.tool0_entry}
         ''' The amount of pulses for flmd0 '''
         if self.type in self.flmd_pulses:
             self.pulses = self.flmd_pulses[self.type][self.comm_mode]
 
+        ''' Number of length bytes in a frame '''
+        if self.type == MCU_Type.V850E2 or self.type == MCU_Type.RH850:
+            self.n_len_bytes = 2
+        else:
+            self.n_len_bytes = 1
+        self.parser = FrameParser(self.FRAME_STX, self.n_len_bytes, frame_checksum, (self.FRAME_ETB, self.FRAME_ETX))
+        # Transmit buffer, frames are built in here (header + length + max data + checksum + footer)
+        self.tx_buf = bytearray(1 + self.n_len_bytes + (0xffff if self.n_len_bytes > 1 else 0x100) + 2)
+        self.tx_view = memoryview(self.tx_buf)
+
+        for name, value in self.type_timings.get(self.type, {}).items():
+            setattr(self, name, value)
+        self.load_timings()
+
         
+    def open_serial(self, port, baud_rate):
+        ''' Opens the UART (again, the single wire entries switch to it), with a reader thread if enabled '''
+        if self.reader is not None:
+            self.reader.stop()
+            self.reader = None
+        self.serial_port = serial.Serial(port, baud_rate, serial.EIGHTBITS, serial.PARITY_NONE, serial.STOPBITS_ONE, timeout=0.1) # TODO poss change timeout depending on baud rate
+        # The timeouts (echo, cmd_timeout) are worked out from it
+        self.baud_rate = baud_rate
+        if self.use_reader:
+            self.reader = PortReader(self.serial_port).start()
+
+    def close(self):
+        ''' Stops the reader thread and closes the UART '''
+        if self.reader is not None:
+            self.reader.stop()
+            self.reader = None
+        if self.serial_port is not None:
+            self.serial_port.close()
+
+    def flush_input(self):
+        ''' Drops the bytes received so far '''
+        if self.reader is not None:
+            self.reader.clear()
+        elif self.serial_port:
+            self.serial_port.reset_input_buffer()
+
     def set_timings(self, rst_off, rst_time, rst_cmd, post_flmd):
         '''Sets the timing parameters for the flash programming interface'''
         self.RESET_OFF_TIME = rst_off
@@ -94,14 +456,30 @@ class RenesasFlashComm():
         self.RESET_CMD_TIME = rst_cmd
         self.POST_FLMD = post_flmd
 
+    def get_timings(self):
+        return {name: getattr(self, name) for name in self.TIMING_PARAMS}
+
+    def load_timings(self):
+        ''' Uses the timings calibrated earlier for this MCU type and comm mode, if there are any '''
+        timings = store.load(store.store_key(self.type, self.comm_mode), "timings")
+        if not timings:
+            return False
+        for name in self.TIMING_PARAMS:
+            if name in timings:
+                setattr(self, name, float(timings[name]))
+        logging.debug("Calibrated timings: {}".format(self.get_timings()))
+        return True
+
+    def save_timings(self):
+        store.save(store.store_key(self.type, self.comm_mode), "timings", self.get_timings())
+
     
     def mcu_on(self):
         '''Operate in normal mode'''
         self.flmd0.off()
         self.reset.off()
-        sleep(self.RESET_OFF_TIME)
-        if self.serial_port:
-            self.serial_port.reset_input_buffer()
+        precise_sleep(self.RESET_OFF_TIME)
+        self.flush_input()
         self.reset.on()
 
     def mcu_off(self):
@@ -109,18 +487,45 @@ class RenesasFlashComm():
         self.reset.off()
         self.flmd0.off()
 
+    def io(self, req):
+        ''' Executes one I/O request of the protocol steps (not FRAME, that's the programmer's) '''
+        op = req[0]
+        if op == IO_Op.SEND:
+            return self.send(req[1])
+        if op == IO_Op.RECV:
+            return self.recv(req[1])
+        if op == IO_Op.SLEEP:
+            return precise_sleep(req[1])
+        if op == IO_Op.FLUSH:
+            return self.flush_input()
+        if op == IO_Op.COMMAND:
+            return self.send_command_frame(*req[1:])
+        if op == IO_Op.DATA:
+            return self.send_data_frame(*req[1:])
+        raise ValueError("Can't execute {}".format(op))
+
+    def run(self, steps):
+        return run_steps(steps, self.io)
+
     def reset_bl(self):
         ''' Calls the correct reset sequence for the mcu type '''
-        _reset_f = self.reset_funcs.get(self.type, self.fp_generic)
-        self.initial_reset()
-        return _reset_f()
-
-    def initial_reset(self):
+        return self.run(self.reset_steps())
+
+    def reset_steps(self):
+        ''' The reset sequence as protocol steps. The ones in reset_funcs have no steps and block '''
+        yield from self.initial_reset_steps()
+        if self.type in self.reset_funcs:
+            return self.reset_funcs[self.type]()
+        if self.type == MCU_Type.RH850:
+            return (yield from self.rh850_reset_steps())
+        return (yield from self.fp_generic_steps())
+
+    def initial_reset_steps(self):
         ''' The generic initial sequence (flmd on, reset off, ...) '''
         # pull reset low to restart
         self.reset.off()
         if self.comm_mode == Comm_Mode.TOOLD or self.comm_mode == Comm_Mode.TOOL0:
-            self.tool = DigitalOutputDevice(18, initial_value = 0) # take the same pin as the UART RX
+            self.tool = self.gpio.output(18, initial_value = 0) # take the same pin as the UART RX
             self.flmd0.off()    # flmd0 acts as toolc
             self.tool.off()
 
@@ -128,36 +533,33 @@ class RenesasFlashComm():
         else:
             self.flmd0.on()
 
-            if self.serial_port:
-                self.serial_port.reset_input_buffer()
+            yield (IO_Op.FLUSH,)
 
-            sleep(self.RESET_OFF_TIME)
+            yield (IO_Op.SLEEP, self.RESET_OFF_TIME)
 
         # pull reset high
         self.reset.on()
 
 
 
-    def rh850_reset(self):
+    def rh850_reset_steps(self):
         ''' TODO put this in something decent '''
-        sleep(0.0056)
-        for i in range(self.pulses):
-            self.flmd0.off()
-            self.flmd0.on()
+        yield (IO_Op.SLEEP, self.RESET_TIME)
+        pulse_train(self.flmd0, self.pulses, self.FLMD_PULSE_TIME)
 
-        sleep(0.2)
+        yield (IO_Op.SLEEP, self.RESET_CMD_TIME)
         for i in range(30):
-            self.send([0x00])
-            sleep(0.0001)
+            yield (IO_Op.SEND, b'\x00')
+            yield (IO_Op.SLEEP, 0.0001)
 
-        _b_recv = self.recv(1)
+        _b_recv = yield (IO_Op.RECV, 1)
         if _b_recv != b'\x00':
             logging.error(_b_recv)
             raise NoResponseError("Did not receive 0 sync byte")
             
         # for bitrate
-        self.send([0x55])
-        _b_recv = self.recv(1)
+        yield (IO_Op.SEND, b'\x55')
+        _b_recv = yield (IO_Op.RECV, 1)
         if _b_recv != b'\xc1':
             logging.error(_b_recv)
             raise NoResponseError("Set bitrate failed")
@@ -165,11 +567,11 @@ class RenesasFlashComm():
         return 0
 
     def tool0_entry(self):
-        sleep(0.01)
+        precise_sleep(0.01)
         self.tool.on()
         self.tool.close()
         # Clean up pins & start 1 wire uart
-        self.serial_port = serial.Serial(self.port, 115200, serial.EIGHTBITS, serial.PARITY_NONE, serial.STOPBITS_ONE, timeout=0.1)
+        self.open_serial(self.port, 115200)
 
         # For 1 wire serial flash programming
         if 1:
@@ -183,26 +585,16 @@ class RenesasFlashComm():
         self.tool.on()
 
         for _cnt in range(3):
-            sleep(0.01)
-            for _i in range(2):
-                self.flmd0.off()
-                sleep(0.001)
-                self.flmd0.on()
-                sleep(0.001)
-
-            sleep(0.005)
-
-            for _i in range(7):
-                self.tool.off()
-                sleep(0.001)
-                self.tool.on()
-                sleep(0.001)
+            precise_sleep(0.01)
+            pulse_train(self.flmd0, 2, 0.001)
+            precise_sleep(0.005)
+            pulse_train(self.tool, 7, 0.001)
 
 
         self.tool.close()
         # Clean up pins & start 1 wire uart
-        self.serial_port = serial.Serial("/dev/ttyAMA0", 125000, serial.EIGHTBITS, serial.PARITY_NONE, serial.STOPBITS_ONE, timeout=0.1)
-        self.serial_port.reset_input_buffer()
+        self.open_serial("/dev/ttyAMA0", 125000)
+        self.flush_input()
         self.reset.on()
 
         _sync_b = self.recv(1)
@@ -213,93 +605,104 @@ class RenesasFlashComm():
 
     def fp_uart1(self):
         ''' Handles the reset over 1-wire UART (on TOOL0 pin) on 78k0r'''
-        sleep(self.RESET_TIME)
+        precise_sleep(self.RESET_TIME)
 
         # wait for the 0 byte to sync
-        f_byte = b""
         st_t = time()
-        while f_byte != b"\x00":
-            f_byte = self.recv(1)
-            if time() < st_t + 0.01:
+        while self.recv(1) != b"\x00":
+            if time() >= st_t + self.UART1_SYNC_TIME:
                 return -1
         self.send([0])
-        # Send two zero bytes for the reset command
-        sleep(0.01)
-        self.send([0])
-        self.send([0])
-
-        # read back the three bytes we just sent
-        self.serial_port.read(3)
+        # Send two zero bytes for the reset command (send takes their echo off the line)
+        precise_sleep(0.01)
+        self.send([0, 0])
+        return 0
 
-    def fp_generic(self):
+    def fp_generic_steps(self):
         ''' Handles the generic FP sequence for UART2 and SPI on 78k0, v850 '''
         # recommended value is 0.0056
-        sleep(self.RESET_TIME)
+        yield (IO_Op.SLEEP, self.RESET_TIME)
 
         # pulse FLMD0 an amount of times to set SPI mode
         logging.debug("pulsing FLMD {} times".format(self.pulses))
 
-        for i in range(self.pulses):
-            self.flmd0.off()
-            self.flmd0.on()
+        pulse_train(self.flmd0, self.pulses, self.FLMD_PULSE_TIME)
 
         self.flmd0.on()
 
         # wait for RESET command processing ! IMPORTANT do not remove - and if does not work, then fiddle with timing !
-        sleep(self.RESET_CMD_TIME)
+        yield (IO_Op.SLEEP, self.RESET_CMD_TIME)
 
         # For UART mode, to synch clocks
         if self.comm_mode == Comm_Mode.UART2:
-            self.send([0x00])
-            sleep(0.01)
-            self.send([0x00])
+            yield (IO_Op.SEND, b'\x00')
+            yield (IO_Op.SLEEP, 0.01)
+            yield (IO_Op.SEND, b'\x00')
 
 
-        if self.serial_port:
-            self.serial_port.reset_input_buffer()
+        yield (IO_Op.FLUSH,)
 
-        sleep(self.POST_FLMD)
+        yield (IO_Op.SLEEP, self.POST_FLMD)
 
 
     def checksum(self, data):
         ''' Calculates checksum for the frame '''
-        s = 0
-        for b in data:
-            s = (s - b) & 0xff
-        return s & 0xff
+        return frame_checksum(data)
 
     def send(self, data, callback_func = None, d_frame = 0):
         """Sends the buffer with data over the serial interface. """
         # Split data into two parts: up untill the trigger byte and then the rest
         if self.comm_mode == Comm_Mode.SPI:
             if callback_func:
-                self.spicomm._spi.transfer(data[:-1])
+                self.spi.xfer2(list(data[:-1]))
                 callback_func()
-                self.spicomm._spi.transfer([data[-1]])
+                self.spi.xfer2([data[-1]])
+            elif d_frame:
+                # One transfer per byte with SPI_BYTE_DELAY after each, all in a single ioctl
+                self.spi.xfer(list(data), self.spi.max_speed_hz, self.SPI_BYTE_DELAY)
             else:
-                if d_frame:
-                    for b in data:
-                        self.spicomm._spi.transfer([b])
-                else:
-                    self.spicomm._spi.transfer(data)
-
-        elif self.comm_mode == Comm_Mode.UART2:
-            self.serial_port.write(bytearray(data)) 
-        else:
-            self.serial_port.write(bytearray(data)) 
-            b_recv = 0
-            # read back the bytes we sent since it's a single wire
-            while b_recv < len(data):
-                b = self.serial_port.read(1)
-                if b:
-                    b_recv += 1
-
+                self.spi.xfer2(list(data))
 
+        elif self.single_wire is not None:
+            self.single_wire.send(data)
+        else:
+            self.write(data)
+
+    def write(self, data):
+        '''
+            Serial.write without its bytes() copy of data: the frame goes from the transmit buffer to the port as
+            it is (POSIX ports, others go through Serial.write)
+        '''
+        fd = getattr(self.serial_port, "fd", None)
+        if fd is None:
+            return self.serial_port.write(data)
+        mv = memoryview(as_buffer(data))
+        while mv:
+            try:
+                mv = mv[os.write(fd, mv):]
+            except BlockingIOError:
+                select.select([], [fd], [])
+
+
+
+    def set_baud(self, baud_rate):
+        """Switches the UART to baud_rate, after the target was told to. Raises ValueError if the port can't do it"""
+        if self.serial_port is None:
+            return
+        self.serial_port.flush()
+        self.serial_port.baudrate = baud_rate
+        self.flush_input()
+        self.baud_rate = baud_rate
 
     def recv(self, n_bytes):
         """Receives data over the serial interface"""
         if self.comm_mode == Comm_Mode.SPI:
-            return self.spicomm._spi.transfer([0x00 for i in range(n_bytes)])
+            _d = self.spi_dummy.get(n_bytes)
+            if _d is None:
+                _d = self.spi_dummy[n_bytes] = (0x00,) * n_bytes
+            return bytes(self.spi.xfer2(_d))
+        elif self.reader is not None:
+            return self.reader.read(n_bytes, self.serial_port.timeout)
         else:
             return self.serial_port.read(n_bytes)
 
@@ -309,84 +712,73 @@ class RenesasFlashComm():
 
 
     def recv_data_frame(self):
-        # get header first - 2 bytes for V850ES
-        data = self.recv(1)
-        if not data or data[0] == 0x00:
-            raise NoResponseError("No frame received")
-
-        n_recvd = 0
-        while (data[0] != self.FRAME_STX and n_recvd < 0x100):
-            data = self.recv(1)
-            logging.debug(data)
-            n_recvd += 1
-            #if n_recvd >= 0x100 or data != 0xff:
-            if n_recvd >= 0x100 or data == b'':
-                raise InvalidHeaderError("Received frame is not a data frame: " + " ".join(['{:02x}'.format(b) for b in data]))
-
-        if self.type == MCU_Type.V850E2 or self.type == MCU_Type.RH850:
-            data += self.recv(2)
-            if len(data) < 3:
-                raise InvalidHeaderError("Frame length wrong: " + " ".join(['{:02x}'.format(b) for b in data]))
-            d_len = (data[1] << 0x8) + data[2]
-        else:
-            data += self.recv(1)
-            if len(data) > 1:
-                d_len = data[1]
-                if d_len == 0:
-                    d_len = 256
-            else:
-                raise InvalidHeaderError("Something data_len" + " ".join(['{:02x}'.format(b) for b in data]))
-
-
-        # To prevent timeouts - receive per byte
-        len_total = len(data) + d_len + 2
-
+        ''' Receives a data frame and returns its payload. Reads are sized from the decoded length field '''
+        p = self.parser
+        p.reset()
+        first = True
         st_t = time()
-        while len(data) < len_total and time() < st_t + 1:
-            _b = self.recv(0x1)
-            data += _b
-        
-        #data = data + self.recv(d_len + 2)
-        if data[-1] != self.FRAME_ETB and data[-1] != self.FRAME_ETX:
-            raise InvalidFooterError("Format error in footer: "+ " ".join(['{:02x}'.format(b) for b in data]))
-        chk = self.checksum(data[1:-2])
-        if data[-2] != chk:
-            raise InvalidChecksumError("Incorrect checksum: "+ " ".join(['{:02x}'.format(b) for b in data]))
-        logging.debug(' '.join('{:02x}'.format(x) for x in data))
-        # TODO change this to n_len_bytes or so
-        if self.type == MCU_Type.V850E2 or self.type == MCU_Type.RH850:
-            return data[3:-2]
-        else:
-            return data[2:-2]
-
-    def make_frame(self, header, data, wrong_chk_sum = 0):
-        if self.type == MCU_Type.V850E2 or self.type == MCU_Type.RH850:
-            l = len(data)
-            d = [header, (l >> 8) & 0xff, l & 0xff]
+        while p.state != p.COMPLETE:
+            _b = self.recv(p.want())
+            if _b:
+                p.feed(_b)
+                st_t = time()
+            if p.state == p.ERROR:
+                raise p.error
+            if p.state == p.HUNT_STX:
+                # An idle line (nothing or a 0 byte before anything else) means there's no response yet
+                if not _b or (first and p.n_garbage == 0):
+                    if p.n_garbage:
+                        raise InvalidHeaderError("Received frame is not a data frame: " + p.hex())
+                    raise NoResponseError("No frame received")
+                if p.n_skipped >= 0x100:
+                    raise InvalidHeaderError("Received frame is not a data frame: " + p.hex())
+            elif time() >= st_t + 1:
+                raise InvalidFooterError("Frame incomplete: " + p.hex())
+            first = False
+
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(p.hex())
+        return p.payload()
+
+    def make_frame(self, header, data, wrong_chk_sum = 0, prefix = b''):
+        '''
+            Builds the frame in the reusable transmit buffer and returns a memoryview on it.
+            The prefix (command byte) and data are copied straight into the buffer, data can be any bytes-like slice
+        '''
+        n_hdr = 1 + self.n_len_bytes
+        n_pre = len(prefix)
+        l = n_pre + len(data)
+        if l > len(self.tx_buf) - n_hdr - 2:
+            raise ValueError("Frame data too long: {}".format(l))
+        buf = self.tx_buf
+        buf[0] = header
+        if self.n_len_bytes == 2:
+            buf[1] = (l >> 8) & 0xff
+            buf[2] = l & 0xff
         else:
-            d = [header, len(data) & 0xff]
-        d = d + data
+            buf[1] = l & 0xff
+        buf[n_hdr:n_hdr + n_pre] = prefix
+        buf[n_hdr + n_pre:n_hdr + l] = data
+        end = n_hdr + l
+        chk = frame_checksum(self.tx_view[1:end])
         if wrong_chk_sum:
-            d.append((self.checksum(d[1:]) + 1) & 0xff)
-        else:
-            d.append(self.checksum(d[1:]))
-        d.append(self.FRAME_ETX)
-        return d
+            chk = (chk + 1) & 0xff
+        buf[end] = chk
+        buf[end + 1] = self.FRAME_ETX
+        return self.tx_view[:end + 2]
 
 
     def send_command_frame(self, cmd, data = [], callback_func = None, wrong_chk_sum = 0):
         """Sends a command to the chip
         """
-        data_bytes = [cmd] + data
-        d = self.make_frame(self.FRAME_SOH, data_bytes, wrong_chk_sum)
-        logging.debug(' '.join('{:02x}'.format(x) for x in d))
+        d = self.make_frame(self.FRAME_SOH, data, wrong_chk_sum, prefix = bytes((cmd,)))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(' '.join('{:02x}'.format(x) for x in d))
         self.send(d, callback_func)
 
-    def send_data_frame(self, data=[]):
-        d = self.make_frame(self.FRAME_STX, data)
-        logging.debug(' '.join('{:02x}'.format(x) for x in d))
+    def send_data_frame(self, data=[], prefix = b''):
+        ''' Sends a data frame, prefix is put in front of the data without copying the data first '''
+        d = self.make_frame(self.FRAME_STX, data, prefix = prefix)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(' '.join('{:02x}'.format(x) for x in d))
         self.send(d, d_frame = 1)
-
-
-
-
@@ -0,0 +1,128 @@
+'''
+    Gang programming: flashes the same image to several identical targets at once, one session (serial port or
+    SPI device plus RESET/FLMD0 GPIOs) per target, each in its own thread.
+
+        python gang.py rh850 uart2 firmware.hex --target /dev/ttyUSB0:3:2 --target /dev/ttyUSB1:17:27
+
+    The image is parsed once and shared, and so are the checksums calculated from it (--diff, --verify).
+    A target that fails is reported and doesn't hold up the others.
+'''
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from defs import *
+from flashcomm import RenesasFlashComm
+from gpio import GPIO_BACKENDS
+from main import flash_programmers
+
+
+def parse_target(spec):
+    '''
+        Target assignment "port[:gpio_reset:gpio_flmd]". For SPI the port is "spi<port>.<device>", e.g. spi0.1.
+        Returns the RenesasFlashComm keyword arguments
+    '''
+    parts = spec.split(":")
+    if len(parts) not in (1, 3):
+        raise ValueError("Target {} is not port[:gpio_reset:gpio_flmd]".format(spec))
+    kwargs = {"port": parts[0]}
+    if len(parts) == 3:
+        kwargs["gpio_reset"] = int(parts[1])
+        kwargs["gpio_flmd"] = int(parts[2])
+    if parts[0].startswith("spi"):
+        _p, _d = parts[0][3:].split(".")
+        kwargs["spi_port"] = int(_p)
+        kwargs["spi_device"] = int(_d)
+    return kwargs
+
+
+class GangSession():
+    ''' One target: its programmer and the result of the run '''
+
+    def __init__(self, name, f_p = None, error = None):
+        self.name = name
+        self.f_p = f_p
+        self.error = error
+        self.t = 0.0
+        self.n_bytes = 0
+
+    def run(self, image, addr, diff = False, verify = False, max_baud = 0, chip_erase = False):
+        ''' Reset, program and (optionally) verify. Errors end up in self.error '''
+        _st = time()
+        try:
+            if self.f_p.reset() == -1:
+                raise NoResponseError("No response to the reset command")
+            if max_baud:
+                self.f_p.negotiate_baud(max_baud)
+            self.f_p.flash(addr, image, diff = diff, chip_erase = chip_erase)
+            if verify:
+                bad = self.f_p.verify_image(image, addr)
+                if bad:
+                    raise VerifyError("Flash differs in {} ranges, first at {:x}".format(len(bad), bad[0][0]))
+            self.n_bytes = image.size()
+        except Exception as e:
+            logging.debug("{}: {}".format(self.name, e), exc_info = True)
+            self.error = "{}: {}".format(type(e).__name__, e)
+        self.t = time() - _st
+        return self
+
+    def passed(self):
+        return self.error is None
+
+
+def gang_program(sessions, image, addr, **kwargs):
+    ''' Runs the sessions that could be set up concurrently, returns all of them '''
+    ready = [s for s in sessions if s.error is None]
+    if ready:
+        with ThreadPoolExecutor(max_workers = len(ready)) as pool:
+            list(pool.map(lambda s: s.run(image, addr, **kwargs), ready))
+    return sessions
+
+
+def print_results(sessions):
+    print("{:<24} {:<6} {:>9} {:>11}  {}".format("target", "result", "time [s]", "bytes/s", "error"))
+    for s in sessions:
+        print("{:<24} {:<6} {:>9.2f} {:>11.0f}  {}".format(s.name, "PASS" if s.passed() else "FAIL", s.t,
+              s.n_bytes / s.t if s.t and s.passed() else 0, s.error or ""))
+    n_pass = sum(s.passed() for s in sessions)
+    print("{} of {} targets passed".format(n_pass, len(sessions)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Renesas gang programming', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("mcu", help="The MCU type of all targets", choices = [t.value for t in MCU_Type])
+    parser.add_argument("mode", help="The communication protocol", choices = [t.value for t in Comm_Mode])
+    parser.add_argument("firmware", help="The firmware to be programmed (raw binary, Intel HEX, S-record or ELF)")
+    parser.add_argument("--target", help="port[:gpio_reset:gpio_flmd] of a target, for SPI spi<port>.<device>. Repeat per target",
+                        action = "append", required = True)
+    parser.add_argument("--addr", help="Load address of a raw binary (hex)", type = lambda x: int(x, 16), default = 0)
+    parser.add_argument("--baud", help="The communication baud rate", type = int, default = 9600)
+    parser.add_argument("--max_baud", help="Switch to the fastest rate up to this one that works (0: stay at --baud)", type = int, default = 0)
+    parser.add_argument("--gpio", help="GPIO backend for RESET / FLMD0. None: $RFPI_GPIO, or gpiozero if it is not set", choices = list(GPIO_BACKENDS), default = None)
+    parser.add_argument("--diff", help="Only erase and program the blocks whose checksum differs from the firmware", action = "store_true")
+    parser.add_argument("--chip-erase", help="Erase the whole chip first, including data flash and the gaps the firmware doesn't cover", action = "store_true")
+    parser.add_argument("--verify", help="Verify the image afterwards (one checksum per flash region where the MCU has it)", action = "store_true")
+    parser.add_argument("--log_level", help="Logging level", choices = ["info", "debug"], default = "info")
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.DEBUG if args.log_level == "debug" else logging.INFO, format="%(threadName)s %(filename)s:%(funcName)s: %(message)s")
+
+    mcu = MCU_Type(args.mcu)
+    mode = Comm_Mode(args.mode)
+    sessions = []
+    for spec in args.target:
+        try:
+            flashcomm = RenesasFlashComm(mcu, mode, baud_rate = args.baud, gpio = args.gpio, **parse_target(spec))
+            sessions.append(GangSession(spec, flash_programmers[mcu](flashcomm = flashcomm)))
+        except Exception as e:
+            sessions.append(GangSession(spec, error = "{}: {}".format(type(e).__name__, e)))
+
+    ready = [s for s in sessions if s.error is None]
+    if ready:
+        # Parsed and aligned once, shared by all sessions
+        image = ready[0].f_p.load_image(args.firmware, args.addr)
+        gang_program(sessions, image, args.addr, diff = args.diff, verify = args.verify, chip_erase = args.chip_erase,
+                     max_baud = args.max_baud if args.max_baud > args.baud else 0)
+    print_results(sessions)
+    exit(0 if all(s.passed() for s in sessions) else 1)
@@ -0,0 +1,199 @@
+'''
+    GPIO backends for FLMD0 / RESET / TOOL and precise waits for the entry sequences.
+
+        gpiozero    DigitalOutputDevice (any gpiozero pin factory), the default
+        cdev        Linux GPIO character device through libgpiod (python3-gpiod, v1 or v2 bindings), a few us per edge
+        mock        No hardware, records a timestamp per edge so sequences can be measured
+
+    Every backend has output(pin, initial_value) returning a pin with on(), off() and close()
+'''
+import os
+from time import perf_counter, sleep
+
+''' libgpiod bindings, imported by the cdev backend '''
+gpiod = None
+
+
+''' precise_sleep busy-waits the last part of a wait, time.sleep oversleeps by up to this much on a loaded Pi '''
+BUSY_WAIT       =   0.002
+
+
+def precise_sleep(t):
+    ''' Waits t seconds: time.sleep for the bulk, then a perf_counter busy-wait '''
+    end = perf_counter() + t
+    if t > BUSY_WAIT:
+        sleep(t - BUSY_WAIT)
+    while perf_counter() < end:
+        pass
+
+
+def pulse_train(pin, n, width):
+    ''' n low pulses of width (s) on a pin that is high, with width high in between '''
+    for i in range(n):
+        pin.off()
+        precise_sleep(width)
+        pin.on()
+        precise_sleep(width)
+
+
+class GpiozeroGPIO():
+    name = "gpiozero"
+
+    def output(self, pin, initial_value = 0):
+        from gpiozero import DigitalOutputDevice
+        return DigitalOutputDevice(pin, initial_value = initial_value)
+
+
+class CdevPin():
+    ''' One output line of a GPIO chip, requested through libgpiod '''
+
+    def __init__(self, chip, pin, initial_value):
+        self.pin = pin
+        if hasattr(gpiod, "request_lines"):
+            # v2 bindings
+            self._values = (gpiod.line.Value.INACTIVE, gpiod.line.Value.ACTIVE)
+            self._req = gpiod.request_lines(chip, consumer = "rfpi", config = {pin: gpiod.LineSettings(
+                direction = gpiod.line.Direction.OUTPUT, output_value = self._values[initial_value])})
+            self._set = lambda v: self._req.set_value(pin, self._values[v])
+        else:
+            self._chip = gpiod.Chip(chip)
+            self._req = self._chip.get_line(pin)
+            self._req.request(consumer = "rfpi", type = gpiod.LINE_REQ_DIR_OUT, default_vals = [initial_value])
+            self._set = self._req.set_value
+
+    def on(self):
+        self._set(1)
+
+    def off(self):
+        self._set(0)
+
+    def close(self):
+        self._req.release()
+
+
+class CdevGPIO():
+    name = "cdev"
+
+    def __init__(self, chip = "/dev/gpiochip0"):
+        global gpiod
+        try:
+            import gpiod
+        except ImportError:
+            raise ImportError("The cdev GPIO backend needs the gpiod module (libgpiod python bindings)")
+        self.chip = chip
+
+    def output(self, pin, initial_value = 0):
+        return CdevPin(self.chip, pin, initial_value)
+
+
+class MockPin():
+    def __init__(self, backend, pin, initial_value):
+        self.backend = backend
+        self.pin = pin
+        self.value = initial_value
+        backend.record(pin, initial_value)
+
+    def on(self):
+        self.value = 1
+        self.backend.record(self.pin, 1)
+
+    def off(self):
+        self.value = 0
+        self.backend.record(self.pin, 0)
+
+    def close(self):
+        pass
+
+
+class MockGPIO():
+    ''' Records every level set as (perf_counter, pin, value) in events '''
+    name = "mock"
+
+    def __init__(self):
+        self.events = []
+
+    def output(self, pin, initial_value = 0):
+        return MockPin(self, pin, initial_value)
+
+    def record(self, pin, value):
+        self.events.append((perf_counter(), pin, value))
+
+    def edges(self, pin, value = None):
+        ''' Times the pin changed (to value) '''
+        ret = []
+        last = None
+        for t, p, v in self.events:
+            if p != pin:
+                continue
+            if last is not None and v != last and (value is None or v == value):
+                ret.append(t)
+            last = v
+        return ret
+
+    def pulse_widths(self, pin):
+        ''' Durations of the low pulses of pin '''
+        ret = []
+        fall = None
+        last = None
+        for t, p, v in self.events:
+            if p != pin or v == last:
+                continue
+            if v == 0 and last is not None:
+                fall = t
+            elif v == 1 and fall is not None:
+                ret.append(t - fall)
+            last = v
+        return ret
+
+
+GPIO_BACKENDS = {b.name: b for b in (GpiozeroGPIO, CdevGPIO, MockGPIO)}
+
+
+def gpio_backend(gpio):
+    ''' Backend by name, or the backend itself. $RFPI_GPIO overrides the default (gpiozero) '''
+    if gpio is None:
+        gpio = os.environ.get("RFPI_GPIO", "gpiozero")
+    if isinstance(gpio, str):
+        return GPIO_BACKENDS[gpio]()
+    return gpio
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='GPIO timing accuracy', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--gpio", help="Backend", choices = list(GPIO_BACKENDS), default = "mock")
+    parser.add_argument("--pin", help="Output pin to pulse", type = int, default = 2)
+    parser.add_argument("--width", help="Pulse width (s)", type = float, default = 0.0001)
+    parser.add_argument("--pulses", help="Pulses per train", type = int, default = 100)
+    args = parser.parse_args()
+
+    def _stats(name, want, got):
+        err = [abs(g - want) * 1e6 for g in got]
+        print("{:<36} {:9.1f} us mean error {:9.1f} us max".format(name, sum(err) / len(err), max(err)))
+
+    for _w in (0.0001, 0.001, 0.0056, 0.01):
+        _got = []
+        for i in range(20):
+            _st = perf_counter()
+            sleep(_w)
+            _got.append(perf_counter() - _st)
+        _stats("time.sleep({})".format(_w), _w, _got)
+        _got = []
+        for i in range(20):
+            _st = perf_counter()
+            precise_sleep(_w)
+            _got.append(perf_counter() - _st)
+        _stats("precise_sleep({})".format(_w), _w, _got)
+
+    backend = gpio_backend(args.gpio)
+    pin = backend.output(args.pin, 1)
+    if isinstance(backend, MockGPIO):
+        pulse_train(pin, args.pulses, args.width)
+        _stats("{} low pulses of {} s".format(args.pulses, args.width), args.width, backend.pulse_widths(args.pin))
+    else:
+        _st = perf_counter()
+        pulse_train(pin, args.pulses, args.width)
+        _t = perf_counter() - _st
+        print("{} pulses of {} s took {:.1f} us per pulse (ideal {:.1f}), measure the widths on a scope".format(
+              args.pulses, args.width, _t / args.pulses * 1e6, 2 * args.width * 1e6))
+    pin.close()
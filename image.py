@@ -0,0 +1,247 @@
+''' Firmware images: raw binary, Intel HEX, Motorola S-record and ELF, loaded into a sparse map of segments '''
+import os
+import struct
+
+from defs import InvalidImageError
+from checksum import Checksum
+
+
+def _first_record(raw, lead):
+    ''' True if the file starts with a text record: the lead character followed by only hex digits '''
+    line = raw[:0x200].split(b"\n", 1)[0].strip()
+    return len(line) > 2 and line[:1] == lead and all(c in b"0123456789abcdefABCDEF" for c in line[1:])
+
+
+class Image():
+    '''
+        Sparse firmware image: a sorted list of non-overlapping [address, bytearray] segments.
+        Adjacent and overlapping segments are merged (data added later wins).
+    '''
+
+    def __init__(self):
+        self.segments = []
+        # Checksums already calculated, images are shared between gang sessions
+        self._checksums = {}
+
+    def add(self, addr, data):
+        ''' Adds data at addr, merging it with the segments it touches '''
+        if not len(data):
+            return
+        end = addr + len(data)
+        merged = []
+        new_start = addr
+        new_end = end
+        for s, d in self.segments:
+            if s + len(d) < addr or s > end:
+                merged.append([s, d])
+                continue
+            new_start = min(new_start, s)
+            new_end = max(new_end, s + len(d))
+        if new_start == addr and new_end == end:
+            seg = bytearray(data)
+        else:
+            seg = bytearray(new_end - new_start)
+            for s, d in self.segments:
+                if new_start <= s and s + len(d) <= new_end:
+                    seg[s - new_start:s - new_start + len(d)] = d
+            seg[addr - new_start:end - new_start] = data
+        merged.append([new_start, seg])
+        merged.sort(key = lambda x: x[0])
+        self.segments = merged
+        self._checksums = {}
+
+    def ranges(self):
+        ''' (start, end) of every segment, end inclusive '''
+        return [(s, s + len(d) - 1) for s, d in self.segments]
+
+    def size(self):
+        return sum(len(d) for s, d in self.segments)
+
+    def view(self, addr_start, addr_end):
+        ''' memoryview on addr_start - addr_end, which has to be inside a single segment '''
+        for s, d in self.segments:
+            if s <= addr_start and addr_end < s + len(d):
+                return memoryview(d)[addr_start - s:addr_end - s + 1]
+        raise ValueError("{:x} - {:x} is not inside a single segment".format(addr_start, addr_end))
+
+    def pieces(self, addr_start, addr_end):
+        ''' (start, end) of the populated parts of addr_start - addr_end '''
+        return [(max(s, addr_start), min(e, addr_end)) for s, e in self.ranges() if s <= addr_end and e >= addr_start]
+
+    def checksum(self, addr_start, addr_end, fill = 0xff, bits = 16):
+        ''' Area checksum of addr_start - addr_end, bytes not in the image count as fill (erased flash) '''
+        key = (addr_start, addr_end, fill, bits)
+        if key in self._checksums:
+            return self._checksums[key]
+        chk = Checksum(bits)
+        n = 0
+        for s, e in self.pieces(addr_start, addr_end):
+            chk.update(self.view(s, e))
+            n += e - s + 1
+        chk.update_fill(fill, (addr_end - addr_start + 1) - n)
+        self._checksums[key] = chk.value()
+        return self._checksums[key]
+
+    def align(self, granularity, fill = 0xff):
+        '''
+            Pads every segment with fill to the granularity (int, or function of the address returning it), in place:
+            a segment that is alone in its span is extended, only segments that end up in the same unit are merged
+            into a new buffer. Returns the image
+        '''
+        g = granularity if callable(granularity) else (lambda addr: granularity)
+        spans = []
+        for s, e in self.ranges():
+            a_s = s - s % g(s)
+            a_e = (e + 1) + (-(e + 1)) % g(e)
+            if spans and a_s <= spans[-1][1]:
+                spans[-1][1] = max(spans[-1][1], a_e)
+            else:
+                spans.append([a_s, a_e])
+        aligned = []
+        for a_s, a_e in spans:
+            segs = [[s, d] for s, d in self.segments if a_s <= s < a_e]
+            if len(segs) == 1:
+                s, buf = segs[0]
+                buf[0:0] = bytes((fill,)) * (s - a_s)
+                buf.extend(bytes((fill,)) * (a_e - a_s - len(buf)))
+            else:
+                buf = bytearray(bytes((fill,)) * (a_e - a_s))
+                for s, d in segs:
+                    buf[s - a_s:s - a_s + len(d)] = d
+            aligned.append([a_s, buf])
+        self.segments = aligned
+        self._checksums = {}
+        return self
+
+    def to_ihex(self, record_size = 0x10):
+        ''' Intel HEX text of the image, with extended linear address records where the upper 16 bits change '''
+        lines = []
+        upper = None
+
+        def _record(r_type, addr, data):
+            rec = bytes((len(data), (addr >> 8) & 0xff, addr & 0xff, r_type)) + bytes(data)
+            lines.append(":" + (rec + bytes((-sum(rec) & 0xff,))).hex().upper())
+
+        for s, d in self.segments:
+            o = 0
+            while o < len(d):
+                addr = s + o
+                if addr >> 16 != upper:
+                    upper = addr >> 16
+                    _record(0x04, 0, upper.to_bytes(2, "big"))
+                # Records don't cross a 64 KiB boundary
+                n = min(record_size, len(d) - o, 0x10000 - (addr & 0xffff))
+                _record(0x00, addr & 0xffff, d[o:o + n])
+                o += n
+        _record(0x01, 0, b"")
+        return "\n".join(lines) + "\n"
+
+    @classmethod
+    def load(cls, path, base = 0):
+        '''
+            Loads an image, the format is detected from the content. base is the load address of raw binaries, whose
+            buffer the file is read into becomes the segment as it is
+        '''
+        with open(path, "rb") as f:
+            raw = bytearray(os.fstat(f.fileno()).st_size)
+            del raw[f.readinto(raw):]
+        if raw[:4] == b"\x7fELF":
+            return cls.from_elf(raw)
+        ext = os.path.splitext(path)[1].lower()
+        if ext in (".hex", ".ihex") or _first_record(raw, b":"):
+            return cls.from_ihex(raw.decode("ascii"))
+        if ext in (".srec", ".s19", ".s28", ".s37", ".mot") or _first_record(raw, b"S"):
+            return cls.from_srec(raw.decode("ascii"))
+        img = cls()
+        if raw:
+            img.segments.append([base, raw])
+        return img
+
+    @classmethod
+    def from_ihex(cls, text):
+        img = cls()
+        upper = 0
+        run_addr, run = None, bytearray()
+        for n, line in enumerate(text.splitlines(), 1):
+            line = line.strip()
+            if not line:
+                continue
+            if line[0] != ":":
+                raise InvalidImageError("Line {}: not an Intel HEX record".format(n))
+            rec = bytes.fromhex(line[1:])
+            if len(rec) < 5 or len(rec) != rec[0] + 5 or sum(rec) & 0xff:
+                raise InvalidImageError("Line {}: bad length or checksum".format(n))
+            r_type = rec[3]
+            data = rec[4:-1]
+            if r_type == 0x00:
+                addr = upper + ((rec[1] << 8) | rec[2])
+                if run_addr is not None and addr == run_addr + len(run):
+                    run += data
+                else:
+                    if run_addr is not None:
+                        img.add(run_addr, run)
+                    run_addr, run = addr, bytearray(data)
+            elif r_type == 0x01:
+                break
+            elif r_type == 0x02:
+                upper = int.from_bytes(data, "big") << 4
+            elif r_type == 0x04:
+                upper = int.from_bytes(data, "big") << 16
+        if run_addr is not None:
+            img.add(run_addr, run)
+        return img
+
+    @classmethod
+    def from_srec(cls, text):
+        img = cls()
+        run_addr, run = None, bytearray()
+        addr_len = {"1": 2, "2": 3, "3": 4}
+        for n, line in enumerate(text.splitlines(), 1):
+            line = line.strip()
+            if not line:
+                continue
+            if line[0] != "S" or len(line) < 4:
+                raise InvalidImageError("Line {}: not an S-record".format(n))
+            rec = bytes.fromhex(line[2:])
+            if len(rec) != rec[0] + 1 or (sum(rec) & 0xff) != 0xff:
+                raise InvalidImageError("Line {}: bad length or checksum".format(n))
+            if line[1] not in addr_len:
+                continue
+            a_l = addr_len[line[1]]
+            addr = int.from_bytes(rec[1:1 + a_l], "big")
+            data = rec[1 + a_l:-1]
+            if run_addr is not None and addr == run_addr + len(run):
+                run += data
+            else:
+                if run_addr is not None:
+                    img.add(run_addr, run)
+                run_addr, run = addr, bytearray(data)
+        if run_addr is not None:
+            img.add(run_addr, run)
+        return img
+
+    @classmethod
+    def from_elf(cls, raw):
+        ''' Loads the PT_LOAD segments at their physical (load) address '''
+        if raw[4] not in (1, 2) or raw[5] not in (1, 2):
+            raise InvalidImageError("Unsupported ELF class or data encoding")
+        end = "<" if raw[5] == 1 else ">"
+        if raw[4] == 1:
+            phoff, = struct.unpack_from(end + "I", raw, 0x1c)
+            phentsize, phnum = struct.unpack_from(end + "HH", raw, 0x2a)
+        else:
+            phoff, = struct.unpack_from(end + "Q", raw, 0x20)
+            phentsize, phnum = struct.unpack_from(end + "HH", raw, 0x36)
+        img = cls()
+        for i in range(phnum):
+            o = phoff + i * phentsize
+            if raw[4] == 1:
+                p_type, p_offset, p_vaddr, p_paddr, p_filesz = struct.unpack_from(end + "IIIII", raw, o)
+            else:
+                p_type, _flags, p_offset, p_vaddr, p_paddr, p_filesz = struct.unpack_from(end + "IIQQQQ", raw, o)
+            if p_type != 1 or not p_filesz:
+                continue
+            if p_offset + p_filesz > len(raw):
+                raise InvalidImageError("Segment {} is outside the file".format(i))
+            img.add(p_paddr, memoryview(raw)[p_offset:p_offset + p_filesz])
+        return img
@@ -0,0 +1,85 @@
+''' Progress journal of a dump, so an interrupted read can continue where it stopped '''
+import json
+import logging
+import os
+
+from checksum import area_checksum
+
+
+''' The journal is updated every time this many bytes have been read '''
+JOURNAL_CHUNK   =   0x4000
+
+
+class DumpJournal():
+    '''
+        Records the address ranges of a dump that are already in the output file, with their checksum.
+        Lives next to the output file (<out_file>.journal) and is removed once the dump is complete
+    '''
+
+    def __init__(self, out_file, addr_start, n_bytes):
+        self.out_file = out_file
+        self.path = out_file + ".journal"
+        self.addr_start = addr_start
+        self.n_bytes = n_bytes
+        self.done = []      # [start, end (exclusive), checksum]
+
+    def load(self):
+        '''
+            Reads the journal of a previous run of the same dump. Ranges whose checksum doesn't match the output
+            file anymore are dropped. Returns the number of bytes that don't have to be read again
+        '''
+        self.done = []
+        try:
+            with open(self.path) as f:
+                j = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        if j.get("addr") != self.addr_start or j.get("size") != self.n_bytes:
+            logging.warning("{} belongs to another dump, starting over".format(self.path))
+            return 0
+        try:
+            out_f = open(self.out_file, 'rb')
+        except OSError:
+            return 0
+        with out_f:
+            for s, e, chk in j.get("done", []):
+                out_f.seek(s - self.addr_start)
+                if area_checksum(out_f.read(e - s)) == chk:
+                    self.done.append([s, e, chk])
+                else:
+                    logging.warning("{:x} - {:x} changed on disk, reading it again".format(s, e - 1))
+        self.done.sort()
+        return self.n_done()
+
+    def add(self, addr_start, addr_end, data):
+        ''' Marks addr_start - addr_end (exclusive) as read and saves the journal '''
+        self.done.append([addr_start, addr_end, area_checksum(data)])
+        self.save()
+
+    def save(self):
+        ''' Written to a temporary file first so an interruption never leaves a broken journal '''
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump({"addr": self.addr_start, "size": self.n_bytes, "done": sorted(self.done)}, f)
+        os.replace(tmp, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def n_done(self):
+        return sum(e - s for s, e, chk in self.done)
+
+    def missing(self):
+        ''' (start, end (exclusive)) of the ranges still to be read '''
+        todo = []
+        addr = self.addr_start
+        for s, e, chk in sorted(self.done):
+            if s > addr:
+                todo.append((addr, s))
+            addr = max(addr, e)
+        if addr < self.addr_start + self.n_bytes:
+            todo.append((addr, self.addr_start + self.n_bytes))
+        return todo
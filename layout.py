@@ -0,0 +1,69 @@
+''' Flash layouts: where the flash is and how it is divided in erase blocks '''
+from defs import MCU_Type
+
+
+''' Default layouts per MCU type: (start address, size, erase block size). TODO adjust these based on chip '''
+LAYOUTS = {
+    MCU_Type.RH850: [(0x0, 0x10000, 0x2000), (0x10000, 0x1f0000, 0x8000), (0xff200000, 0x8000, 0x40)],
+    MCU_Type.V850E2: [(0x0, 0x300000, 0x8000), (0x02000000, 0x8000, 0x40)],
+    MCU_Type.V850ES: [(0x0, 0x40000, 0x1000)],
+    MCU_Type.V850E: [(0x0, 0x40000, 0x1000)],
+    MCU_Type.R78K0: [(0x0, 0xf000, 0x400)],
+    MCU_Type.R78K0_Kx2: [(0x0, 0xf000, 0x400)],
+    MCU_Type.R78K0R: [(0x0, 0x40000, 0x400)],
+    MCU_Type.R32C: [(0xfc0000, 0x40000, 0x1000)],
+}
+
+
+def merge_ranges(ranges):
+    ''' Sorted (start, end) ranges with the adjacent and overlapping ones joined '''
+    merged = []
+    for s, e in sorted(ranges):
+        if merged and s <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], e))
+        else:
+            merged.append((s, e))
+    return merged
+
+
+class FlashLayout():
+    ''' A list of flash regions, each divided in erase blocks of the same size '''
+
+    def __init__(self, regions):
+        self.regions = sorted(regions)
+
+    def size(self):
+        return sum(r[1] for r in self.regions)
+
+    def region(self, addr):
+        ''' The (start, size, erase block size) region containing addr, None if not in flash '''
+        for r in self.regions:
+            if r[0] <= addr < r[0] + r[1]:
+                return r
+        return None
+
+    def block(self, addr):
+        ''' The (start, end) of the erase block containing addr '''
+        r = self.region(addr)
+        if r is None:
+            raise ValueError("Address {:x} is not in flash".format(addr))
+        s = addr - (addr - r[0]) % r[2]
+        return (s, s + r[2] - 1)
+
+    def blocks(self, addr_start, addr_end):
+        ''' All erase blocks (start, end) touching addr_start - addr_end, in order '''
+        blks = []
+        for r_start, r_size, r_blk in self.regions:
+            s = max(addr_start, r_start)
+            e = min(addr_end, r_start + r_size - 1)
+            if s > e:
+                continue
+            b = s - (s - r_start) % r_blk
+            while b <= e:
+                blks.append((b, b + r_blk - 1))
+                b += r_blk
+        return blks
+
+    def blocks_for(self, ranges):
+        ''' Erase blocks touching any of the (start, end) ranges, each block only once '''
+        return sorted(set(b for s, e in ranges for b in self.blocks(s, e)))
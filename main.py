@@ -1,19 +1,15 @@
 import argparse
+import importlib
 import logging
+import shlex
+import sys
+from collections.abc import Mapping
 from enum import Enum
-from time import sleep
+from time import time
 
-from defs import MCU_Type, Comm_Mode
-from flashcomm import RenesasFlashComm
-from renesas_fpi import RenesasFlashProgrammer
-from error import *
-
-from rh850_prog import RH850Programmer
-from r32c_prog import R32CProgrammer
-from r78k0_prog import R78K0Programmer
-from r78k0r_prog import R78K0RProgrammer
-from v850e2_prog import V850Programmer
-from rl78_prog import RL78Programmer
+from defs import MCU_Type, Comm_Mode, NoAckError, NoResponseError, VerifyError
+from gpio import GPIO_BACKENDS
+from image import Image
 
 class Actions(Enum):
     RESET       =   "reset"
@@ -29,40 +25,95 @@ class Actions(Enum):
     CHK         =   "chk"
     RFO         =   "rfo"
     WFO         =   "wfo"
-
-
-
-flash_programmers = {
-        MCU_Type.RH850: RH850Programmer,
-        MCU_Type.R32C: R32CProgrammer,
-        MCU_Type.R78K0: R78K0Programmer,
-        MCU_Type.R78K0_Kx2: R78K0Programmer,
-        MCU_Type.R78K0R: R78K0RProgrammer,
-        MCU_Type.V850E2: V850Programmer, 
-        MCU_Type.RL78: RL78Programmer
-        }
+    CALIBRATE   =   "calibrate"
+    DIFF        =   "diff"
+    BATCH       =   "batch"
+
+
+
+class ProgrammerRegistry(Mapping):
+    '''
+        MCU_Type -> programmer class. The built-in ones are "module:Class" strings, a module is only imported when
+        its class is looked up, so the CLI doesn't load every programmer (and what they import) to start.
+        MCU types without a built-in programmer are looked up in the "rfpi.programmers" entry points of the
+        installed packages, named after the MCU type:
+
+            [project.entry-points."rfpi.programmers"]
+            v850es = "mypkg.v850es:V850ESProgrammer"
+    '''
+
+    ENTRY_POINT_GROUP   =   "rfpi.programmers"
+
+    def __init__(self, programmers):
+        self.programmers = dict(programmers)
+        self._classes = {}
+        self._entry_points = None
+
+    def register(self, mcu, programmer):
+        ''' Adds a programmer, a class or a "module:Class" string '''
+        self._classes.pop(mcu, None)
+        if isinstance(programmer, str):
+            self.programmers[mcu] = programmer
+        else:
+            self._classes[mcu] = programmer
+
+    def entry_points(self):
+        ''' Entry points of the group by MCU type value, only scanned when needed '''
+        if self._entry_points is None:
+            from importlib.metadata import entry_points
+            try:
+                eps = entry_points(group = self.ENTRY_POINT_GROUP)
+            except TypeError:
+                # Python < 3.10
+                eps = entry_points().get(self.ENTRY_POINT_GROUP, [])
+            self._entry_points = {ep.name: ep for ep in eps}
+        return self._entry_points
+
+    def __getitem__(self, mcu):
+        if mcu in self._classes:
+            return self._classes[mcu]
+        if mcu in self.programmers:
+            _module, _cls = self.programmers[mcu].split(":")
+            cls = getattr(importlib.import_module(_module), _cls)
+        else:
+            ep = self.entry_points().get(mcu.value)
+            if ep is None:
+                raise KeyError(mcu)
+            cls = ep.load()
+        self._classes[mcu] = cls
+        return cls
+
+    def __contains__(self, mcu):
+        # Without importing the programmer (Mapping's does a lookup)
+        return mcu in self.programmers or mcu in self._classes or \
+            (isinstance(mcu, MCU_Type) and mcu.value in self.entry_points())
+
+    def __iter__(self):
+        known = set(self.programmers) | set(self._classes)
+        values = {t.value: t for t in MCU_Type}
+        return iter(sorted(known, key = lambda t: t.value) + [values[n] for n in sorted(self.entry_points())
+                                                              if n in values and values[n] not in known])
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+
+flash_programmers = ProgrammerRegistry({
+        MCU_Type.RH850: "rh850_prog:RH850Programmer",
+        MCU_Type.R32C: "r32c_prog:R32CProgrammer",
+        MCU_Type.R78K0: "r78k0_prog:R78K0Programmer",
+        MCU_Type.R78K0_Kx2: "r78k0_prog:R78K0Programmer",
+        MCU_Type.R78K0R: "r78k0r_prog:R78K0RProgrammer",
+        MCU_Type.V850E2: "v850e2_prog:V850Programmer"
+        })
 
 log = {
         "info": logging.INFO,
         "debug": logging.DEBUG
     }
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description='Renesas Flash Programming', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-
-
-    parser.add_argument("mcu", help="Specify the exact renesas MCU", choices = [t.value for t in MCU_Type])
-    parser.add_argument("mode", help="The communication protocol", choices = [t.value for t in Comm_Mode], default="uart2")
-    ''' Bootloader communication options '''
-    parser.add_argument("--port", help="The serial device to be used", default = "/dev/ttyAMA0")
-    parser.add_argument("--baud", help="The communication baud rate", type = int, default = 9600)
-    parser.add_argument("--gpio_reset", help="The GPIO pin used for the reset pin", type = int, default = 3)
-    parser.add_argument("--gpio_flmd", help="The GPIO pin used for the flmd pin", type = int, default = 2)
-
-    parser.add_argument("--log_level", help="Logging level", choices = [k for k in log], default = "debug")
-
-    
-    ''' For specific commands '''
+def add_actions(parser):
+    ''' The subcommands, shared with the daemon client '''
     subparsers = parser.add_subparsers(help = "Specific command to execute", dest = "command")
     ''' Simple parsers (require no args) '''
     subparsers.add_parser(Actions.RESET.value, help = "Initialises the bootloader interface")
@@ -75,11 +126,23 @@ if __name__ == "__main__":
 
     ''' Parsers requiring address '''
     parser_prog = subparsers.add_parser(Actions.PROGRAM.value, help = "Erases the memory and programs the given firmware")
-    parser_prog.add_argument("addr", type = lambda x: int(x, 16), help = "address to program data at")
-    parser_prog.add_argument("firmware", help = "The firmware to be programmed")
+    parser_prog.add_argument("addr", type = lambda x: int(x, 16), help = "address to program a raw binary at (HEX, S-record and ELF files carry their own addresses)")
+    parser_prog.add_argument("firmware", help = "The firmware to be programmed (raw binary, Intel HEX, S-record or ELF)")
+    parser_prog.add_argument("--diff", help = "Only erase and program the blocks whose checksum differs from the firmware", action = "store_true")
+    parser_prog.add_argument("--chip-erase", help = "Erase the whole chip first, including data flash and the gaps the firmware doesn't cover", action = "store_true")
+
+    parser_verify = subparsers.add_parser(Actions.VERIFY.value, help = "Compares the flash with the given firmware")
+    parser_verify.add_argument("addr", type = lambda x: int(x, 16), help = "address of a raw binary (HEX, S-record and ELF files carry their own addresses)")
+    parser_verify.add_argument("firmware", help = "The firmware that should be programmed (raw binary, Intel HEX, S-record or ELF)")
+    parser_verify.add_argument("--mode", help = "checksum: one checksum per flash region, device: the MCU compares the data sent to it, "
+                               "readback: read the flash and compare here (default: the cheapest the MCU has)", choices = ["checksum", "device", "readback"])
 
-    parser_verify = subparsers.add_parser(Actions.VERIFY.value, help = "Verifies the given firmware")
-    parser_verify.add_argument("addr", type = lambda x: int(x, 16), help = "address to verify data at")
+
+    parser_diff = subparsers.add_parser(Actions.DIFF.value, help = "Lists the pages where the flash differs from the given firmware, by checksum bisection")
+    parser_diff.add_argument("addr", type = lambda x: int(x, 16), help = "address of a raw binary (HEX, S-record and ELF files carry their own addresses)")
+    parser_diff.add_argument("firmware", help = "The reference firmware (raw binary, Intel HEX, S-record or ELF)")
+    parser_diff.add_argument("--page", type = lambda x: int(x, 16), help = "Page size to narrow the differences down to (hex, rounded up to a multiple of the program unit, default: the program unit)")
+    parser_diff.add_argument("--read", help = "Read the differing pages from the device into this Intel HEX file")
 
 
     parser_erase = subparsers.add_parser(Actions.ERASE.value, help = "Erases the memory")
@@ -88,8 +151,13 @@ if __name__ == "__main__":
 
     parser_read = subparsers.add_parser(Actions.READ.value, help = "Read out part of the firmware")
     parser_read.add_argument("addr", type = lambda x: int(x, 16), help = "The address to read from")
-    parser_read.add_argument("size", type = lambda x: int(x, 16), help = "The number of bytes to read")
+    parser_read.add_argument("size", type = lambda x: None if x == "end" else int(x, 16), help = "The number of bytes to read, 'end' for up to the end of the flash (region)")
     parser_read.add_argument("f_out", help = "The file the firmware is written to")
+    parser_read.add_argument("--restart", help = "Ignore the progress journal of an interrupted read and start over", action = "store_true")
+
+    parser_cal = subparsers.add_parser(Actions.CALIBRATE.value, help = "Finds the shortest reliable reset timings and stores them for this MCU and mode")
+    parser_cal.add_argument("--tries", help = "Resets in a row that have to succeed", type = int, default = 3)
+    parser_cal.add_argument("--resolution", help = "Resolution of the search in seconds", type = float, default = 0.0005)
 
     parser_test = subparsers.add_parser(Actions.TEST.value, help = "Test a certain command")
     parser_test.add_argument("cmd", type = lambda x: int(x, 16), help = "The command to execute")
@@ -103,73 +171,216 @@ if __name__ == "__main__":
     parser_chks.add_argument("addr_start", type = lambda x: int(x, 16), help = "The start address of the checksums")
     parser_chks.add_argument("addr_end", type = lambda x: int(x, 16), help = "The end address of the checksums")
 
-    args = parser.parse_args() 
+    parser_batch = subparsers.add_parser(Actions.BATCH.value, help = "Runs several subcommands in one bootloader session, stops at the first that fails")
+    parser_batch.add_argument("script", nargs = "?", help = "File with one subcommand per line (# comments), - for stdin")
+    parser_batch.add_argument("-c", dest = "steps", help = "A subcommand, e.g. -c 'erase 0' -c 'program 0 fw.hex'. Can be repeated, runs after the script", action = "append", default = [])
 
-    mcu = MCU_Type(args.mcu)
-    mode = Comm_Mode(args.mode)
+    return subparsers
 
-    # Set logging level
-    logging.basicConfig(level=log[args.log_level], format="%(filename)s:%(funcName)s: %(message)s")
 
-    # kwargs = {"comm_mode": mode, "baud_rate": args.baud, "ser_port": args.port, "gpio_flmd": args.gpio_flmd, "gpio_reset": args.gpio_reset}
+def build_parser():
+    ''' Programmer options (MCU, mode, wiring) followed by the subcommand '''
+    parser = argparse.ArgumentParser(description='Renesas Flash Programming', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
-    # Create the flashcomm device
-    flashcomm = RenesasFlashComm(mcu, mode, port = args.port, baud_rate = args.baud, gpio_flmd = args.gpio_flmd, gpio_reset = args.gpio_reset)
 
-    kwargs = {"flashcomm": flashcomm}
+    parser.add_argument("mcu", help="Specify the exact renesas MCU", choices = [t.value for t in MCU_Type])
+    parser.add_argument("mode", help="The communication protocol", choices = [t.value for t in Comm_Mode], default="uart2")
+    ''' Bootloader communication options '''
+    parser.add_argument("--port", help="The serial device to be used", default = "/dev/ttyAMA0")
+    parser.add_argument("--baud", help="The communication baud rate", type = int, default = 9600)
+    parser.add_argument("--max_baud", help="After the reset, switch to the fastest rate up to this one that works (0: stay at --baud)", type = int, default = 0)
+    parser.add_argument("--gpio_reset", help="The GPIO pin used for the reset pin", type = int, default = 3)
+    parser.add_argument("--gpio_flmd", help="The GPIO pin used for the flmd pin", type = int, default = 2)
+    parser.add_argument("--gpio", help="GPIO backend for RESET / FLMD0 (cdev: libgpiod, precise timing). None: $RFPI_GPIO, or gpiozero if it is not set", choices = list(GPIO_BACKENDS), default = None)
+    parser.add_argument("--reader", help="Receive through a thread that keeps draining the UART into a buffer", action = "store_true")
 
-    f_p = flash_programmers.get(mcu, RenesasFlashComm)(**kwargs)
+    parser.add_argument("--log_level", help="Logging level", choices = [k for k in log], default = "debug")
 
+    add_actions(parser)
+    return parser
+
+
+def load_steps(args):
+    ''' The subcommands (argv lists) of a batch, from the script and the -c options '''
+    lines = []
+    if args.script:
+        with (sys.stdin if args.script == "-" else open(args.script)) as f:
+            lines += f.read().splitlines()
+    lines += args.steps
+    steps = [shlex.split(l, comments = True) for l in lines]
+    return [st for st in steps if st]
+
+
+def run_batch(f_p, steps, reset):
+    '''
+        Runs the steps with a single reset: reset() is only called again after a step that leaves the session
+        (calibrate, test, mcu_on/off). All steps are parsed before the first one runs. Stops at the first step
+        that fails, then prints the time of every step
+    '''
+    parser = argparse.ArgumentParser(prog = "batch step", add_help = False)
+    add_actions(parser)
+    step_args = [parser.parse_args(argv) for argv in steps]
+    for argv, args in zip(steps, step_args):
+        if args.command in (None, Actions.BATCH.value):
+            parser.error("not a batch step: {}".format(" ".join(argv)))
+
+    state = {"in_session": False, "reset": False}
+
+    def _reset():
+        state["reset"] = True
+        if not state["in_session"]:
+            _r = reset()
+            state["in_session"] = _r != -1
+            return _r
+        return 0
+
+    results = []
+    error = None
+    for argv, args in zip(steps, step_args):
+        state["reset"] = False
+        _st = time()
+        try:
+            run_action(f_p, args, _reset)
+        except Exception as e:
+            logging.debug("", exc_info = True)
+            error = "{}: {}".format(type(e).__name__, e)
+        results.append((" ".join(argv), time() - _st, error))
+        if not state["reset"]:
+            state["in_session"] = False
+        if error:
+            break
+
+    print("{:<40} {:>9}  {}".format("step", "time [s]", "result"))
+    for step, t, err in results:
+        print("{:<40} {:>9.3f}  {}".format(step, t, err or "ok"))
+    for argv in steps[len(results):]:
+        print("{:<40} {:>9}  skipped".format(" ".join(argv), "-"))
+    print("{:<40} {:>9.3f}".format("total", sum(r[1] for r in results)))
+    if error:
+        raise SystemExit(1)
+
+
+def create_programmer(mcu, mode, port, baud, gpio_flmd, gpio_reset, gpio = None, reader = False):
+    ''' Creates the flashcomm device and the programmer for the MCU type '''
+    from flashcomm import RenesasFlashComm
+    if mcu not in flash_programmers:
+        raise ValueError("No programmer for {}".format(mcu.value))
+    flashcomm = RenesasFlashComm(mcu, mode, port = port, baud_rate = baud, gpio_flmd = gpio_flmd, gpio_reset = gpio_reset, gpio = gpio, reader = reader)
+    kwargs = {"flashcomm": flashcomm}
+    return flash_programmers[mcu](**kwargs)
+
+
+def start_session(f_p, max_baud):
+    '''
+        Bootloader reset, then switch to the fastest baud rate that works and check which device it is. If the
+        signature can't be read the profile of last time isn't trusted, the session goes on with the default layout
+    '''
+    _r = f_p.reset()
+    if max_baud > f_p.sync_baud:
+        f_p.negotiate_baud(max_baud)
+    try:
+        f_p.identify()
+    except ValueError as e:
+        logging.warning("Signature not readable, using the default layout: {}".format(e))
+        f_p.apply_profile(None)
+    return _r
+
+
+def run_action(f_p, args, reset):
+    '''
+        Executes the subcommand in args. reset() is called first by the actions that need the bootloader,
+        it's start_session here and only resets when the session was lost in the daemon
+    '''
+    flashcomm = f_p.flashcomm
     cmd = Actions(args.command)
 
     # check which command given
     if cmd == Actions.RESET:
-        f_p.reset()
+        if reset() == -1:
+            raise NoResponseError("No response to the reset command")
     elif cmd == Actions.PROGRAM:
-        f_p.reset()
-        f_p.flash(args.addr, args.firmware)
+        reset()
+        f_p.flash(args.addr, args.firmware, diff = args.diff, chip_erase = args.chip_erase)
     elif cmd == Actions.READ:
-        f_p.reset()
-        _firm = f_p.read(args.addr, args.size)
-        with open(args.f_out, "wb") as f:
-            f.write(_firm)
+        reset()
+        if args.size is None:
+            args.size = f_p.flash_end(args.addr) - args.addr + 1
+        f_p.dump(args.addr, args.size, args.f_out, resume = not args.restart)
     elif cmd == Actions.SIG:
-        f_p.reset()
-        f_p.get_signature()
+        reset()
+        if f_p.profile is None:
+            raise NoResponseError("No signature read from the device")
+        print(f_p.profile)
     elif cmd == Actions.RFO:
-        f_p.reset()
+        reset()
         f_p.rfo()
     elif cmd == Actions.WFO:
-        f_p.reset()
+        reset()
         f_p.wfo()
     elif cmd == Actions.CHKS:
-        f_p.reset()
+        reset()
         f_p.get_checksums(args.addr_start, args.addr_end)
     elif cmd == Actions.CHK:
-        f_p.reset()
-        f_p.get_checksum(args.addr_start, args.addr_end)
+        reset()
+        print("{:x} - {:x}: {:x}".format(args.addr_start, args.addr_end, f_p.read_checksum(args.addr_start, args.addr_end)))
+    elif cmd == Actions.CALIBRATE:
+        f_p.calc_timings(n_tries = args.tries, resolution = args.resolution)
     elif cmd == Actions.TEST:
         while 1:
             try:
-                f_p.reset()
+                reset()
                 break
             except ValueError as e:
                 pass
         f_p.test_cmd(args.cmd, [int(a, 16) for a in args.cmd_args])
 
     elif cmd == Actions.VERIFY:
-        f_p.reset()
-        f_p.verify(args.addr, [i & 0xff for i in range(0x100)])
+        reset()
+        bad = f_p.verify_image(args.firmware, args.addr, mode = args.mode)
+        for _s, _e in bad:
+            print("Differs: {:x} - {:x}".format(_s, _e))
+        if bad:
+            raise VerifyError("Flash differs from {} in {} ranges".format(args.firmware, len(bad)))
+        print("Verify OK")
+    elif cmd == Actions.DIFF:
+        reset()
+        pages = f_p.diff_pages(args.firmware, args.addr, page = args.page)
+        for _s, _e in pages:
+            print("{:x} - {:x}".format(_s, _e))
+        print("{} pages differ".format(len(pages)))
+        if args.read:
+            image = Image()
+            for _s, _e in pages:
+                image.add(_s, f_p.read(_s, _e - _s + 1))
+            with open(args.read, "w") as f:
+                f.write(image.to_ihex())
     elif cmd == Actions.ERASE:
-        f_p.reset()
-        f_p.block_erase(args.addr)
+        reset()
+        _r = f_p.block_erase(args.addr)
+        if f_p.chk_return(f_p.COMMAND_BLOCK_ERASE, _r):
+            raise NoAckError("Erasing block {:x} failed: {}".format(args.addr, _r))
     elif cmd == Actions.MCU_ON:
         flashcomm.mcu_on()
-        while 1:
-            pass
     elif cmd == Actions.MCU_OFF:
         flashcomm.mcu_off()
+    elif cmd == Actions.BATCH:
+        run_batch(f_p, load_steps(args), reset)
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+
+    mcu = MCU_Type(args.mcu)
+    mode = Comm_Mode(args.mode)
+
+    # Set logging level
+    logging.basicConfig(level=log[args.log_level], format="%(filename)s:%(funcName)s: %(message)s")
+
+    f_p = create_programmer(mcu, mode, args.port, args.baud, args.gpio_flmd, args.gpio_reset, args.gpio, args.reader)
+
+    run_action(f_p, args, lambda: start_session(f_p, args.max_baud))
+
+    if Actions(args.command) in (Actions.MCU_ON, Actions.MCU_OFF):
+        # Keep the pins where they are
         while 1:
             pass
-    
-
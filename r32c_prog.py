@@ -3,7 +3,7 @@ from renesas_fpi import RenesasFlashProgrammer
 from defs import Comm_Mode, MCU_Type
 import logging
 
-from time import sleep
+from time import sleep, time
 
 class R32CProgrammer(RenesasFlashProgrammer):
     ''' 
@@ -22,6 +22,19 @@ class R32CProgrammer(RenesasFlashProgrammer):
     # TODO fill in for other R8C, ... Seems funky addresses to me
     LOCK_REG = {MCU_Type.R32C: 0xFFFFFFE8}
 
+    # Response deadlines, see RenesasFlashProgrammer.TIMEOUTS
+    TIMEOUTS = dict(RenesasFlashProgrammer.TIMEOUTS, read = (0.1, 0.0), chip_erase = (2.0, 0.05))
+
+    # Baud rate select commands, echoed back at the old rate before the bootloader switches
+    BAUD_RATES = {9600: 0xb0, 19200: 0xb1, 38400: 0xb2, 57600: 0xb3, 115200: 0xb4}
+
+    # No signature in the raw protocol, so no device profile either
+    COMMAND_SIGNATURE = None
+
+    # No checksum or verify command either, verify_image reads back
+    COMMAND_CHECKSUM = None
+    COMMAND_VERIFY = None
+
 
     def __init__(self, **kwargs):
         #super().__init__(MCU_Type.Rxx, Comm_Mode.UART2, baud_rate = 9600)
@@ -31,6 +44,7 @@ class R32CProgrammer(RenesasFlashProgrammer):
 
     def reset(self):
         ''' Takes care of the reset for the R32C. FLMD0 pin serves as CNVss/MODE '''
+        self.flashcomm.set_baud(self.sync_baud)
         self.flashcomm.reset.off()
         self.flashcomm.flmd0.on()
         sleep(0.001)
@@ -51,6 +65,21 @@ class R32CProgrammer(RenesasFlashProgrammer):
             raise ValueError("Baud rate setting failed")
         return 0
 
+    def set_baud(self, baud):
+        ''' Selects the rate, switches the host after the echo and checks the bootloader is ready (status) '''
+        self.flashcomm.send([self.BAUD_RATES[baud]])
+        _r = self.flashcomm.recv(1)
+        if _r != bytes((self.BAUD_RATES[baud],)):
+            logging.debug(_r)
+            return -1
+        sleep(0.01)
+        self.flashcomm.set_baud(baud)
+        _st = self.status()
+        if len(_st) != 2 or not _st[0] & 0x80:
+            logging.debug(_st)
+            return -1
+        return 0
+
 
     def status(self):
         ''' 
@@ -68,7 +97,16 @@ class R32CProgrammer(RenesasFlashProgrammer):
 
             '''
         self.flashcomm.send([self.GET_STATUS])
-        return self.flashcomm.recv(2)
+        return self.recv_raw(2, "status")
+
+    def probe(self):
+        ''' True if the bootloader still answers the status command and is ready '''
+        try:
+            _st = self.status()
+        except (ValueError, OSError) as e:
+            logging.debug(e)
+            return False
+        return len(_st) == 2 and bool(_st[0] & 0x80)
 
     def clr_status(self):
         '''
@@ -82,11 +120,30 @@ class R32CProgrammer(RenesasFlashProgrammer):
         '''
         a = self.LOCK_REG[self.mcu_type]
         self.flashcomm.send([self.CHIP_UNLOCK, a & 0xff, (a >> 0x8) & 0xff, (a >> 0x10) & 0xff, 0x7] + code)
+        return self.wait_ready("status")
 
-        sleep(0.02)
-        _st = self.status()
+    def recv_raw(self, n_bytes, op):
+        '''
+            Reads the n_bytes of an unframed response, for as long as op may take
+        '''
+        deadline = time() + self.cmd_timeout(op, n_bytes)
+        _r = b''
+        while len(_r) < n_bytes:
+            _r += self.flashcomm.recv(n_bytes - len(_r))
+            if time() >= deadline:
+                break
+        return _r
 
-        return _st
+    def wait_ready(self, op, n_bytes = 0):
+        '''
+            Polls the status until the bootloader is ready (SRD1 bit 7) or the deadline of op has passed.
+            Returns the last status
+        '''
+        deadline = time() + self.cmd_timeout(op, n_bytes)
+        while True:
+            _st = self.status()
+            if (len(_st) == 2 and _st[0] & 0x80) or time() >= deadline:
+                return _st
 
          
 
@@ -95,24 +152,24 @@ class R32CProgrammer(RenesasFlashProgrammer):
             Issue a single read command to get a page (0x100 byte)
         '''
         self.flashcomm.send([self.PAGE_READ, (addr >> 0x8) & 0xff, (addr >> 0x10) & 0xff])
-        sleep(0.5)
-        _r = self.flashcomm.recv(0x100)
-        return _r
+        return self.recv_raw(0x100, "read")
 
-    def read(self, addr_start, n_bytes, out_file = None):
+    def read_stream(self, addr_start, n_bytes):
+        ''' Unlocks the chip and reads page by page, the page read ignores the low address byte '''
         self.chip_unlock()
-        _firm = b''
-        for _i in range(addr_start, addr_start + n_bytes, 0x100):
-            _chunk = self.read_page(_i)
-            _firm += _chunk
+        addr_end = addr_start + n_bytes
+        for _p in range(addr_start & ~0xff, addr_end, 0x100):
+            _chunk = self.read_page(_p)
+            _s = max(addr_start, _p)
+            yield _s, memoryview(_chunk)[_s - _p:addr_end - _p]
             if len(_chunk) != 0x100:
-                logging.error(f"Chunk {_i:04x} read not 0x100 aligned")
-                return _firm
-        return _firm
+                logging.error(f"Chunk {_p:04x} read not 0x100 aligned")
+                return
 
 
     def erase_chip(self):
         self.flashcomm.send([0xa7, 0xd0])
+        return self.wait_ready("chip_erase", self.get_layout().size())
 
 
 
@@ -8,6 +8,8 @@ from defs import MCU_Type, Comm_Mode
 class R78K0Programmer(RenesasFlashProgrammer):
     ''' Class to program the 8-bit 78k0 MCUs '''
 
+    ''' Baud rate set (0x9a) codes of the 78K0/Kx2 '''
+    BAUD_RATES = {115200: 0x00, 250000: 0x01, 500000: 0x02, 1000000: 0x03}
 
     def __init__(self, **kwargs):
         super().__init__(MCU_Type.R78K0, **kwargs)
@@ -21,3 +23,7 @@ class R78K0Programmer(RenesasFlashProgrammer):
         if ret[0] == 0x06:
             return 0
         return -1
+
+    def get_blk_size(self, addr):
+        ''' A data frame holds at most 0x100 bytes here (1 byte length) '''
+        return 0x100
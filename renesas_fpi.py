@@ -1,10 +1,15 @@
 from time import sleep, time
 import logging
+import mmap
 import sys
-import numpy
 
 from defs import *
-from flashcomm import RenesasFlashComm
+from flashcomm import RenesasFlashComm, run_steps, stream_steps
+from checksum import image_checksum
+from layout import FlashLayout, LAYOUTS, merge_ranges
+from image import Image
+from journal import DumpJournal, JOURNAL_CHUNK
+from device import DeviceProfile, load_profile, save_profile
 
 
 
@@ -46,6 +51,26 @@ class RenesasFlashProgrammer():
     STATUS_BUSY              = 0xff
 
     BLK_SIZE                =   0x40       # For data frames TODO should possible do this in flashcomm
+    CHECKSUM_BITS           =   16         # Width of the area checksum returned by COMMAND_CHECKSUM
+    STATUS_POLL_INTERVAL    =   (0.0005, 0.01)  # Wait between status polls, doubling from the first to the second (s)
+    VERIFY_MODES            =   ("checksum", "device", "readback")  # Cheapest first, see verify_image
+    SIG_DATA_FLASH_END      =   False      # The signature has the data flash end after the code flash end (rfpi.md)
+
+    ''' Response deadline per operation: (fixed s, s per KiB worked on). The time on the wire is added (cmd_timeout) '''
+    TIMEOUTS = {
+        "status":       (0.1, 0.0),
+        "erase":        (0.5, 0.05),
+        "chip_erase":   (1.0, 0.05),
+        "blank_check":  (0.1, 0.02),
+        "program":      (0.2, 0.4),
+        "verify":       (0.1, 0.1),
+        "checksum":     (0.1, 0.01),
+        "read":         (0.5, 0.0),
+        "test":         (2.0, 0.0),
+    }
+
+    ''' Baud rates COMMAND_BAUD_RATE_SET can switch to and their code, set per family. None: stay at the sync rate '''
+    BAUD_RATES = None
 
     def __init__(self, mcu_type, flashcomm = None):
         if not flashcomm:
@@ -57,21 +82,47 @@ class RenesasFlashProgrammer():
         self.timeout = 0.01
         # How big are the flash blocks 
         self.fl_block_size = 0x1000
+        # Supply voltage x10 for COMMAND_BAUD_RATE_SET (0x32: 5V, 0x21: 3.3V)
+        self.voltage = 0x32
+        # The bootloader always starts at this rate, negotiate_baud may switch to a faster one
+        self.sync_baud = flashcomm.baud_rate
 
         self.mcu_type = mcu_type
+        # Erase block layout
+        self.layout = FlashLayout(LAYOUTS[mcu_type]) if mcu_type in LAYOUTS else None
+        # The device seen last time (identify checks it's still the same one)
+        self.profile = None
+        _p = load_profile(flashcomm.type, flashcomm.comm_mode, self.SIG_DATA_FLASH_END)
+        if _p:
+            self.apply_profile(_p)
 
 
     def reset(self):
         ''' Generic reset sequence - initialise the communication (depending on target and comm_mode) and then send the reset command '''
-        r = self.flashcomm.reset_bl() # execute the right reset 
+        return self.run(self.reset_steps())
+
+    def reset_steps(self):
+        ''' reset() as protocol steps. 0 if the reset command is acknowledged, -1 if not '''
+        self.flashcomm.set_baud(self.sync_baud)
+        r = yield from self.flashcomm.reset_steps() # execute the right reset 
         if r:
             raise ValueError("Bootloader mode reset failed...")
         try:
-            self.reset_command()
+            _r = yield from self.reset_command_steps()
         except (NoResponseError, InvalidHeaderError, InvalidFooterError, InvalidChecksumError, NoAckError, InvalidFrameError) as e:
             logging.debug(e)
             return -1
-        return 0
+        return self.chk_return(self.COMMAND_RESET, _r)
+
+    def io(self, req):
+        ''' Executes one I/O request of the protocol steps, frames are received with recv() '''
+        if req[0] == IO_Op.FRAME:
+            return self.recv(req[1])
+        return self.flashcomm.io(req)
+
+    def run(self, steps):
+        ''' Runs protocol steps (see flashcomm.run_steps) on the blocking transport, returns their result '''
+        return run_steps(steps, self.io)
 
     
 
@@ -91,44 +142,121 @@ class RenesasFlashProgrammer():
             return -1
         return 0
 
-    def recv(self):
-        '''Receives and returns a dataframe, throws an exception if anything other than an ACK is observed'''
+    def status_polling(self):
+        ''' True if the response has to be asked for with the status command instead of waiting for it '''
+        return self.flashcomm.comm_mode == Comm_Mode.SPI and self.flashcomm.type == MCU_Type.R78K0   # only for SPI 78k0 - bastard
+
+    def cmd_timeout(self, op, n_bytes = 0):
+        ''' Deadline (s) for the response of op working on n_bytes, from TIMEOUTS plus the time on the wire '''
+        fixed, per_kib = self.TIMEOUTS.get(op, self.TIMEOUTS["status"])
+        bits = 8 if self.flashcomm.serial_port is None else 10
+        return fixed + per_kib * n_bytes / 0x400 + (n_bytes + 0x10) * bits / self.flashcomm.baud_rate
+
+    def complete(self, op, n_bytes = 0):
+        ''' Waits for the response of the command just sent, as long as op on n_bytes may take and no longer '''
+        return self.recv(self.cmd_timeout(op, n_bytes))
+
+    def recv(self, timeout = None):
+        '''
+            Receives and returns a dataframe, polling (with the status command where the protocol needs it) until
+            timeout (default self.timeout). Raises InvalidFrameError if nothing came
+        '''
         ret = []
         st = time()
-        while (not ret) and (time() < st + self.timeout):
+        deadline = st + (self.timeout if timeout is None else timeout)
+        poll_wait = self.STATUS_POLL_INTERVAL[0]
+        while True:
             try:
-                if self.flashcomm.comm_mode == Comm_Mode.SPI and self.flashcomm.type == MCU_Type.R78K0:
-                    self.flashcomm.send_command_frame(self.COMMAND_STATUS)  # only for SPI 78k0 - bastard 
+                if self.status_polling():
+                    self.flashcomm.send_command_frame(self.COMMAND_STATUS)
                 ret = self.flashcomm.recv_data_frame()
             except (InvalidFrameError, NoResponseError) as e:
                 pass
+            if ret or time() >= deadline:
+                break
+            if self.status_polling():
+                # Don't keep the target busy answering status frames
+                sleep(min(poll_wait, max(0.0, deadline - time())))
+                poll_wait = min(2 * poll_wait, self.STATUS_POLL_INTERVAL[1])
         if not ret:
-            raise InvalidFrameError('Didn\'t receive a frame after timeout')
+            raise InvalidFrameError('Didn\'t receive a frame after {:.2f}s'.format(time() - st))
         #if ret[0] == self.STATUS_PARAM_ERROR or ret[0] == self.STATUS_NACK:
         #    raise NoAckError("Received status {:02x}".format(ret[0]))
         return ret
 
-    def calc_timings(self):
-        """Since all devices require different timings, let's try to automatically detect these"""
-        rst_off_orig = 0.1
-        rst_time_orig = 0.0056
-        rst_cmd_orig = 0.05
-        post_flmd_orig = 0.05
-
-
-        step_size = 3
-        for flmd in range(11):
-            for rst_off in numpy.arange(0, rst_off_orig, rst_off_orig/step_size):
-                for post_flmd in numpy.arange(0, post_flmd_orig, rst_off_orig/step_size):
-                    for rst_time in numpy.arange(0, rst_time_orig, rst_time_orig/step_size):
-                        for rst_cmd in numpy.arange(0, rst_cmd_orig, rst_cmd_orig/step_size):
-                            self.flashcomm.set_timings(rst_off, rst_time, rst_cmd, post_flmd)
-                            if self.fp_mode() == 0:
-                                logging.info("Found values: RST OFF {}, POST_FLMD {}, RST_TIME {}, RST_CMD {}".format(rst_off, post_flmd, rst_time, rst_cmd)) 
-                                return
+    def reset_ok(self):
+        ''' One reset into the bootloader, True if the reset command was acknowledged '''
+        try:
+            _r = self.reset()
+        except (ValueError, OSError) as e:
+            logging.debug(e)
+            return False
+        if _r == -1:
+            return False
+        return _r == 0 or self.chk_return(self.COMMAND_RESET, _r) == 0
+
+    def reset_reliable(self, n_tries):
+        ''' True if n_tries resets in a row succeed with the current timings '''
+        for i in range(n_tries):
+            if not self.reset_ok():
+                return False
+        return True
+
+    def calc_timings(self, n_tries = 3, resolution = 0.0005, save = True):
+        '''
+            Since all devices require different timings, search the shortest ones that still reset reliably (n_tries
+            resets in a row). Coarse: the current timings are doubled until they are reliable, then every parameter
+            is tried at 0. Fine: each parameter that is needed is bisected between the last failing and the last
+            reliable value, down to resolution (s), with the parameters searched before already at their minimum.
+            The result is stored for the MCU type and comm mode, RenesasFlashComm loads it from then on
+        '''
+        fc = self.flashcomm
+        timings = fc.get_timings()
+        for i in range(4):
+            if self.reset_reliable(n_tries):
+                break
+            timings = {name: 2 * t for name, t in timings.items()}
+            logging.info("Reset not reliable, trying {}".format(timings))
+            fc.set_timings(*[timings[name] for name in fc.TIMING_PARAMS])
+        else:
+            raise NoResponseError("Reset not reliable with any of the timings tried")
+        start = dict(timings)
+
+        def _try(name, t):
+            setattr(fc, name, t)
+            ok = self.reset_reliable(n_tries)
+            logging.debug("{} = {:.4f}: {}".format(name, t, "ok" if ok else "failed"))
+            return ok
+
+        for name in fc.TIMING_PARAMS:
+            good = timings[name]
+            bad = 0.0
+            if not _try(name, 0.0):
+                while good - bad > resolution:
+                    mid = (good + bad) / 2
+                    if _try(name, mid):
+                        good = mid
+                    else:
+                        bad = mid
+            else:
+                good = 0.0
+            timings[name] = good
+            setattr(fc, name, good)
+
+        if not self.reset_reliable(n_tries):
+            logging.warning("Minimum timings {} not reliable together, keeping {}".format(timings, start))
+            timings = start
+        fc.set_timings(*[timings[name] for name in fc.TIMING_PARAMS])
+        logging.info("Timings: " + ", ".join("{} {:.4f}".format(name, t) for name, t in timings.items()))
+        if save:
+            fc.save_timings()
+        return timings
 
     def _get_addr_data(self, addr_start, addr_end, n_b = None):
         n_bytes = n_b if n_b is not None else self.n_bytes
+        for _a in (addr_start, addr_end):
+            if not 0 <= _a < 1 << (n_bytes * 8):
+                raise ValueError("Address {:x} doesn't fit in {} bytes".format(_a, n_bytes))
         return [(addr_start >> (i*8)) & 0xff for i in range(n_bytes - 1, -1, -1)] + [(addr_end >> (i*8)) & 0xff for i in range(n_bytes - 1, -1, -1)] 
 
 
@@ -141,9 +269,51 @@ class RenesasFlashProgrammer():
         # Get signature
         return self.recv()
 
+    def apply_profile(self, profile):
+        ''' Sizes the flash layout to the device, None goes back to the default layout of the MCU type '''
+        self.profile = profile
+        if self.mcu_type in LAYOUTS:
+            self.layout = FlashLayout(profile.regions(LAYOUTS[self.mcu_type]) if profile else LAYOUTS[self.mcu_type])
+
+    def identify(self):
+        '''
+            Reads and decodes the signature. The cached profile is kept if it's the same device, otherwise the new
+            one replaces it. Returns the profile (None if the protocol has no signature command)
+        '''
+        if self.COMMAND_SIGNATURE is None:
+            return self.profile
+        _p = DeviceProfile.decode(self.get_signature(), self.SIG_DATA_FLASH_END)
+        if self.profile and self.profile.signature == _p.signature:
+            return self.profile
+        if self.profile:
+            logging.info("Different device than last time")
+        _p.baud = self.flashcomm.baud_rate if self.flashcomm.baud_rate != self.sync_baud else 0
+        logging.info(str(_p))
+        self.apply_profile(_p)
+        save_profile(self.flashcomm.type, self.flashcomm.comm_mode, _p)
+        return _p
+
+    def flash_end(self, addr):
+        ''' Last address of the flash region containing addr (as large as the profile says) '''
+        r = self.get_layout().region(addr)
+        if r is None:
+            raise ValueError("Address {:x} is not in flash".format(addr))
+        return r[0] + r[1] - 1
+
     def reset_command(self):
-        self.flashcomm.send_command_frame(self.COMMAND_RESET)
-        return self.recv() 
+        return self.run(self.reset_command_steps())
+
+    def reset_command_steps(self):
+        yield (IO_Op.COMMAND, self.COMMAND_RESET)
+        return (yield (IO_Op.FRAME, None))
+
+    def probe(self):
+        ''' True if the bootloader session is still there: the reset command is answered (and changes nothing) '''
+        try:
+            return self.chk_return(self.COMMAND_RESET, self.reset_command()) == 0
+        except (ValueError, OSError) as e:
+            logging.debug(e)
+            return False
 
     def security_release(self):
         self.flashcomm.send_command_frame(self.COMMAND_SECURITY_RELEASE)
@@ -160,47 +330,139 @@ class RenesasFlashProgrammer():
 
     def test_cmd(self, cmd, args = []):
         self.flashcomm.send_command_frame(cmd, args)
-        sleep(1)
-        _r = self.recv()
+        _r = self.complete("test")
         if _r != cmd.to_bytes(1, byteorder = "big"):
             #return _r 
             logging.info("Return {}: {}".format(cmd, _r))
-        sleep(1)
-        return self.recv()
+        return self.complete("test")
+
+    def read_stream(self, addr_start, n_bytes):
+        '''
+            Reads n_bytes from addr_start, yields (address, data) for every received frame as it comes in.
+            Raises NoAckError if the read command is refused
+        '''
+        return stream_steps(self.read_stream_steps(addr_start, n_bytes), self.io)
+
+    def read_stream_steps(self, addr_start, n_bytes):
+        data = self._get_addr_data(addr_start, addr_start + n_bytes - 1)    # n_bytes - 1 because of weird alignment on the MCU - request 0-0xff to read out first 0x100 bytes
+        yield (IO_Op.COMMAND, self.COMMAND_READ, data)
+        ret = yield (IO_Op.FRAME, self.cmd_timeout("status"))
+        if self.chk_return(self.COMMAND_READ, ret):
+            raise NoAckError("Read {:x} - {:x} failed: {}".format(addr_start, addr_start + n_bytes - 1, ret))
+        addr = addr_start
+        addr_end = addr_start + n_bytes
+        while addr < addr_end:
+            yield (IO_Op.DATA, [self.STATUS_ACK])
+            dat = yield (IO_Op.FRAME, self.cmd_timeout("read", min(addr_end - addr, 0x100)))
+            logging.debug("Read {:x}: {} bytes".format(addr, len(dat)))
+            yield (IO_Op.OUT, (addr, memoryview(dat)[:addr_end - addr]))
+            addr += len(dat)
+
+    def read(self, addr_start, n_bytes):
+        ''' Reads n_bytes from addr_start into memory, use dump for large areas '''
+        buf = bytearray(n_bytes)
+        n_rcvd = 0
+        for addr, dat in self.read_stream(addr_start, n_bytes):
+            buf[addr - addr_start:addr - addr_start + len(dat)] = dat
+            n_rcvd = addr - addr_start + len(dat)
+        return bytes(buf[:n_rcvd])
+
+    def dump(self, addr_start, n_bytes, out_file, resume = True):
+        '''
+            Reads n_bytes from addr_start straight into out_file. The file is preallocated and memory mapped, every
+            frame is written at its offset as it arrives, so memory use doesn't depend on the size.
+            Progress is kept in a journal next to out_file (see journal.py): with resume, a dump that was interrupted
+            continues with the ranges that are still missing. Returns the number of bytes in the file
+        '''
+        if n_bytes <= 0:
+            open(out_file, 'wb').close()
+            return 0
+        journal = DumpJournal(out_file, addr_start, n_bytes)
+        if resume and journal.load():
+            logging.info("Resuming dump, {:x} of {:x} bytes already read".format(journal.n_done(), n_bytes))
+        with open(out_file, 'r+b' if journal.done else 'w+b') as out_f:
+            out_f.truncate(n_bytes)
+            with mmap.mmap(out_f.fileno(), n_bytes) as out_m:
+                for _s, _e in journal.missing():
+                    _mark = _s
+                    for addr, dat in self.read_stream(_s, _e - _s):
+                        _o = addr - addr_start
+                        out_m[_o:_o + len(dat)] = dat
+                        _cur = addr + len(dat)
+                        if _cur - _mark >= JOURNAL_CHUNK or _cur >= _e:
+                            out_m.flush()
+                            journal.add(_mark, _cur, out_m[_mark - addr_start:_cur - addr_start])
+                            _mark = _cur
+                    if _mark < _e:
+                        break
+        n_done = journal.n_done()
+        if n_done < n_bytes:
+            logging.warning("Only read {:x} of {:x} bytes, run again to continue".format(n_done, n_bytes))
+        else:
+            journal.remove()
+        return n_done
 
     def read_memory(self, addr_start, n_bytes, out_file = None):
         """Reads memory from the V850"""
-        data = self._get_addr_data(addr_start, addr_start + n_bytes - 1)    # n_bytes - 1 because of weird alignment on the MCU - request 0-0xff to read out first 0x100 bytes
-        self.flashcomm.send_command_frame(self.COMMAND_READ, data)
-        ret = self.flashcomm.recv_data_frame()
-        if ret[0] == 0x6:
-            if out_file:
-                with open(out_file, 'wb') as out_f:
-                    pass
-            logging.info("DJONKO DJONKO MANEEEEE")
-            self.timeout = 0.5
-            self.flashcomm.send_data_frame([0x6])
-            dat = self.recv()
-            n_rcvd = len(dat)
-            logging.info("DJONKO DJONKO ZWEI received {}".format(n_rcvd))
-            while dat:
-                if out_file:
-                    with open(out_file, 'ab') as out_f:
-                        out_f.write(dat)
-                if n_rcvd >= n_bytes:
-                    return 0
-                sleep(0.1)
-                self.flashcomm.send_data_frame([0x6])
-                dat = self.recv()
-                n_rcvd += len(dat)
-                logging.info("n_rcvd: {}\t n_bytes:{}".format(n_rcvd, n_bytes))
-        return ret
+        if out_file:
+            self.dump(addr_start, n_bytes, out_file)
+        else:
+            for _a, _d in self.read_stream(addr_start, n_bytes):
+                pass
+        return 0
 
-    def baud_rate_set(self, voltage = 0x32):
-        self.flashcomm.send_command_frame(self.COMMAND_BAUD_RATE_SET, [0x00, voltage]) # for 5V 
-        #self.flashcomm.send_command_frame(self.COMMAND_BAUD_RATE_SET, [0x00, 0x21]) # for 3.3V 
+    def baud_rate_set(self, baud = 115200, voltage = 0x32):
+        self.flashcomm.send_command_frame(self.COMMAND_BAUD_RATE_SET, [self.BAUD_RATES[baud], voltage])
         return self.recv()
 
+    def set_baud(self, baud):
+        ''' Switches the target and then the host to baud, confirmed with the reset command. 0 if it works '''
+        _r = self.baud_rate_set(baud, self.voltage)
+        if self.chk_return(self.COMMAND_BAUD_RATE_SET, _r):
+            return -1
+        sleep(0.01)
+        self.flashcomm.set_baud(baud)
+        try:
+            _r = self.reset_command()
+        except (NoResponseError, InvalidHeaderError, InvalidFooterError, InvalidChecksumError, InvalidFrameError) as e:
+            logging.debug(e)
+            return -1
+        return self.chk_return(self.COMMAND_RESET, _r)
+
+    def negotiate_baud(self, max_baud):
+        '''
+            Switches to the highest of BAUD_RATES up to max_baud that both the target and the host UART can do,
+            falling back one rate at a time (the bootloader is reset in between). Run it right after reset.
+            Returns the rate in use
+        '''
+        if self.flashcomm.serial_port is None:
+            return self.flashcomm.baud_rate
+        if not self.BAUD_RATES:
+            logging.info("No baud rate table for {}, staying at {} baud".format(self.flashcomm.type.value, self.flashcomm.baud_rate))
+            return self.flashcomm.baud_rate
+        rates = sorted((b for b in self.BAUD_RATES if self.sync_baud < b <= max_baud), reverse = True)
+        # The rate that worked for this device last time goes first
+        if self.profile and self.profile.baud in rates:
+            rates.remove(self.profile.baud)
+            rates.insert(0, self.profile.baud)
+        for baud in rates:
+            try:
+                if self.set_baud(baud) == 0:
+                    logging.info("Switched to {} baud".format(baud))
+                    self.remember_baud(baud)
+                    return baud
+            except (ValueError, OSError) as e:
+                logging.debug(e)
+            logging.info("{} baud failed, trying a lower rate".format(baud))
+            self.reset()
+        self.remember_baud(0)
+        return self.flashcomm.baud_rate
+
+    def remember_baud(self, baud):
+        if self.profile and self.profile.baud != baud:
+            self.profile.baud = baud
+            save_profile(self.flashcomm.type, self.flashcomm.comm_mode, self.profile)
+
 
     def get_version(self):
         self.flashcomm.send_command_frame(self.COMMAND_VERSION_GET)
@@ -214,113 +476,176 @@ class RenesasFlashProgrammer():
 
     def get_checksum(self, addr_start, addr_end, callback_func = None):
         """Gets checksum of a certain address area"""
+        return self.run(self.get_checksum_steps(addr_start, addr_end, callback_func))
+
+    def get_checksum_steps(self, addr_start, addr_end, callback_func = None):
+        ''' Returns the checksum frame, or the status frame if the command is refused '''
         data = self._get_addr_data(addr_start, addr_end)
-        self.flashcomm.send_command_frame(self.COMMAND_CHECKSUM, data, callback_func)
+        yield (IO_Op.COMMAND, self.COMMAND_CHECKSUM, data, callback_func)
         # Get the status frame
-        _ret = self.recv()
+        _ret = yield (IO_Op.FRAME, self.cmd_timeout("status"))
         if self.chk_return(self.COMMAND_CHECKSUM, _ret):
             return _ret
-        # Get the checksum
-        chk = self.flashcomm.recv_data_frame()  # Checksum does not need status frame for some reason
-        return chk
+        # Get the checksum - does not need status frame for some reason
+        return (yield (IO_Op.FRAME, self.cmd_timeout("checksum", addr_end - addr_start + 1)))
 
-    def verify(self, addr_start, bin_data, n_bytes = 0):
+    def verify(self, addr_start, bin_data, n_bytes = 0, prefix = b''):
         '''Verifies that the data is programmed in the range start_addr:end_addr'''
-        self.timeout = 0.1
+        if self.COMMAND_VERIFY is None:
+            raise ValueError("Device verify not supported on {}, use verify_image".format(self.mcu_type.value))
         if not n_bytes:
             n_bytes = len(bin_data)
         data = self._get_addr_data(addr_start, addr_start + n_bytes - 1)
         self.flashcomm.send_command_frame(self.COMMAND_VERIFY, data)
         # Check if ACK received, return if no bin_data provided
-        _ret = self.recv()
+        _ret = self.complete("status")
         if self.chk_return(self.COMMAND_VERIFY, _ret) or not bin_data:
             return _ret
-        self.flashcomm.send_data_frame(bin_data)
-        sleep(0.1)
-        return self.recv()
+        self.flashcomm.send_data_frame(bin_data, prefix)
+        return self.complete("verify", len(bin_data))
 
-    def program(self, addr_start, bin_data, n_bytes = 0):
+    def program(self, addr_start, bin_data, n_bytes = 0, prefix = b''):
         '''Programs the binary data to the specified address (in chunks of 0x100 bytes)'''
-        self.timeout = 0.1
-        # Set the timeout since programming takes longer
+        return self.run(self.program_steps(addr_start, bin_data, n_bytes, prefix))
+
+    def program_steps(self, addr_start, bin_data, n_bytes = 0, prefix = b''):
         if not n_bytes:
             n_bytes = len(bin_data)
         data = self._get_addr_data(addr_start, addr_start + n_bytes - 1)
-        self.flashcomm.send_command_frame(self.COMMAND_PROGRAMMING, data)
-        sleep(0.01)
+        yield (IO_Op.COMMAND, self.COMMAND_PROGRAMMING, data)
         # Check if ACK received, return if no data provided
-        _ret = self.recv()
+        _ret = yield (IO_Op.FRAME, self.cmd_timeout("status"))
         if self.chk_return(self.COMMAND_PROGRAMMING, _ret):
             return _ret
-        self.flashcomm.send_data_frame(bin_data)
-        sleep(0.4)
-        ret = self.recv()
-        logging.info(f"{ret}")
+        yield (IO_Op.DATA, bin_data, prefix)
+        ret = yield (IO_Op.FRAME, self.cmd_timeout("program", len(bin_data)))
+        logging.debug(f"{ret}")
         return ret
 
+    def program_image_steps(self, image, blocks):
+        ''' Programs the parts of the image in the (erased) blocks, raises NoAckError if a frame is refused '''
+        for _s, _e in blocks:
+            for _ps, _pe in image.pieces(_s, _e):
+                blk_size = self.get_blk_size(_ps)
+                for _a in range(_ps, _pe + 1, blk_size):
+                    _r = yield from self.program_steps(_a, image.view(_a, min(_a + blk_size - 1, _pe)))
+                    if self.chk_return(self.COMMAND_PROGRAMMING, _r):
+                        raise NoAckError("Programming {:x} failed: {}".format(_a, _r))
+
 
     def recv_uart(self, baud = 115200, out_file = None):
         '''Reads the bytes from the UART after the dump routine has been uploaded'''
         self.flashcomm.serial_port.baudrate = baud
-        if out_file:
-            with open(out_file, 'wb') as out_f:
-                pass
+        out_f = open(out_file, 'wb') if out_file else None
         self.flashcomm.normal_mode()
         sleep(0.1)
         RECV_SIZE = 0x1000
-        dat = self.flashcomm.recv(RECV_SIZE)
-        while dat:
-            if out_file:
-                with open(out_file, 'ab') as out_f:
-                    out_f.write(dat)
+        try:
             dat = self.flashcomm.recv(RECV_SIZE)
+            while dat:
+                if out_f:
+                    out_f.write(dat)
+                dat = self.flashcomm.recv(RECV_SIZE)
+        finally:
+            if out_f:
+                out_f.close()
         self.flashcomm.mcu_off()
 
     def overwrite_bootl(self, firmware):
         '''Overwrites the boot section with the firmware contained in firm_file'''
-        self.timeout = 0.5  # set timeout large enough
         if self.fp_mode() != 0:
             logging.error("Flash programming mode could not be activated")
             return
-        with open(firmware, 'rb') as dump_routine:
-            bytes_read = list(dump_routine.read())
-        # Fill in missing FF's to align to page size
-        l = len(bytes_read)
-        for i in range(l, (l | 0xff) + 1):
-            bytes_read.append(0xff)
-        for i in range(0, len(bytes_read), self.fl_block_size):
-            self.block_erase(i)
-        sleep(0.1)
-        for i in range(0, len(bytes_read), 0x100):
-            self.program(i, bytes_read[i:i+0x100])
-            sleep(0.1)
-
-    def block_erase(self, addr_start):
-        '''Erases block of 0x100 bytes starting from addr_start'''
-        t_o = self.timeout
-        self.timeout = 0.3
-
-        # Align address to a 1kB boundary
-        data = self._get_addr_data(addr_start, addr_start + self.fl_block_size - 1)
+        image = self.load_image(firmware)
+        self.erase_blocks(self.get_layout().blocks_for(image.ranges()), chip_erase = False)
+        for _s, _e in image.ranges():
+            for i in range(_s, _e + 1, 0x100):
+                _r = self.program(i, image.view(i, min(i + 0xff, _e)))
+                if self.chk_return(self.COMMAND_PROGRAMMING, _r):
+                    raise NoAckError("Programming {:x} failed: {}".format(i, _r))
+
+    def get_layout(self):
+        ''' Erase block layout, falls back to blocks of fl_block_size over the whole address range '''
+        if self.layout is None:
+            return FlashLayout([(0x0, 1 << (8 * self.n_bytes), self.fl_block_size)])
+        return self.layout
+
+    def blank_check(self, addr_start, addr_end):
+        '''Returns True if addr_start - addr_end is erased'''
+        return self.run(self.blank_check_steps(addr_start, addr_end))
+
+    def blank_check_steps(self, addr_start, addr_end):
+        yield (IO_Op.COMMAND, self.COMMAND_BLOCK_BLANK_CHECK, self._get_addr_data(addr_start, addr_end))
+        _r = yield (IO_Op.FRAME, self.cmd_timeout("blank_check", addr_end - addr_start + 1))
+        return self.chk_return(self.COMMAND_BLOCK_BLANK_CHECK, _r) == 0
+
+    def erase_blocks(self, blocks, chip_erase = None):
+        '''
+            Erases the (start, end) erase blocks, each exactly once. Blocks that blank check as erased are skipped.
+            chip_erase: True erases the whole chip instead (everything outside the blocks too), False never does,
+            None only when the blocks are the whole flash anyway. Returns True if the chip was erased
+        '''
+        return self.run(self.erase_blocks_steps(blocks, chip_erase))
+
+    def erase_blocks_steps(self, blocks, chip_erase = None):
+        if not blocks:
+            return False
+        _whole = sum(e - s + 1 for s, e in blocks) >= self.get_layout().size()
+        if self.COMMAND_CHIP_ERASE is not None and (chip_erase or (chip_erase is None and _whole)):
+            if _whole:
+                logging.info("Erasing the whole flash - chip erase")
+            else:
+                logging.warning("Chip erase: the flash outside the image (data flash, gaps) is erased too")
+            _r = yield from self.chip_erase_steps()
+            if not self.chk_return(self.COMMAND_CHIP_ERASE, _r):
+                return True
+            logging.warning("Chip erase failed ({}), erasing per block".format(_r))
+
+        n_blank = 0
+        for s, e in blocks:
+            if self.COMMAND_BLOCK_BLANK_CHECK is not None and (yield from self.blank_check_steps(s, e)):
+                n_blank += 1
+                continue
+            _r = yield from self.block_erase_steps(s, e)
+            if self.chk_return(self.COMMAND_BLOCK_ERASE, _r):
+                raise NoAckError("Erasing block {:x} - {:x} failed: {}".format(s, e, _r))
+        logging.info("Erased {} blocks, {} already blank".format(len(blocks) - n_blank, n_blank))
+        return False
+
+    def block_erase(self, addr_start, addr_end = None):
+        '''Erases the block starting from addr_start (fl_block_size if no end given)'''
+        return self.run(self.block_erase_steps(addr_start, addr_end))
+
+    def block_erase_steps(self, addr_start, addr_end = None):
+        if addr_end is None:
+            addr_end = addr_start + self.fl_block_size - 1
+        data = self._get_addr_data(addr_start, addr_end)
         if self.flashcomm.type == MCU_Type.RL78:
             data = data[::]
-        self.flashcomm.send_command_frame(self.COMMAND_BLOCK_ERASE, data)
-        _r = self.recv()
-
-        self.timeout = t_o
+        yield (IO_Op.COMMAND, self.COMMAND_BLOCK_ERASE, data)
+        _r = yield (IO_Op.FRAME, self.cmd_timeout("status"))
 
         if _r[0] != 0x06:  
             return _r
 
+        # Second status frame once the erase is done
+        return (yield (IO_Op.FRAME, self.cmd_timeout("erase", addr_end - addr_start + 1)))
 
-        sleep(0.2)
-        _r = self.recv()
-        return _r
 
+    def chk_return(self, cmd, ret):
+        ''' Checks the status frame of a command, 0 if ACK '''
+        if not ret:
+            return -1
+        if ret[0] == self.STATUS_ACK:
+            return 0
+        return -1
 
     def chip_erase(self):
-        self.flashcomm.send_command_frame(self.COMMAND_CHIP_ERASE)
-        return self.recv()
+        return self.run(self.chip_erase_steps())
+
+    def chip_erase_steps(self):
+        yield (IO_Op.COMMAND, self.COMMAND_CHIP_ERASE)
+        return (yield (IO_Op.FRAME, self.cmd_timeout("chip_erase", self.get_layout().size())))
 
     def security_set(self, sec_flag, boot_blk_no, fswstl = None, fswsth = None, fswel = None, fsweh = None): 
         ''' Sets the security settings of the MCU
@@ -354,49 +679,217 @@ class RenesasFlashProgrammer():
         logging.info("Length: %d" % len(ret))
 
 
+    def read_checksum(self, addr_start, addr_end):
+        '''Gets the checksum of addr_start - addr_end from the device as an int'''
+        return self.run(self.read_checksum_steps(addr_start, addr_end))
+
+    def read_checksum_steps(self, addr_start, addr_end):
+        # get_checksum returns the status frame on a NACK, which can be as long as a checksum (RH850)
+        yield (IO_Op.COMMAND, self.COMMAND_CHECKSUM, self._get_addr_data(addr_start, addr_end))
+        _r = yield (IO_Op.FRAME, self.cmd_timeout("status"))
+        if self.chk_return(self.COMMAND_CHECKSUM, _r):
+            raise NoAckError("Checksum {:x} - {:x} failed: {}".format(addr_start, addr_end, _r))
+        chk = yield (IO_Op.FRAME, self.cmd_timeout("checksum", addr_end - addr_start + 1))
+        if len(chk) != self.CHECKSUM_BITS // 8:
+            raise NoAckError("Checksum {:x} - {:x} failed: {}".format(addr_start, addr_end, chk))
+        return int.from_bytes(chk, "big")
+
     def get_checksums(self, start_addr, end_addr):
         '''Gets all (legitimate) checksums from start_addr to end_addr'''
         chks = []
         for i in range(start_addr, end_addr, 0x100):
-            chk = self.get_checksum(i, i + 0xff)
-            chksum = (chk[0] << 8) | chk[1]
+            chksum = self.read_checksum(i, i + 0xff)
             chks.append(chksum)
             print('[{:04x}]: {:04x}'.format(i, chksum))
-            sleep(0.01)
         return chks
 
-    def verify_bin(self, binary, addr_start=0):
-        with open(binary, 'rb') as dump_routine:
-            bytes_read = list(dump_routine.read())
-        # Fill in missing FF's to align to page size
-        l = len(bytes_read)
-        for i in range(l, (l | 0xff) + 1):
-            bytes_read.append(0xff)
-        for i in range(0, len(bytes_read), 0x400):
-            logging.info("Verifying block {:x}".format(i))
-            if self.verify(i + addr_start , i + addr_start + 0x3ff, bytes_read[i:i+0x400])[1] != 0x6:
-                logging.error("Verify error!")
-            sleep(0.2)
+    def host_checksums(self, image, start_addr, end_addr, addr_base = 0):
+        '''Calculates the checksums get_checksums would return for an image loaded at addr_base'''
+        return [image_checksum(image, i, i + 0xff, addr_base, bits = self.CHECKSUM_BITS) for i in range(start_addr, end_addr, 0x100)]
+
+    def expected_checksum(self, image, addr_start, addr_end):
+        '''
+            The checksum read_checksum returns for addr_start - addr_end once the image is programmed. Bytes of the
+            range the image doesn't cover count as erased (flash erases the whole block around a segment)
+        '''
+        return image.checksum(addr_start, addr_end, bits = self.CHECKSUM_BITS)
+
+    def verify_modes(self):
+        ''' The VERIFY_MODES the protocol has commands for, cheapest first '''
+        cmds = {"checksum": self.COMMAND_CHECKSUM, "device": self.COMMAND_VERIFY, "readback": self.COMMAND_READ}
+        return [m for m in self.VERIFY_MODES if cmds[m] is not None]
+
+    def region_ranges(self, ranges):
+        ''' The (start, end) ranges split where a flash region ends, a checksum command can't span two '''
+        layout = self.get_layout()
+        split = []
+        for _s, _e in ranges:
+            while _s <= _e:
+                r = layout.region(_s)
+                if r is None:
+                    raise ValueError("{:x} - {:x} is not in flash".format(_s, _e))
+                split.append((_s, min(_e, r[0] + r[1] - 1)))
+                _s = split[-1][1] + 1
+        return split
+
+    def checksum_diff(self, image, ranges, unit):
+        '''
+            The units of the ranges whose checksum on the device differs from the image. unit is the size (int, or
+            function of the address like get_program_align) the ranges are made of, rounded up to a multiple of the
+            program unit since a unit is only programmed as a whole. Each range is checksummed as a whole and only halves that differ are bisected further, so k differing units out of n cost about
+            k * log2(n) checksum commands. The area checksum is a sum, so the checksum of the second half follows
+            from the whole and the first half without a command
+        '''
+        _unit = unit if callable(unit) else (lambda addr: unit)
+        def unit_size(addr):
+            _a = self.get_program_align(addr)
+            return max(_a, -(-_unit(addr) // _a) * _a)
+        mask = (1 << self.CHECKSUM_BITS) - 1
+        bad = []
+        n_cmds = 0
+        todo = [(_s, _e, None) for _s, _e in reversed(ranges)]
+        while todo:
+            _s, _e, chk = todo.pop()
+            if chk is None:
+                chk = self.read_checksum(_s, _e)
+                n_cmds += 1
+            if chk == self.expected_checksum(image, _s, _e):
+                continue
+            _u = unit_size(_s)
+            n_units = -(-(_e - _s + 1) // _u)
+            if n_units <= 1:
+                bad.append((_s, _e))
+                continue
+            _m = _s + (n_units // 2) * _u
+            first = self.read_checksum(_s, _m - 1)
+            n_cmds += 1
+            todo.append((_m, _e, (chk - first) & mask))
+            todo.append((_s, _m - 1, first))
+        logging.info("{:x} of {:x} bytes differ, {} checksum commands".format(
+                     sum(e - s + 1 for s, e in bad), sum(e - s + 1 for s, e in ranges), n_cmds))
+        return bad
+
+    def diff_pages(self, binary, addr = 0, page = None):
+        '''
+            The (start, end) pages of the image whose content on the device differs, found with checksum_diff.
+            page is the size to narrow it down to, by default the program unit (get_program_align). A page that isn't
+            a multiple of the program unit is rounded up to one
+        '''
+        image = self.load_image(binary, addr)
+        if page:
+            for _s, _e in self.region_ranges(image.ranges()):
+                if page % self.get_program_align(_s):
+                    logging.warning("Page {:x} isn't a multiple of the program unit {:x} at {:x}, rounding it up".format(
+                                    page, self.get_program_align(_s), _s))
+                    break
+        return self.checksum_diff(image, self.region_ranges(image.ranges()), page or self.get_program_align)
+
+    def verify_image(self, binary, addr = 0, mode = None):
+        '''
+            Compares the flash with the image, addr is the load address of raw binaries. mode is one of
+            verify_modes(), by default the cheapest:
+                checksum    one checksum command per flash region the image covers, compared with expected_checksum.
+                            A region that differs is bisected down to the pages that differ (diff_pages)
+                device      the image is sent and the device compares it (COMMAND_VERIFY), as slow as programming
+                readback    the image area is read and compared on the host
+            Returns the (start, end) ranges that differ, an empty list if the flash holds the image
+        '''
+        image = self.load_image(binary, addr)
+        modes = self.verify_modes()
+        mode = mode or modes[0]
+        if mode not in modes:
+            raise ValueError("{} has no {} verify, only {}".format(self.mcu_type.value, mode, ", ".join(modes)))
+        _st = time()
+        bad = getattr(self, "_verify_" + mode)(image)
+        logging.info("Verified {:x} bytes ({}) in {:.2f}s: {}".format(image.size(), mode, time() - _st,
+                     "{} ranges differ".format(len(bad)) if bad else "ok"))
+        return bad
+
+    def _verify_checksum(self, image):
+        return merge_ranges(self.diff_pages(image))
+
+    def _verify_device(self, image):
+        bad = []
+        for _s, _e in self.region_ranges(image.ranges()):
+            blk_size = self.get_blk_size(_s)
+            for _a in range(_s, _e + 1, blk_size):
+                _ae = min(_a + blk_size - 1, _e)
+                _r = self.verify(_a, image.view(_a, _ae))
+                if self.chk_return(self.COMMAND_VERIFY, _r) or len(_r) < 2:
+                    raise NoAckError("Verify {:x} - {:x} failed: {}".format(_a, _ae, _r))
+                if _r[1] != self.STATUS_ACK:
+                    bad.append((_a, _ae))
+        return merge_ranges(bad)
+
+    def _verify_readback(self, image):
+        bad = []
+        for _s, _e in self.region_ranges(image.ranges()):
+            for _a, dat in self.read_stream(_s, _e - _s + 1):
+                if dat != image.view(_a, _a + len(dat) - 1):
+                    bad.append((_a, _a + len(dat) - 1))
+        return merge_ranges(bad)
 
     def get_blk_size(self, addr):
         ''' Default block size '''
         return 0x2000
 
-    def flash(self, addr, binary):
-        ''' Flashes the binary to the MCU '''
-        with open(binary, 'rb') as _b:
-            _firmware = list(_b.read())
-        _len = len(_firmware)
-        blk_size = self.get_blk_size(addr)
+    def get_program_align(self, addr):
+        ''' Smallest unit that can be programmed at addr, image segments are padded to it '''
+        return 0x100
 
-        if _len & 0xff != 0:
-            for _i in range(_len, (_len | 0xff) + 1):
-                _firmware.append(0xff)
-
-        count = 0
-        for _i in range(addr, addr + len(_firmware), blk_size):
-            # We erase the block first - the erase block size is often different to the program block size, but we can just ignore the errors here
-            self.block_erase(_i) 
-            self.program(_i, _firmware[count:count + blk_size])
-            count += blk_size
+    def load_image(self, binary, addr = 0):
+        '''
+            Loads a raw binary (at addr), Intel HEX, S-record or ELF file and pads every segment with 0xff to the
+            program granularity. Only the populated parts of the image are erased, programmed and verified.
+            An Image is used as it is, so one loaded here can be shared by several sessions (gang.py)
+        '''
+        if isinstance(binary, Image):
+            return binary
+        return Image.load(binary, base = addr).align(self.get_program_align)
 
+    def flash(self, addr, binary, diff = False, chip_erase = False):
+        '''
+            Flashes the image to the MCU, addr is the load address of raw binaries. Every erase block a segment
+            touches is erased once (see erase_blocks), gaps between the segments are left alone. The chip is only
+            erased as a whole if the image covers all of the flash, or with chip_erase (which erases the gaps too).
+            With diff, the blocks whose checksum on the device already matches the image are skipped. The blocks
+            that differ are found by bisection (checksum_diff), not with a checksum command per block. It never
+            erases the chip
+        '''
+        if diff and chip_erase:
+            raise ValueError("A chip erase would also erase the blocks diff skips")
+        image = self.load_image(binary, addr)
+        if not image.segments:
+            raise InvalidImageError("{} contains no data".format(binary))
+        layout = self.get_layout()
+        for _s, _e in image.ranges():
+            if layout.region(_s) is None or layout.region(_e) is None:
+                raise ValueError("Image segment {:x} - {:x} is not in flash".format(_s, _e))
+        all_blocks = layout.blocks_for(image.ranges())
+        _partial = [b for b in all_blocks if image.pieces(*b) != [b]]
+        if _partial:
+            logging.warning("{} erase blocks are only partly covered by the image, the rest of them will be erased".format(len(_partial)))
+
+        n_skipped = 0
+        t_checksum = 0
+        blocks = all_blocks
+        if diff:
+            _st = time()
+            _bad = self.checksum_diff(image, self.region_ranges(merge_ranges(all_blocks)), lambda a: layout.region(a)[2])
+            blocks = layout.blocks_for(_bad)
+            n_skipped = len(all_blocks) - len(blocks)
+            t_checksum = time() - _st
+
+        _st = time()
+        if self.erase_blocks(blocks, chip_erase = False if diff else (chip_erase or None)):
+            # Chip erase also took the skipped blocks
+            blocks = all_blocks
+        self.run(self.program_image_steps(image, blocks))
+        t_programming = time() - _st
+
+        if diff:
+            if blocks:
+                logging.info("Skipped {} of {} blocks, saved ~{:.1f}s (checksums took {:.1f}s)".format(
+                    n_skipped, n_skipped + len(blocks), n_skipped * t_programming / len(blocks), t_checksum))
+            else:
+                logging.info("Skipped all {} blocks, image already programmed (checksums took {:.1f}s)".format(n_skipped, t_checksum))
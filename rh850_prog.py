@@ -17,13 +17,22 @@ class RH850Programmer(RenesasFlashProgrammer):
     COMMAND_ID_CODE         =   0x30
     COMMAND_RFO             =   0x27
     COMMAND_WFO             =   0x26
+    COMMAND_SIGNATURE       =   0x3a
+
+    ''' No chip erase, and 0x32 is the frequency set on the RH850. 0x13 is programming, so no verify command either '''
+    COMMAND_CHIP_ERASE          =   None
+    COMMAND_BLOCK_BLANK_CHECK   =   None
+    COMMAND_VERIFY              =   None
 
 
     ''' Unsure about these commands '''
     CHIP_INFO               =   0x3a
 
+    ''' The bit rate is sent as a 32 bit number (cmd_34), these are the ones tried when negotiating '''
+    BAUD_RATES              =   (115200, 250000, 500000, 1000000)
+
 
-    def __init__(self, **kwargs):
+    def __init__(self, osc_freq = 0xf42400, **kwargs):
         super().__init__(MCU_Type.RH850, **kwargs)
         logging.info("RH850 instance initiated...")
         # Device specifics 
@@ -31,86 +40,93 @@ class RH850Programmer(RenesasFlashProgrammer):
         self.n_bytes = 4
         self.fl_block_size = 0x2000
 
-        # TODO adjust this based on chip
-        self.freq = 0xf42400
+        # Oscillator frequency (16MHz by default). TODO adjust int_freq based on chip
+        self.freq = osc_freq
         self.int_freq = 0x05b8d800
+        # Rate cmd_34 switches to after the baud sync
+        self.baud = self.sync_baud
+
+    def two_phase_steps(self, cmd, data = [], timeout = None):
+        ''' Command, status frame [cmd], then [cmd] as data frame to get the result (which starts with cmd) '''
+        yield (IO_Op.COMMAND, cmd, data)
+        _r = yield (IO_Op.FRAME, timeout)
+        if self.chk_return(cmd, _r):
+            raise NoAckError("Command {:02x} failed: {}".format(cmd, _r))
+        yield (IO_Op.DATA, [cmd])
+        return (yield (IO_Op.FRAME, timeout))
 
     def rfo(self):
         ''' Read flash options '''
-        self.flashcomm.send_command_frame(self.COMMAND_RFO)
-        _r = self.recv()
-        if _r != b'\x27':
-            raise ValueError("sheit")
-        self.flashcomm.send_data_frame([self.COMMAND_RFO])
-        _r = self.recv()
-        return _r
+        return self.run(self.two_phase_steps(self.COMMAND_RFO))
 
     def wfo(self, option_bytes = [0xcf, 0xff, 0x27, 0xba, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff]):
         ''' Write Flash options '''
         self.flashcomm.send_command_frame(self.COMMAND_WFO, option_bytes)
-        sleep(0.5)
-        _r = self.recv()
+        _r = self.complete("program", len(option_bytes))
         if _r[0] != self.COMMAND_WFO:
             raise ValueError("Error")
         return _r
         
     
-    def freq_set(self):
-        '''Not quite figured out what the arguments to this are. These hardcoded values set the baud rate to 9600 with an oscillator of 16MHz '''
+    def freq_set_steps(self):
+        '''Sets the oscillator (freq) and internal (int_freq) frequency, the bit rate is derived from them '''
         #self.flashcomm.send_command_frame(0x32, [0, 0x7a, 0x12, 0x00, 0x04, 0xc4, 0xb4, 0x00]) # for 57600
         #self.flashcomm.send_command_frame(0x32, [0, 0xf4, 0x24, 0x00, 0x04, 0xc4, 0xb4, 0x00]) # for 9600 (f42400 = 16000000)
         #self.flashcomm.send_command_frame(0x32, [0, self.freq >> 8, self.freq & 0xff, 0x00, 0x04, 0xc4, 0xb4, 0x00]) # for 9600
         #self.flashcomm.send_command_frame(0x32, [0, 0x1, 0xc2, 0x00, 0x04, 0xc4, 0xb4, 0x00]) # for 115200?
-        self.flashcomm.send_command_frame(0x32, [(self.freq >> 0x18) & 0xff, (self.freq >> 0x10) & 0xff, (self.freq >> 0x8) & 0xff, self.freq & 0xff, (self.int_freq >> 0x18) & 0xff, (self.int_freq >> 0x10) & 0xff, (self.int_freq >> 0x8) & 0xff, self.int_freq & 0xff])
-        _r = self.recv()
-        if _r != b'\x32':
-            raise ValueError("Command 32 failed")
-        sleep(0.1)
-        self.flashcomm.send_data_frame([0x32])
-        _r = self.recv()
-        return _r
-
+        return (yield from self.two_phase_steps(0x32, [(self.freq >> 0x18) & 0xff, (self.freq >> 0x10) & 0xff, (self.freq >> 0x8) & 0xff, self.freq & 0xff, (self.int_freq >> 0x18) & 0xff, (self.int_freq >> 0x10) & 0xff, (self.int_freq >> 0x8) & 0xff, self.int_freq & 0xff]))
 
+    def freq_set(self):
+        return self.run(self.freq_set_steps())
 
     def cmd_38(self):
-        self.flashcomm.send_command_frame(0x38)
-        _r = self.recv()
-        if _r != b'\x38':
-            return _r
-        self.flashcomm.send_data_frame([0x38])
-        _r = self.recv()
-        return _r
+        return self.run(self.two_phase_steps(0x38))
 
-    def cmd_34(self):
-        ''' Not sure what it does '''
-        self.flashcomm.send_command_frame(0x34, [0, 0, 0x25, 0x80]) # Sets baud rate you shlonkendonkel
-        _r = self.recv()
+    def cmd_34_steps(self, baud = 9600):
+        ''' Sets the bit rate, the host has to follow right after the status frame '''
+        yield (IO_Op.COMMAND, 0x34, [(baud >> 0x18) & 0xff, (baud >> 0x10) & 0xff, (baud >> 0x8) & 0xff, baud & 0xff])
+        _r = yield (IO_Op.FRAME, None)
         if _r != b'\x34':
             raise ValueError("Cmd 34 failed")
 
+    def cmd_34(self, baud = 9600):
+        return self.run(self.cmd_34_steps(baud))
+
     def cmd_2c(self):
-        self.flashcomm.send_command_frame(0x2c)
-        _r = self.recv()
-        if _r != b'\x2c':
-            raise ValueError("Cmd 2c failed")
-        self.flashcomm.send_data_frame([0x2c])
-        return self.recv()
+        return self.run(self.two_phase_steps(0x2c))
 
-    def pre_reset(self):
-        if self.flashcomm.reset_bl() != 0:
+    def pre_reset_steps(self):
+        self.flashcomm.set_baud(self.sync_baud)
+        if (yield from self.flashcomm.reset_steps()) != 0:
             raise NoResponseError("RH850 baud sync failed")
-        self.cmd_38()
-        self.freq_set()
-        self.cmd_34()
+        yield from self.two_phase_steps(0x38)
+        yield from self.freq_set_steps()
+        yield from self.cmd_34_steps(self.baud)
+        self.flashcomm.set_baud(self.baud)
+
+    def pre_reset(self):
+        return self.run(self.pre_reset_steps())
 
-    def reset(self):
+    def reset_steps(self):
         ''' RH850 seems to require a very specific reset sequence. After this - requires post_reset and 3a'''
-        _r = self.pre_reset()
-        if _r == -1:
-            return -1
+        yield from self.pre_reset_steps()
         # Check return of reset command - bootloader can be locked
-        _r = self.reset_command()
-        return _r
+        _r = yield from self.reset_command_steps()
+        return self.chk_return(self.COMMAND_RESET, _r)
+
+    def set_baud(self, baud):
+        ''' The bit rate can only be set in the reset sequence, so this resets again at the new rate '''
+        _baud = self.baud
+        self.baud = baud
+        try:
+            _r = self.reset()
+        except (ValueError, OSError) as e:
+            logging.debug(e)
+            _r = -1
+        if _r:
+            self.baud = _baud
+            return -1
+        return 0
 
     def post_reset(self):
         _r = self.cmd_2c()
@@ -123,33 +139,30 @@ class RH850Programmer(RenesasFlashProgrammer):
         return self.recv()
         
 
-    def read(self, addr_start, n_bytes):
+    def read_stream_steps(self, addr_start, n_bytes):
+        ''' Every frame has to be requested with a [COMMAND_READ] data frame and comes back prefixed with it '''
         data = self._get_addr_data(addr_start, addr_start + n_bytes - 1)
-        self.flashcomm.send_command_frame(self.COMMAND_READ, data)
-        _r = self.flashcomm.recv_data_frame()
-        if not _r or _r[0] != self.COMMAND_READ:
-            return _r
-        self.flashcomm.send_data_frame([self.COMMAND_READ])
-        n_rcvd = 0
-        bytes_ = b''
-        while n_rcvd < n_bytes:
-            _r = self.flashcomm.recv_data_frame()
-            logging.info(_r)
-            bytes_ += _r[1:]
-            n_rcvd += len(_r) - 1
-            if n_rcvd < n_bytes:
-                self.flashcomm.send_data_frame([self.COMMAND_READ])
-        logging.info(bytes_)
-        return bytes_
-
-        
-    def block_erase(self, addr):
+        yield (IO_Op.COMMAND, self.COMMAND_READ, data)
+        _r = yield (IO_Op.FRAME, self.cmd_timeout("status"))
+        if self.chk_return(self.COMMAND_READ, _r):
+            raise NoAckError("Read {:x} - {:x} failed: {}".format(addr_start, addr_start + n_bytes - 1, _r))
+        addr = addr_start
+        addr_end = addr_start + n_bytes
+        while addr < addr_end:
+            yield (IO_Op.DATA, [self.COMMAND_READ])
+            _r = yield (IO_Op.FRAME, self.cmd_timeout("read", min(addr_end - addr, 0x400)))
+            if self.chk_return(self.COMMAND_READ, _r) or len(_r) < 2:
+                raise NoAckError("Read {:x} failed: {}".format(addr, _r))
+            logging.debug("Read {:x}: {} bytes".format(addr, len(_r) - 1))
+            yield (IO_Op.OUT, (addr, memoryview(_r)[1:1 + addr_end - addr]))
+            addr += len(_r) - 1
+
+    def block_erase_steps(self, addr, addr_end = None):
         ''' Erase the block on given address '''
         data = self._get_addr_data(addr, addr)[0:4] 
-        self.flashcomm.send_command_frame(self.COMMAND_BLOCK_ERASE, data)
-        sleep(0.5)
-        _r = self.recv()
-        return _r
+        yield (IO_Op.COMMAND, self.COMMAND_BLOCK_ERASE, data)
+        _region = self.get_layout().region(addr)
+        return (yield (IO_Op.FRAME, self.cmd_timeout("erase", _region[2] if _region else self.fl_block_size)))
 
     def cmd_30(self, ocd_id = [0xff for _i in range(0x20)]):
         ''' Possibly unlocks the old bootloader with the OCD ID? '''
@@ -158,19 +171,20 @@ class RH850Programmer(RenesasFlashProgrammer):
         return _r
     
     def cmd_3a(self):
-        self.flashcomm.send_command_frame(0x3a)
-        _r = self.recv()
-        self.flashcomm.send_data_frame([0x3a])
-        return self.recv()
+        return self.run(self.two_phase_steps(0x3a))
+
+    def get_signature(self):
+        ''' Two phase like read, the signature follows the command byte '''
+        return self.cmd_3a()[1:]
 
     def cmd_3b(self):
         for _i in range(0xc):
             self.flashcomm.send_command_frame(0x3b, [_i])
             _r = self.recv()
 
-    def program(self, addr_start, bin_data):
+    def program_steps(self, addr_start, bin_data, n_bytes = 0, prefix = b''):
         # For rh850: there's a 0x13 in front of every data frame
-        return super().program(addr_start, [self.COMMAND_PROGRAMMING] + bin_data, n_bytes = len(bin_data))
+        return (yield from super().program_steps(addr_start, bin_data, n_bytes = len(bin_data), prefix = bytes((self.COMMAND_PROGRAMMING,))))
 
     def get_blk_size(self, addr):
         if addr >= 0xff200000:
@@ -179,9 +193,11 @@ class RH850Programmer(RenesasFlashProgrammer):
             blk_size = 0x400
         return blk_size
 
-    def verify(self, addr_start, bin_data):
-        return super().verify(addr_start, [self.COMMAND_VERIFY] + bin_data, n_bytes = len(bin_data))
-
+    def get_program_align(self, addr):
+        ''' Data flash is programmed in smaller units than the code flash '''
+        if addr >= 0xff200000:
+            return 0x40
+        return 0x100
 
     def checksum(self, addr_st, addr_e):
         return super().get_checksum(addr_st, addr_e)
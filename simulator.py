@@ -0,0 +1,569 @@
+'''
+    Simulated bootloader target speaking the Renesas flash programming frame protocol over a pty.
+    Lets the transport and the programmers run (and be benchmarked) without hardware:
+
+        python simulator.py rh850 --baud 115200 --erase_time 0.005
+        GPIOZERO_PIN_FACTORY=mock python main.py rh850 uart2 --port /dev/pts/5 sig
+
+    The RESET/FLMD0 lines can't be seen over a pty, so the simulator (re)starts a session on the sync bytes instead.
+    On the UART1 of the 78K0R the target talks first, there the host flushing its input right before it releases
+    RESET stands in for the reset (pty packet mode) and is answered with the 0x00 sync byte.
+'''
+import argparse
+import fcntl
+import logging
+import os
+import random
+import select
+import struct
+import termios
+import threading
+import tty
+from time import sleep, perf_counter
+
+from defs import MCU_Type
+from checksum import frame_checksum, area_checksum
+from layout import LAYOUTS
+
+
+FRAME_SOH       =   0x01
+FRAME_ETB       =   0x17
+FRAME_ETX       =   0x03
+
+STATUS_COMMAND_ERROR    =   0x04
+STATUS_PARAM_ERROR      =   0x05
+STATUS_ACK              =   0x06
+STATUS_CHECKSUM_ERROR   =   0x07
+STATUS_VERIFY_ERROR     =   0x0f
+STATUS_NOT_BLANK        =   0x1b
+
+''' Canned responses, taken from rfpi.md where possible '''
+RH850_DEVICE_INFO = [0x10, 0xff, 0x40, 0x00, 0x48, 0x00, 0x00, 0x01, 0x6e, 0x36, 0x00, 0x00, 0x7a, 0x12, 0x00, 0x04, 0xc4, 0xb4, 0x00, 0x01, 0x7d, 0x78, 0x40]
+RH850_FREQ_INFO = [0x04, 0xc4, 0xb4, 0x00, 0x02, 0x62, 0x5a, 0x00]
+SIGNATURE = [0x10, 0x00, 0x01] + list(b"SIMULATED ") + [0xff, 0xff, 0x2f, 0x00] + [0xff, 0x7f, 0x00, 0x02] + [0x04, 0x00, 0x00]
+''' Time from the (simulated) reset to the 0x00 of the UART1 sync, in the host's sleep after the flush '''
+UART1_SYNC_DELAY = 0.001
+''' Erase blocks of data flash are this small, bigger ones are code flash '''
+DATA_FLASH_BLK_SIZE = 0x40
+
+''' Baud rate codes of the 0x9A command and the R32C baud select commands '''
+GENERIC_BAUD_CODES = {0x00: 115200, 0x01: 250000, 0x02: 500000, 0x03: 1000000}
+R32C_BAUD_CODES = {0xb0: 9600, 0xb1: 19200, 0xb2: 38400, 0xb3: 57600, 0xb4: 115200}
+
+''' termios speed constants, to see which rate the host set on its end of the pty '''
+TERMIOS_RATES = {getattr(termios, "B{}".format(b)): b for b in (9600, 19200, 38400, 57600, 115200, 230400, 460800, 500000, 1000000)
+                 if hasattr(termios, "B{}".format(b))}
+
+
+class FlashRegion():
+    ''' A contiguous area of flash, erased in blocks of blk_size '''
+
+    def __init__(self, start, size, blk_size):
+        self.start = start
+        self.end = start + size - 1
+        self.blk_size = blk_size
+        self.data = bytearray(b'\xff' * size)
+
+    def contains(self, addr_start, addr_end):
+        return self.start <= addr_start <= addr_end <= self.end
+
+
+class SimulatedTarget():
+    '''
+        Serves a single bootloader session on the master side of a pty.
+        :param mcu_type: MCU_Type to emulate - determines framing (STX, length bytes), address size and command set
+        :param flash_map: list of (start, size, erase block size), defaults to the layout in layout.py
+        :param baud_rate: if set, every byte costs the time it would take on the wire at this rate
+        :param erase_time: latency per erased block (s)
+        :param program_time: latency per programmed KiB (s)
+        :param bad_chk_rate: probability of a response frame getting a wrong checksum
+        :param drop_rate: probability of a byte being dropped from a response frame
+        :param echo: echo every received byte back, as on the single wire modes
+        :param max_baud: highest rate the target accepts when asked to switch (None: any)
+
+        After a baud rate switch, bytes the host sends at another (standard) rate are lost, as on a real line.
+        The host going back to the rate of the sync counts as a reset.
+    '''
+
+    def __init__(self, mcu_type, flash_map = None, baud_rate = None, erase_time = 0.0, program_time = 0.0,
+                 bad_chk_rate = 0.0, drop_rate = 0.0, echo = False, read_chunk = None, seed = None, max_baud = None):
+        self.type = mcu_type
+        self.rh850 = mcu_type == MCU_Type.RH850
+        self.FRAME_STX = {MCU_Type.RH850: 0x81, MCU_Type.V850E2: 0x11}.get(mcu_type, 0x02)
+        self.n_len_bytes = 2 if mcu_type in (MCU_Type.RH850, MCU_Type.V850E2) else 1
+        self.n_addr_bytes = 4 if mcu_type in (MCU_Type.RH850, MCU_Type.V850E2) else 3
+        # Only the V850E2 signature has the data flash end (DeviceProfile, rfpi.md)
+        self.sig_data_flash_end = mcu_type == MCU_Type.V850E2
+        # The target sends 0x00 after the reset and waits for the host's (fp_uart1)
+        self.uart1_sync = mcu_type == MCU_Type.R78K0R
+        # When that 0x00 is due, None if no reset is pending
+        self.sync_at = None
+        self.read_chunk = read_chunk if read_chunk else (0x400 if self.rh850 else 0x100)
+
+        self.regions = [FlashRegion(*r) for r in (flash_map if flash_map else LAYOUTS.get(mcu_type, [(0x0, 0x10000, 0x400)]))]
+        self.baud_rate = baud_rate
+        self.byte_time = 10.0 / baud_rate if baud_rate else 0.0
+        self.max_baud = max_baud
+        # Rate the target switched to, None while it is at the rate of the sync
+        self.baud = None
+        self.sync_baud = None
+        self.erase_time = erase_time
+        self.program_time = program_time
+        self.bad_chk_rate = bad_chk_rate
+        self.drop_rate = drop_rate
+        self.echo = echo
+        self.rand = random.Random(seed)
+
+        self.master = None
+        self.slave = None
+        self.port = None
+        self.in_buf = bytearray()
+        self.running = False
+        self.synced = False
+        self.unlocked = False
+        # Command waiting for data frames: (cmd, next address, end address)
+        self.pending = None
+        self.n_commands = 0
+
+    def open(self):
+        ''' Creates the pty, returns the name of the port to give to RenesasFlashComm '''
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        if self.uart1_sync:
+            fcntl.ioctl(self.master, termios.TIOCPKT, struct.pack("i", 1))
+        self.port = os.ttyname(self.slave)
+        return self.port
+
+    def close(self):
+        self.running = False
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self.master = self.slave = None
+
+    def start(self):
+        ''' Serves in a background thread, returns the port name '''
+        if self.master is None:
+            self.open()
+        threading.Thread(target = self.serve_forever, daemon = True).start()
+        return self.port
+
+    def serve_forever(self):
+        if self.master is None:
+            self.open()
+        self.running = True
+        try:
+            while self.running:
+                self.step()
+        except OSError as e:
+            if self.running:
+                logging.error("Simulator stopped: {}".format(e))
+
+    def load(self, addr, data):
+        ''' Preloads flash contents '''
+        r = self._region(addr, addr + len(data) - 1)
+        if not r:
+            raise ValueError("{:08x} - {:08x} not in the flash map".format(addr, addr + len(data) - 1))
+        r.data[addr - r.start:addr - r.start + len(data)] = data
+
+    def signature(self):
+        '''
+            SIGNATURE with the flash ends of the flash map (little endian, address size of the MCU type), the data
+            flash end only in the families whose signature has it
+        '''
+        code = [r.end for r in self.regions if r.blk_size > DATA_FLASH_BLK_SIZE]
+        data = [r.end for r in self.regions if r.blk_size <= DATA_FLASH_BLK_SIZE]
+        sig = SIGNATURE[:13] + list(max(code).to_bytes(self.n_addr_bytes, "little"))
+        if data and self.sig_data_flash_end:
+            sig += list(max(data).to_bytes(self.n_addr_bytes, "little"))
+        return sig + SIGNATURE[-3:]
+
+    def mem(self, addr_start, addr_end):
+        r = self._region(addr_start, addr_end)
+        return memoryview(r.data)[addr_start - r.start:addr_end - r.start + 1]
+
+    ''' Wire level '''
+
+    def _host_baud(self):
+        ''' Rate of the host end of the pty, None if it isn't a standard one '''
+        try:
+            return TERMIOS_RATES.get(termios.tcgetattr(self.slave)[5])
+        except termios.error:
+            return None
+
+    def set_baud(self, baud):
+        ''' Switches the target to baud (None: back to the rate of the sync) '''
+        if self.baud is None and baud is not None:
+            self.sync_baud = self._host_baud()
+        self.baud = baud
+        _b = baud if baud else self.baud_rate
+        self.byte_time = 10.0 / _b if self.baud_rate else 0.0
+
+    def _fill(self):
+        if self.sync_at is not None:
+            if not select.select([self.master], [], [], max(0.0, self.sync_at - perf_counter()))[0]:
+                self.sync_at = None
+                self.write_raw(b'\x00')
+                return
+        _d = os.read(self.master, 0x10000)
+        if not _d:
+            raise OSError("pty closed")
+        if self.uart1_sync:
+            if _d[0] & termios.TIOCPKT_FLUSHREAD and self.baud is None:
+                self.on_reset()
+            if _d[0]:
+                return
+            _d = _d[1:]
+        _host = self._host_baud()
+        if self.baud is not None and _host not in (None, self.baud):
+            if _host != self.sync_baud:
+                logging.debug("sim: host at {} baud, target at {}, dropped {} bytes".format(_host, self.baud, len(_d)))
+                return
+            self.set_baud(None)
+        if self.echo:
+            os.write(self.master, _d)
+        self.in_buf += _d
+
+    def _read(self, n):
+        while len(self.in_buf) < n:
+            self._fill()
+        _d = bytes(self.in_buf[:n])
+        del self.in_buf[:n]
+        return _d
+
+    def _wire_delay(self, n, since = None):
+        ''' Waits until n bytes could have gone over the wire '''
+        if not self.byte_time:
+            return
+        _t = n * self.byte_time - (perf_counter() - since if since is not None else 0)
+        if _t > 0:
+            sleep(_t)
+
+    def write_raw(self, data):
+        self._wire_delay(len(data))
+        os.write(self.master, bytes(data))
+
+    def send_frame(self, data, footer = FRAME_ETX):
+        ''' Sends a data frame, applying the configured faults '''
+        l = len(data)
+        d = bytearray([self.FRAME_STX]) + (l & ((1 << 8 * self.n_len_bytes) - 1)).to_bytes(self.n_len_bytes, "big") + bytes(data)
+        d += bytes([frame_checksum(d[1:]), footer])
+        if self.bad_chk_rate and self.rand.random() < self.bad_chk_rate:
+            d[-2] = (d[-2] + 1) & 0xff
+        if self.drop_rate and self.rand.random() < self.drop_rate * len(d):
+            del d[self.rand.randrange(len(d))]
+        self.write_raw(d)
+
+    def step(self):
+        ''' Handles one sync byte or frame from the host '''
+        _st = perf_counter()
+        lead = self._read(1)[0]
+        if self.type == MCU_Type.R32C:
+            self.r32c_command(lead)
+            return
+        if lead not in (FRAME_SOH, self.FRAME_STX):
+            self.on_byte(lead)
+            return
+        _hdr = self._read(self.n_len_bytes)
+        l = int.from_bytes(_hdr, "big")
+        if self.n_len_bytes == 1 and l == 0:
+            l = 0x100
+        _rest = self._read(l + 2)
+        self._wire_delay(1 + self.n_len_bytes + l + 2, _st)
+        payload = _rest[:l]
+        if _rest[-1] not in (FRAME_ETB, FRAME_ETX):
+            logging.debug("sim: bad footer {:02x}".format(_rest[-1]))
+            return
+        if _rest[-2] != frame_checksum(_hdr + payload):
+            self.send_status(payload[0] if payload else 0, STATUS_CHECKSUM_ERROR)
+            return
+        if lead == FRAME_SOH:
+            self.n_commands += 1
+            if not payload:
+                self.send_status(0, STATUS_COMMAND_ERROR)
+                return
+            self.on_command(payload[0], payload[1:])
+        else:
+            self.on_data(payload, _rest[-1])
+
+    def on_reset(self):
+        '''
+            The host flushed its input at the rate of the sync, as it does before releasing RESET. The 0x00 follows
+            UART1_SYNC_DELAY after the last flush, one for flushes in a row
+        '''
+        self.pending = None
+        self.sync_at = perf_counter() + UART1_SYNC_DELAY
+
+    def on_byte(self, b):
+        ''' Bytes outside of frames: sync sequence '''
+        if self.rh850:
+            if b == 0x00:
+                # A new run of sync bytes restarts the session
+                if self.synced is not None:
+                    self.synced = None
+                    self.pending = None
+                    self.set_baud(None)
+                    self.write_raw(b'\x00')
+            elif b == 0x55 and self.synced is None:
+                self.synced = True
+                self.write_raw(b'\xc1')
+        elif b == 0x00:
+            self.pending = None
+            self.set_baud(None)
+
+    ''' Responses '''
+
+    def send_status(self, cmd, status = STATUS_ACK):
+        if self.rh850:
+            self.send_frame([cmd] if status == STATUS_ACK else [cmd | 0x80, status])
+        else:
+            self.send_frame([status])
+
+    def send_result(self, cmd, data):
+        ''' RH850 prefixes result data with the command byte '''
+        self.send_frame(([cmd] if self.rh850 else []) + list(data))
+
+    ''' Flash '''
+
+    def _region(self, addr_start, addr_end):
+        for r in self.regions:
+            if r.contains(addr_start, addr_end):
+                return r
+        return None
+
+    def _addrs(self, args):
+        n = self.n_addr_bytes
+        if len(args) < n:
+            return None, None
+        s = int.from_bytes(args[:n], "big")
+        e = int.from_bytes(args[n:2 * n], "big") if len(args) >= 2 * n else s
+        return s, e
+
+    def erase(self, addr_start, addr_end):
+        ''' Erases all blocks touching the range, returns the amount of blocks '''
+        r = self._region(addr_start, addr_end)
+        s = addr_start - (addr_start - r.start) % r.blk_size
+        n = 0
+        while s <= addr_end:
+            r.data[s - r.start:s - r.start + r.blk_size] = b'\xff' * r.blk_size
+            s += r.blk_size
+            n += 1
+        if self.erase_time:
+            sleep(self.erase_time * n)
+        return n
+
+    def program(self, addr, data):
+        ''' Flash can only clear bits, so programming without erasing shows up on verify '''
+        r = self._region(addr, addr + len(data) - 1)
+        o = addr - r.start
+        r.data[o:o + len(data)] = bytes(a & b for a, b in zip(r.data[o:o + len(data)], data))
+        if self.program_time:
+            sleep(self.program_time * len(data) / 0x400)
+
+    ''' Protocol '''
+
+    def on_command(self, cmd, args):
+        self.pending = None
+        s, e = self._addrs(args)
+        ranged = {0x22, 0x32, 0x40, 0x13, 0x50, 0xb0} if not self.rh850 else {0x13, 0x15, 0x18}
+        if cmd in ranged and (s is None or e < s or not self._region(s, e)):
+            self.send_status(cmd, STATUS_PARAM_ERROR)
+            return
+        if self.rh850:
+            self.rh850_command(cmd, args, s, e)
+        else:
+            self.generic_command(cmd, args, s, e)
+
+    def generic_command(self, cmd, args, s, e):
+        if cmd in (0x00, 0x70, 0x90):
+            self.send_status(cmd)
+        elif cmd == 0x9a:
+            self.switch_baud(cmd, GENERIC_BAUD_CODES.get(args[0]) if args else None)
+        elif cmd == 0xc0:
+            self.send_status(cmd)
+            self.send_frame(self.signature())
+        elif cmd == 0xc5:
+            self.send_status(cmd)
+            self.send_frame([0x00, 0x00, 0x00, 0x04, 0x00, 0x00])
+        elif cmd == 0xa1:
+            self.send_status(cmd)
+            self.send_frame([0xff, 0x03, 0x00, 0x00, 0x00, 0x00])
+        elif cmd == 0x20:
+            for r in self.regions:
+                self.erase(r.start, r.end)
+            self.send_status(cmd)
+        elif cmd == 0x22:
+            self.send_status(cmd)
+            self.erase(s, e)
+            self.send_status(cmd)
+        elif cmd == 0x32:
+            blank = self.mem(s, e).tobytes().count(0xff) == e - s + 1
+            self.send_frame([STATUS_ACK if blank else STATUS_NOT_BLANK])
+        elif cmd == 0xb0:
+            self.send_status(cmd)
+            chk = area_checksum(self.mem(s, e))
+            self.send_frame([chk >> 8, chk & 0xff])
+        elif cmd in (0x40, 0x13, 0x50):
+            self.pending = (cmd, s, e)
+            self.send_status(cmd)
+        else:
+            self.send_status(cmd, STATUS_COMMAND_ERROR)
+
+    def rh850_command(self, cmd, args, s, e):
+        if cmd in (0x38, 0x32, 0x2c, 0x3a, 0x27, 0x15):
+            self.pending = (cmd, s, e)
+            self.send_status(cmd)
+        elif cmd == 0x18:
+            # The checksum follows the status right away, as the generic get_checksum expects
+            self.send_status(cmd)
+            chk = area_checksum(self.mem(s, e))
+            self.send_frame([chk >> 8, chk & 0xff])
+        elif cmd in (0x00, 0x26):
+            self.send_status(cmd)
+        elif cmd == 0x34:
+            self.switch_baud(cmd, int.from_bytes(args[:4], "big") if len(args) >= 4 else None)
+        elif cmd == 0x12:
+            if s is None or not self._region(s, s):
+                self.send_status(cmd, STATUS_PARAM_ERROR)
+                return
+            self.erase(s, s)
+            self.send_status(cmd)
+        elif cmd == 0x13:
+            self.pending = (cmd, s, e)
+            self.send_status(cmd)
+        else:
+            self.send_status(cmd, STATUS_COMMAND_ERROR)
+
+    def switch_baud(self, cmd, baud):
+        ''' Acknowledges at the old rate, then switches '''
+        if not baud or (self.max_baud and baud > self.max_baud):
+            self.send_status(cmd, STATUS_PARAM_ERROR)
+            return
+        self.send_status(cmd)
+        self.set_baud(baud)
+
+    def on_data(self, data, footer):
+        if not self.pending:
+            self.send_status(data[0] if data else 0, STATUS_COMMAND_ERROR)
+            return
+        cmd, s, e = self.pending
+        if self.rh850:
+            # Every data frame starts with the command byte
+            data = data[1:]
+            if cmd == 0x13:
+                self._program_frame(cmd, s, e, data)
+            elif cmd == 0x15:
+                self._read_frame(cmd, s, e)
+            else:
+                self.pending = None
+                if cmd == 0x38:
+                    self.send_result(cmd, RH850_DEVICE_INFO)
+                elif cmd == 0x32:
+                    self.send_result(cmd, RH850_FREQ_INFO)
+                elif cmd == 0x2c:
+                    self.send_result(cmd, [0xff])
+                elif cmd == 0x3a:
+                    self.send_result(cmd, self.signature())
+                elif cmd == 0x27:
+                    self.send_result(cmd, [0xcf, 0xff, 0x27, 0xba] + [0xff] * 28)
+            return
+
+        if cmd == 0x40:
+            self._program_frame(cmd, s, e, data)
+        elif cmd == 0x13:
+            n = min(len(data), e - s + 1)
+            ok = self.mem(s, s + n - 1) == data[:n]
+            self.pending = (cmd, s + n, e) if s + n <= e else None
+            self.send_frame([STATUS_ACK, STATUS_ACK if ok else STATUS_VERIFY_ERROR])
+        elif cmd == 0x50:
+            self._read_frame(cmd, s, e)
+
+    def _program_frame(self, cmd, s, e, data):
+        n = min(len(data), e - s + 1)
+        self.program(s, data[:n])
+        self.pending = (cmd, s + n, e) if s + n <= e else None
+        if self.rh850:
+            self.send_status(cmd)
+        else:
+            self.send_frame([STATUS_ACK, STATUS_ACK])
+
+    def _read_frame(self, cmd, s, e):
+        n = min(self.read_chunk, e - s + 1)
+        self.pending = (cmd, s + n, e) if s + n <= e else None
+        self.send_result(cmd, self.mem(s, s + n - 1))
+
+
+    def r32c_command(self, cmd):
+        ''' The R32C bootloader has no frames, just command bytes followed by their arguments '''
+        if cmd == 0x00:
+            self.set_baud(None)
+        elif cmd in R32C_BAUD_CODES:
+            # Baud rate selection, echoed back at the old rate. Rates it can't do are ignored
+            if self.max_baud and R32C_BAUD_CODES[cmd] > self.max_baud:
+                return
+            self.write_raw(bytes((cmd,)))
+            self.set_baud(R32C_BAUD_CODES[cmd])
+        elif cmd == 0x70:
+            self.write_raw(bytes((0x80, 0x0c if self.unlocked else 0x00)))
+        elif cmd == 0xf5:
+            _a = self._read(4)
+            self._read(_a[3])
+            self.unlocked = True
+        elif cmd == 0xff:
+            _a = self._read(2)
+            addr = (_a[1] << 16) | (_a[0] << 8)
+            self.write_raw(self.mem(addr, addr + 0xff) if self._region(addr, addr + 0xff) else b'\xff' * 0x100)
+        elif cmd == 0x41:
+            _a = self._read(2)
+            addr = (_a[1] << 16) | (_a[0] << 8)
+            self.program(addr, self._read(0x100))
+        elif cmd == 0x20:
+            _a = self._read(3)
+            addr = (_a[1] << 16) | (_a[0] << 8)
+            self.erase(addr, addr)
+        elif cmd == 0xa7:
+            self._read(1)
+            for r in self.regions:
+                self.erase(r.start, r.end)
+
+
+def _region_arg(arg):
+    start, size, blk = arg.split(":")
+    return (int(start, 16), int(size, 16), int(blk, 16))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Simulated Renesas bootloader on a pty', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("mcu", help="The MCU type to simulate", choices = [t.value for t in MCU_Type])
+    parser.add_argument("--flash", help="Flash region start:size:erase_block (hex), can be repeated", type = _region_arg, action = "append")
+    parser.add_argument("--load", help="Preload flash with addr:file (addr in hex), can be repeated", action = "append", default = [])
+    parser.add_argument("--baud", help="Simulate the wire time of this baud rate (0: no delay)", type = int, default = 0)
+    parser.add_argument("--erase_time", help="Erase latency per block (s)", type = float, default = 0.0)
+    parser.add_argument("--program_time", help="Program latency per KiB (s)", type = float, default = 0.0)
+    parser.add_argument("--bad_chk", help="Probability of a response frame with a bad checksum", type = float, default = 0.0)
+    parser.add_argument("--drop", help="Probability per byte of dropping a byte of a response frame", type = float, default = 0.0)
+    parser.add_argument("--echo", help="Echo received bytes (single wire modes)", action = "store_true")
+    parser.add_argument("--seed", help="Seed for the fault injection", type = int)
+    parser.add_argument("--max_baud", help="Highest rate the target agrees to switch to (0: any)", type = int, default = 0)
+    parser.add_argument("--log_level", help="Logging level", choices = ["info", "debug"], default = "info")
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.DEBUG if args.log_level == "debug" else logging.INFO, format="%(filename)s:%(funcName)s: %(message)s")
+
+    sim = SimulatedTarget(MCU_Type(args.mcu), flash_map = args.flash, baud_rate = args.baud, erase_time = args.erase_time,
+                          program_time = args.program_time, bad_chk_rate = args.bad_chk, drop_rate = args.drop,
+                          echo = args.echo, seed = args.seed, max_baud = args.max_baud)
+    port = sim.open()
+    for _l in args.load:
+        _addr, _file = _l.split(":", 1)
+        with open(_file, "rb") as f:
+            sim.load(int(_addr, 16), f.read())
+    print("Simulated {} bootloader on {}".format(args.mcu, port))
+    try:
+        sim.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    sim.close()
@@ -0,0 +1,63 @@
+'''
+    Settings learned from targets (reset timings, ...) that are kept between runs. All of them live in one JSON
+    file, keyed by MCU type and communication mode:
+
+        {"rh850/uart2": {"timings": {"RESET_OFF_TIME": 0.002, ...}}}
+
+    The directory is ~/.cache/rfpi, or $RFPI_CACHE if set
+'''
+import json
+import logging
+import os
+import tempfile
+import threading
+
+
+STORE_FILE  =   "targets.json"
+
+''' Sessions in threads (gang.py) save at the same time, the load-modify-save of one must not interleave with another '''
+_lock = threading.Lock()
+
+
+def store_path():
+    cache_dir = os.environ.get("RFPI_CACHE") or os.path.join(os.path.expanduser("~"), ".cache", "rfpi")
+    return os.path.join(cache_dir, STORE_FILE)
+
+
+def store_key(mcu_type, comm_mode):
+    return "{}/{}".format(mcu_type.value, comm_mode.value)
+
+
+def _load_all(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.warning("Ignoring {}: {}".format(path, e))
+        return {}
+
+
+def load(key, section):
+    ''' The stored section (dict) of key, None if there is none '''
+    return _load_all(store_path()).get(key, {}).get(section)
+
+
+def save(key, section, values):
+    '''
+        Replaces the section of key. Written to a temporary file of its own first, so an interruption never leaves a
+        broken store and writers don't clobber each other's file
+    '''
+    path = store_path()
+    with _lock:
+        entries = _load_all(path)
+        entries.setdefault(key, {})[section] = values
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with tempfile.NamedTemporaryFile('w', dir = os.path.dirname(path), prefix = STORE_FILE, suffix = ".tmp", delete = False) as f:
+            json.dump(entries, f, indent = 1, sort_keys = True)
+        try:
+            os.replace(f.name, path)
+        except OSError:
+            os.unlink(f.name)
+            raise
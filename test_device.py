@@ -0,0 +1,24 @@
+import pytest
+
+from defs import *
+from device import DeviceProfile
+from layout import LAYOUTS
+from main import flash_programmers
+from simulator import SimulatedTarget
+
+
+@pytest.mark.parametrize("mcu", [t for t in flash_programmers if t in LAYOUTS])
+def test_decodes_the_simulator_signature(mcu):
+    f_p = flash_programmers[mcu]
+    if f_p.COMMAND_SIGNATURE is None:
+        pytest.skip("No signature command")
+    p = DeviceProfile.decode(bytes(SimulatedTarget(mcu).signature()), f_p.SIG_DATA_FLASH_END)
+    assert p.code_flash_end is not None
+    assert p.name == "SIMULATED"
+    assert p.regions(LAYOUTS[mcu]) == sorted(LAYOUTS[mcu])
+    assert (p.data_flash_end is not None) == f_p.SIG_DATA_FLASH_END
+
+def test_regions_are_cut_not_grown():
+    p = DeviceProfile()
+    p.code_flash_end, p.data_flash_end = 0x1fffff, 0x0200ffff
+    assert p.regions(LAYOUTS[MCU_Type.V850E2]) == [(0x0, 0x200000, 0x8000), (0x02000000, 0x8000, 0x40)]
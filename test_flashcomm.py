@@ -0,0 +1,119 @@
+from time import time
+
+import pytest
+
+from defs import *
+from checksum import frame_checksum
+from flashcomm import FrameParser, RenesasFlashComm
+
+
+def parser(stx = 0x02, n_len_bytes = 1):
+    return FrameParser(stx, n_len_bytes, frame_checksum)
+
+def frame(data, stx = 0x02, n_len_bytes = 1, footer = 0x03, chk = 0):
+    ''' A data frame around data, chk is added to the checksum to break it '''
+    body = (len(data) % (1 << 8 * n_len_bytes)).to_bytes(n_len_bytes, "big") + bytes(data)
+    return bytes([stx]) + body + bytes([(frame_checksum(body) + chk) & 0xff, footer])
+
+
+def test_whole_frame():
+    p = parser()
+    f = frame(b"\x06\x01\x02")
+    assert p.feed(f) == len(f)
+    assert p.state == p.COMPLETE
+    assert p.payload() == b"\x06\x01\x02"
+    assert p.n_skipped == 0
+
+def test_byte_by_byte():
+    p = parser()
+    for b in frame(b"\x06\x01\x02", footer = 0x17):
+        assert p.state != p.COMPLETE
+        p.feed(bytes([b]))
+    assert p.payload() == b"\x06\x01\x02"
+
+def test_want_follows_the_length_field():
+    p = parser(0x81, 2)
+    f = frame(bytes(0x300), 0x81, 2)
+    assert p.want() == 1
+    p.feed(f[:1])
+    assert p.want() == 2
+    p.feed(f[1:3])
+    assert p.want() == 0x300 + 2
+    p.feed(f[3:])
+    assert p.payload() == bytes(0x300)
+
+def test_zero_length_is_0x100():
+    p = parser()
+    f = frame(bytes(range(0x100)))
+    assert f[1] == 0x00
+    p.feed(f)
+    assert p.payload() == bytes(range(0x100))
+
+def test_skips_idle_and_garbage():
+    p = parser()
+    p.feed(b"\x00\x00\xaa\x55" + frame(b"\x06"))
+    assert p.payload() == b"\x06"
+    assert p.n_skipped == 4
+    assert p.n_garbage == 2
+
+def test_stops_at_the_end_of_the_frame():
+    p = parser()
+    first, second = frame(b"\x06"), frame(b"\x06\x12\x34")
+    assert p.feed(first + second) == len(first)
+    assert p.payload() == b"\x06"
+    p.reset()
+    p.feed((first + second)[len(first):])
+    assert p.payload() == b"\x06\x12\x34"
+
+def test_bad_checksum_is_an_error():
+    p = parser()
+    f = frame(b"\x06\x02\x02", chk = 1)
+    assert p.feed(f + frame(b"\x06")) == len(f)
+    assert p.state == p.ERROR
+    assert isinstance(p.error, InvalidChecksumError)
+
+def test_bad_footer_is_an_error():
+    p = parser()
+    p.feed(frame(b"\x06", footer = 0x04))
+    assert p.state == p.ERROR
+    assert isinstance(p.error, InvalidFooterError)
+
+def test_no_resync_into_the_payload():
+    ''' RH850: a broken frame with STX in its payload must not be taken for the start of another one '''
+    p = parser(0x81, 2)
+    p.feed(frame(b"\x13\x81\x00\x40\x00\x00", 0x81, 2, chk = 1))
+    assert p.state == p.ERROR
+    assert isinstance(p.error, InvalidChecksumError)
+
+def test_resync_on_empty_header():
+    p = parser(0x81, 2)
+    p.feed(b"\x81\x00\x00" + frame(b"\x13", 0x81, 2))
+    assert p.state == p.COMPLETE
+    assert p.payload() == b"\x13"
+    assert p.n_skipped == 3
+    assert p.n_garbage == 1
+
+
+class Line():
+    ''' Stands in for the flashcomm device: recv() hands out what is queued, then nothing '''
+    def __init__(self, data, stx = 0x02, n_len_bytes = 1):
+        self.data = bytes(data)
+        self.parser = parser(stx, n_len_bytes)
+
+    def recv(self, n_bytes):
+        _r, self.data = self.data[:n_bytes], self.data[n_bytes:]
+        return _r
+
+def test_recv_data_frame():
+    assert RenesasFlashComm.recv_data_frame(Line(frame(b"\x06\x55"))) == b"\x06\x55"
+
+def test_recv_data_frame_raises_checksum_error_at_once():
+    line = Line(frame(b"\x13\x81\x00\x40", 0x81, 2, chk = 1) + bytes(0x10), 0x81, 2)
+    st_t = time()
+    with pytest.raises(InvalidChecksumError):
+        RenesasFlashComm.recv_data_frame(line)
+    assert time() - st_t < 0.5
+
+def test_recv_data_frame_no_response():
+    with pytest.raises(NoResponseError):
+        RenesasFlashComm.recv_data_frame(Line(b""))
@@ -0,0 +1,31 @@
+import os
+
+import pytest
+
+from defs import *
+from device import DeviceProfile, load_profile, save_profile
+from flashcomm import RenesasFlashComm
+from gang import GangSession, gang_program
+from image import Image
+from main import flash_programmers
+from simulator import SimulatedTarget
+
+
+def test_two_sessions_negotiate_and_save_at_once(tmp_path, monkeypatch):
+    ''' Both sessions remember the negotiated rate in the same store at the same time '''
+    monkeypatch.setenv("RFPI_CACHE", str(tmp_path))
+    mcu, mode = MCU_Type.RH850, Comm_Mode.UART2
+    sims = [SimulatedTarget(mcu) for _ in range(2)]
+    save_profile(mcu, mode, DeviceProfile.decode(bytes(sims[0].signature())))
+    sessions = []
+    for i, sim in enumerate(sims):
+        fc = RenesasFlashComm(mcu, mode, port = sim.start(), gpio_reset = 5 + 2 * i, gpio_flmd = 6 + 2 * i)
+        sessions.append(GangSession(str(i), flash_programmers[mcu](flashcomm = fc)))
+    data = os.urandom(0x2000)
+    image = Image()
+    image.add(0, data)
+    gang_program(sessions, image, 0, max_baud = 1000000, verify = True)
+    assert [s.error for s in sessions] == [None, None]
+    assert all(bytes(sim.mem(0, len(data) - 1)) == data for sim in sims)
+    assert load_profile(mcu, mode).baud == 1000000
+    assert os.listdir(str(tmp_path)) == ["targets.json"]
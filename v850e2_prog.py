@@ -7,8 +7,11 @@ from defs import Comm_Mode, MCU_Type
 class V850Programmer(RenesasFlashProgrammer):
     ''' Class to program the V850 MCUs '''
 
+    SIG_DATA_FLASH_END  =   True
 
     def __init__(self, **kwargs):
         super().__init__(MCU_Type.V850E2, **kwargs)
+        # 4 byte addresses (rfpi.md: the blank check takes 00 00 00 00 00 0b ff ff), the data flash is at 0x02000000
+        self.n_bytes = 4
 
 